@@ -0,0 +1,154 @@
+"""
+Payer adapters
+##############
+
+One adapter per payer, for `crawler.py`. Each one only knows where its
+payer lists its files; the crawler handles the catalog, index files and
+sizes. To add a payer, subclass `Adapter`, give it a `name`, and add it
+to ADAPTERS.
+
+All requests go through the `session` argument, so that they're rate
+limited (and can be recorded and replayed, see `crawler.FixtureSession`).
+Dates in URLs are class attributes, so they can be bumped (or overridden
+on an instance) when a payer posts new files.
+"""
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+class Adapter:
+    """
+    Base class for a payer. Override `discover`, `indexes` or both.
+    """
+
+    name = None
+
+    # The kinds of links to pull out of this payer's index files
+    index_kinds = ("in_network",)
+
+    def discover(self, session):
+        """Yields (kind, url) or (kind, url, size) for links found directly"""
+        return ()
+
+    def indexes(self, session):
+        """Yields the URLs (or paths) of index files to get links from"""
+        return ()
+
+
+class Aetna(Adapter):
+    name = "aetna"
+
+    # The following values were inferred from looking at the network requests on the pages linked from here:
+    # https://www.aetna.com/individuals-families/member-rights-resources/rights/disclosure-information.html
+    brand_codes = ["ASH", "AETNACVS", "ALICUNDER100", "ALICFI", "ALICSI"]
+    date = "2022-08-05"
+    base_url = "https://mrf.healthsparq.com/aetnacvs-egress.nophi.kyruushsq.com/prd/mrf/AETNACVS_I"
+
+    def discover(self, session):
+        # You need to loop through each brand code to get all of the in-network files
+        for brand_code in self.brand_codes:
+            resp = session.get(f"{self.base_url}/{brand_code}/latest_metadata.json")
+            resp.raise_for_status()
+            file_paths = {
+                file["fileName"] for file in resp.json()["files"]
+                if file["fileSchema"] == "IN_NETWORK_RATES"
+            }
+            for file_path in sorted(file_paths):
+                yield "in_network", f"{self.base_url}/{brand_code}/{self.date}/inNetworkRates/{file_path}"
+
+
+class Anthem(Adapter):
+    """
+    Anthem (and Empire BC, which is part of it) posts one index for all its
+    plans. It's tens of GB, but it's streamed, so there's no need to split
+    it first.
+    """
+
+    name = "anthem"
+    date = "2022-08-01"
+    index_url = "https://antm-pt-preprod-dataz-nogbd-nophi-us-east1.s3.amazonaws.com/anthem/{date}_anthem_index.json.gz"
+
+    def indexes(self, session):
+        yield self.index_url.format(date=self.date)
+
+
+class BCBSNC(Adapter):
+    name = "bcbsnc"
+    mrfs_url = "https://www.bluecrossnc.com/about-us/policies-and-best-practices/transparency-coverage-mrf"
+
+    def indexes(self, session):
+        from bs4 import BeautifulSoup
+
+        resp = session.get(self.mrfs_url)
+        resp.raise_for_status()
+        soup = BeautifulSoup(resp.content, features="lxml")
+        for link in soup.find_all("a"):
+            if (url := link.get("href")) is not None and "index.json" in url:
+                yield url
+
+
+class Humana(Adapter):
+    name = "humana"
+    data_url = "https://developers.humana.com/Resource/GetData"
+    download_url = "https://developers.humana.com/Resource/DownloadPCTFile?fileType=innetwork&"
+    page_size = 2000
+
+    def _page(self, session, start):
+        params = {"fileType": "innetwork", "iDisplayLength": str(self.page_size), "iDisplayStart": start}
+        resp = session.get(self.data_url, params=params)
+        resp.raise_for_status()
+        return resp.json()
+
+    def _links(self, page):
+        # Humana gives the sizes, so these don't need sizing
+        for file in page["aaData"]:
+            yield "in_network", self.download_url + file["name"], int(file["size"])
+
+    def discover(self, session):
+        first = self._page(session, 0)
+        yield from self._links(first)
+
+        # The rest of the pages at once (the session limits how many)
+        starts = range(self.page_size, int(first["iTotalRecords"]), self.page_size)
+        with ThreadPoolExecutor(8) as pool:
+            for future in as_completed([pool.submit(self._page, session, start) for start in starts]):
+                yield from self._links(future.result())
+
+
+class Kaiser(Adapter):
+    name = "kaiser"
+    date = "2022-08"
+    base_url = "https://healthy.kaiserpermanente.org/pricing/innetwork"
+
+    def discover(self, session):
+        resp = session.get(f"{self.base_url}/{self.date}_List.txt")
+        resp.raise_for_status()
+
+        # Capture only the negotiated rates files (ignore table of contents and allowed amounts files)
+        for line in resp.text.split("\n"):
+            url = self.base_url + line.split("  ")[0].strip().replace(" ", "")
+            if "in-network-rates" in url:
+                yield "in_network", url
+            # Kaiser breaks the convention with their MRFs by not labeling them correctly here
+            elif "KPWA_FILE" in url:
+                yield "in_network", url
+
+
+class UHC(Adapter):
+    """UnitedHealthcare, and Optum (which is part of it) on the same API"""
+
+    name = "uhc"
+    blobs_url = "https://transparency-in-coverage.uhc.com/api/v1/uhc/blobs/"
+
+    def discover(self, session):
+        resp = session.get(self.blobs_url)
+        resp.raise_for_status()
+        for file in resp.json()["blobs"]:
+            yield "in_network", file["downloadUrl"]
+
+
+class Optum(UHC):
+    name = "optum"
+    blobs_url = "https://transparency-in-coverage.optum.com/api/v1/oh/blobs/"
+
+
+ADAPTERS = {adapter.name: adapter for adapter in (Aetna, Anthem, BCBSNC, Humana, Kaiser, Optum, UHC)}
@@ -0,0 +1,249 @@
+"""
+Payer crawler
+#############
+
+Finds the MRF URLs of each payer and puts them, with their sizes, in one
+shared catalog (a `mrfutils.idxutils.LinkCatalog`).
+
+Everything that's particular to a payer lives in an adapter (see
+`adapters.py`). An adapter yields links it found directly, as (kind, url)
+or (kind, url, size), and/or index files whose links should be pulled out
+and added. The crawler does the rest:
+
+1. Discovery: the adapters run at the same time, one thread per payer.
+   Index files that were read completely are skipped on the next run.
+2. Sizing: as soon as a payer's discovery is done, its URLs without a size
+   get HEAD requests (see `mrfutils.idxutils.size_links`).
+
+Every request made by an adapter goes through the session it's handed,
+which lets at most `per_host` requests to the same host run at once.
+Recording the responses of a real run with `--record DIR` and replaying
+them with `--replay DIR` runs the adapters without the network, which is
+how to check one after changing it.
+
+Usage:
+
+$ python crawler.py aetna humana kaiser --db catalog.db
+$ python crawler.py uhc --record fixtures/uhc --no-size
+$ python crawler.py uhc --replay fixtures/uhc --no-size --db /tmp/test.db
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from urllib.parse import urlsplit
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+from mrfutils.idxutils import LinkCatalog, gen_index_links, size_links
+
+from adapters import ADAPTERS
+
+log = logging.getLogger("crawler")
+
+
+class LimitedSession:
+    """
+    Wraps a requests.Session so that at most `per_host` requests to the
+    same host are in flight at once, and requests to a host start at
+    least `interval` seconds apart. Safe to share between threads.
+    """
+
+    def __init__(self, session=None, per_host=4, interval=0.0):
+        self.session = session or requests.Session()
+        self.per_host = per_host
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.hosts = {}
+
+    def _host(self, url):
+        host = urlsplit(url).netloc
+        with self.lock:
+            if host not in self.hosts:
+                self.hosts[host] = [threading.BoundedSemaphore(self.per_host), threading.Lock(), 0.0]
+            return self.hosts[host]
+
+    def request(self, method, url, **kwargs):
+        host = self._host(url)
+        semaphore, lock, _ = host
+        with semaphore:
+            if self.interval:
+                with lock:
+                    wait = host[2] + self.interval - time.monotonic()
+                    if wait > 0:
+                        time.sleep(wait)
+                    host[2] = time.monotonic()
+            kwargs.setdefault("timeout", 60)
+            return self.session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def head(self, url, **kwargs):
+        return self.request("HEAD", url, **kwargs)
+
+
+class FixtureSession:
+    """
+    Records the responses a session gets in `directory` (if `session` is
+    given) or replays them from there (if not). Replaying a request that
+    wasn't recorded raises KeyError.
+    """
+
+    def __init__(self, directory, session=None):
+        self.directory = Path(directory)
+        self.session = session
+        if session is not None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, method, url, params):
+        full_url = requests.Request(method, url, params=params).prepare().url
+        key = hashlib.sha1(f"{method} {full_url}".encode()).hexdigest()
+        return self.directory / key, full_url
+
+    def request(self, method, url, params=None, **kwargs):
+        path, full_url = self._path(method, url, params)
+        meta_path = path.with_suffix(".json")
+
+        if self.session is not None:
+            response = self.session.request(method, url, params=params, **kwargs)
+            path.with_suffix(".body").write_bytes(response.content)
+            meta_path.write_text(json.dumps({
+                "request": full_url,
+                "url": response.url,
+                "status": response.status_code,
+                "headers": dict(response.headers),
+            }, indent=2))
+            return response
+
+        if not meta_path.exists():
+            raise KeyError(f"No recorded response for {method} {full_url}")
+        meta = json.loads(meta_path.read_text())
+        response = requests.Response()
+        response.url = meta["url"]
+        response.status_code = meta["status"]
+        response.headers = CaseInsensitiveDict(meta["headers"])
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers) or "utf-8"
+        response._content = path.with_suffix(".body").read_bytes()
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def head(self, url, **kwargs):
+        return self.request("HEAD", url, **kwargs)
+
+
+def crawl_payer(adapter, db, session, size=True, concurrency=50, per_host=4):
+    """
+    Discovers, and then sizes, the links of one payer. Returns a summary
+    dict for that payer.
+    """
+    name = adapter.name
+    catalog = LinkCatalog(db)
+    added = {}
+
+    def count(new):
+        for kind, n in new.items():
+            added[kind] = added.get(kind, 0) + n
+
+    try:
+        count(catalog.add_links(adapter.discover(session), payer=name))
+
+        for index in adapter.indexes(session):
+            if catalog.is_indexed(index):
+                log.info(f"{name}: already read {index}")
+                continue
+            log.info(f"{name}: reading {index}")
+            count(catalog.add_links(gen_index_links(index, adapter.index_kinds), payer=name))
+            catalog.mark_indexed(index)
+
+        log.info(f"{name}: found {added or 'nothing new'}")
+
+        failed = {}
+        if size:
+            kinds = ("in_network",) + tuple(k for k in adapter.index_kinds if k != "in_network")
+            failed = asyncio.run(size_links(
+                catalog, kinds, concurrency=concurrency, per_host=per_host, payer=name,
+            ))
+
+        return {
+            "added": added,
+            "failed": {k: n for k, n in failed.items() if n},
+            "total_gb": catalog.total_size("in_network", name) / 1e9,
+        }
+    finally:
+        catalog.close()
+
+
+def crawl(adapters, db, session=None, size=True, concurrency=50, per_host=4):
+    """
+    Crawls `adapters` (names or instances) at the same time, each into
+    the catalog at `db`. Returns {payer: summary}; a payer that failed
+    gets {"error": ...} and doesn't stop the others.
+    """
+    adapters = [ADAPTERS[a]() if isinstance(a, str) else a for a in adapters]
+    session = session or LimitedSession(per_host=per_host)
+
+    # Create the tables once, before the threads race for them
+    LinkCatalog(db).close()
+
+    results = {}
+    with ThreadPoolExecutor(len(adapters) or 1, thread_name_prefix="crawl") as pool:
+        futures = {
+            pool.submit(crawl_payer, adapter, db, session, size, concurrency, per_host): adapter.name
+            for adapter in adapters
+        }
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                results[name] = future.result()
+            except Exception as e:
+                log.exception(f"{name} failed")
+                results[name] = {"error": repr(e)}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Catalog the MRF URLs of payers")
+    parser.add_argument("payers", nargs="*", help=f"default: all of {', '.join(sorted(ADAPTERS))}")
+    parser.add_argument("--db", default="catalog.db")
+    parser.add_argument("--per-host", type=int, default=4, help="requests in flight per host")
+    parser.add_argument("--interval", type=float, default=0.0, help="seconds between requests to a host")
+    parser.add_argument("--concurrency", type=int, default=50, help="HEAD requests in flight per payer")
+    parser.add_argument("--no-size", action="store_true", help="only discover the links")
+    fixtures = parser.add_mutually_exclusive_group()
+    fixtures.add_argument("--record", metavar="DIR", help="save the adapters' responses in DIR")
+    fixtures.add_argument("--replay", metavar="DIR", help="replay the adapters' responses from DIR")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(threadName)s %(message)s")
+
+    session = LimitedSession(per_host=args.per_host, interval=args.interval)
+    if args.record:
+        session = FixtureSession(args.record, session)
+    elif args.replay:
+        session = FixtureSession(args.replay)
+
+    results = crawl(
+        args.payers or sorted(ADAPTERS),
+        args.db,
+        session,
+        size=not args.no_size,
+        concurrency=args.concurrency,
+        per_host=args.per_host,
+    )
+    for name, result in sorted(results.items()):
+        print(name, json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
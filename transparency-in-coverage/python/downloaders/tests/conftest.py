@@ -0,0 +1,8 @@
+import sys
+from pathlib import Path
+
+# The downloaders are scripts, run from their own directory, and use
+# mrfutils from the source tree next to them unless it's installed
+HERE = Path(__file__).parent.parent
+sys.path.insert(0, str(HERE))
+sys.path.append(str(HERE.parent / "mrfutils" / "src"))
@@ -0,0 +1,96 @@
+"""
+Flattens many in-network files at once.
+
+>>> python3 batch_cli.py --index <index_url> --code-file <csvfile> --workers 8
+>>> python3 batch_cli.py --url-file urls.txt --npi-file <csvfile> --merge
+>>> python3 batch_cli.py --catalog catalog.db --max-large 2 --workers 8
+
+Each file goes to its own directory under --out-dir, unless you pass --merge,
+in which case everything ends up in the same set of tables.
+
+With --catalog, the files come from a catalog made by the downloaders'
+crawler instead, largest first, with at most --max-large files of --large-gb
+or more running at once. Run it again to pick up where it left off.
+"""
+import argparse
+import json
+import logging
+
+from mrfutils.batch import gen_urls, run_batch, summarize
+from mrfutils.helpers import import_csv_to_set, set_hasher, set_mirror, set_range_connections, HASHERS
+from mrfutils.mirror import FileMirror
+from mrfutils.scheduler import run_catalog
+from mrfutils.writers import WRITERS
+
+logging.basicConfig(format = '%(asctime)s - %(message)s')
+log = logging.getLogger('mrfutils')
+log.setLevel(logging.INFO)
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-u', '--url', action = 'append', default = [])
+parser.add_argument('-l', '--url-file')
+parser.add_argument('-i', '--index')
+parser.add_argument('-o', '--out-dir', default = 'csv_output')
+parser.add_argument('-c', '--code-file')
+parser.add_argument('-n', '--npi-file')
+parser.add_argument('-w', '--workers', type = int, default = 4)
+parser.add_argument('-r', '--retries', type = int, default = 2)
+parser.add_argument('-m', '--merge', action = 'store_true')
+parser.add_argument('--checkpoint', action = 'store_true')
+parser.add_argument('--hasher', choices = list(HASHERS), default = 'sha256')
+parser.add_argument('--output-format', choices = list(WRITERS), default = 'csv')
+parser.add_argument('--connections', type = int, default = 1)
+parser.add_argument('--mirror')
+parser.add_argument('--mirror-gb', type = int, default = 200)
+parser.add_argument('--catalog')
+parser.add_argument('--payer')
+parser.add_argument('--max-large', type = int, default = 1)
+parser.add_argument('--large-gb', type = float, default = 1)
+parser.add_argument('--retry-failed', action = 'store_true')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    set_hasher(args.hasher)
+    set_range_connections(args.connections)
+    if args.mirror:
+        set_mirror(FileMirror(args.mirror, max_bytes = args.mirror_gb << 30, connections = args.connections))
+
+    if args.code_file:
+        code_filter = import_csv_to_set(args.code_file)
+    else:
+        code_filter = None
+
+    if args.npi_file:
+        npi_filter = import_csv_to_set(args.npi_file)
+    else:
+        npi_filter = None
+
+    options = dict(
+        out_dir = args.out_dir,
+        workers = args.workers,
+        retries = args.retries,
+        merge = args.merge,
+        checkpoint = args.checkpoint,
+        code_filter = code_filter,
+        npi_filter = npi_filter,
+        output_format = args.output_format,
+    )
+
+    if args.catalog:
+        results = run_catalog(
+            args.catalog,
+            max_large = args.max_large,
+            large_size = int(args.large_gb * (1 << 30)),
+            payer = args.payer,
+            retry_failed = args.retry_failed,
+            **options,
+        )
+    else:
+        urls = gen_urls(args.url, args.url_file, args.index)
+        results = run_batch(urls, **options)
+
+    for result in results:
+        if result['status'] == 'failed':
+            print(f"FAILED {result['url']}: {result['error']}")
+
+    print(json.dumps(summarize(results), indent = 2))
@@ -10,8 +10,10 @@ line argument to do that.
 import argparse
 import logging
 
-from mrfutils.helpers import import_csv_to_set
+from mrfutils.helpers import import_csv_to_set, set_hasher, set_mirror, set_range_connections, HASHERS
 from mrfutils.flatteners import in_network_file_to_csv
+from mrfutils.mirror import FileMirror
+from mrfutils.writers import WRITERS
 
 logging.basicConfig()
 log = logging.getLogger('mrfutils')
@@ -23,8 +25,23 @@ parser.add_argument('-u', '--url')
 parser.add_argument('-o', '--out-dir', default = 'csv_output')
 parser.add_argument('-c', '--code-file')
 parser.add_argument('-n', '--npi-file')
+parser.add_argument('-w', '--workers', type = int, default = 1)
+parser.add_argument('--checkpoint', action = 'store_true')
+parser.add_argument('--dedup', action = 'store_true')
+parser.add_argument('--reference-db')
+parser.add_argument('--reference-cache')
+parser.add_argument('--prune-references', action = 'store_true')
+parser.add_argument('--output-format', choices = list(WRITERS), default = 'csv')
+parser.add_argument('--hasher', choices = list(HASHERS), default = 'sha256')
+parser.add_argument('--connections', type = int, default = 1)
+parser.add_argument('--mirror')
+parser.add_argument('--mirror-gb', type = int, default = 200)
 
 args = parser.parse_args()
+set_hasher(args.hasher)
+set_range_connections(args.connections)
+if args.mirror:
+    set_mirror(FileMirror(args.mirror, max_bytes = args.mirror_gb << 30, connections = args.connections))
 
 url = args.url
 out_dir = args.out_dir
@@ -44,5 +61,12 @@ in_network_file_to_csv(
     url = args.url,
     npi_filter = npi_filter,
     code_filter = code_filter,
-    out_dir = out_dir
+    out_dir = out_dir,
+    workers = args.workers,
+    checkpoint = args.checkpoint,
+    dedup = args.dedup,
+    reference_db = args.reference_db,
+    reference_cache = args.reference_cache,
+    prune_references = args.prune_references,
+    output_format = args.output_format,
 )
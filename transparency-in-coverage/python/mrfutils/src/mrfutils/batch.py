@@ -0,0 +1,317 @@
+"""
+Batch runs
+##########
+
+Runs `in_network_file_to_csv` over many files at once, with a bounded pool of
+worker processes, instead of launching one `screen` session per URL.
+
+Each file gets its own output directory, `{out_dir}/{filename}`, so that no
+two processes ever append to the same CSV. With `merge = True`, the tables of
+each finished file are appended to the tables in `out_dir` by the parent
+process (one file at a time) and the per-file directory is removed. The
+merged files are listed in `{out_dir}/.merged.jsonl`, and a rerun into the
+same `out_dir` skips them instead of appending their rows a second time
+(short of a crash in the middle of merging one).
+
+A file that fails is retried (from scratch) up to `retries` times. If it
+still fails, its output directory is removed.
+
+With `checkpoint = True`, each file saves checkpoints as it goes (see
+checkpoint.py), and a file whose directory holds a checkpoint is resumed
+from it instead of started over, whether it's being retried or the whole
+batch is being run again after dying.
+
+The pool itself is `run_files`, which takes the files in order.
+scheduler.run_catalog runs the same pool, but picks the files by size.
+
+Usage:
+
+>>> urls = gen_urls(index = 'https://.../index.json')
+>>> results = run_batch(urls, 'csv_output', workers = 8, code_filter = codes)
+>>> summarize(results)
+{'done': 118, 'failed': 2, 'rows': {...}}
+"""
+from __future__ import annotations
+
+import contextlib
+import json
+import logging
+import os
+import shutil
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Callable, Generator, Iterable
+
+from mrfutils.flatteners import extract_filename_from_url, in_network_file_to_csv
+from mrfutils import helpers
+from mrfutils.helpers import make_dir, set_hasher, set_mirror, set_range_connections
+from mrfutils.idxutils import gen_in_network_links
+from mrfutils.writers import WRITERS
+
+log = logging.getLogger(__name__)
+
+MERGED_LOG = '.merged.jsonl'
+
+# Set in each worker process by _init_worker
+_worker_options = {}
+
+def _init_worker(options: dict, hasher: str, range_connections: int, mirror) -> None:
+	set_hasher(hasher)
+	set_range_connections(range_connections)
+	set_mirror(mirror)
+	_worker_options.update(options)
+
+
+def _run_file(url: str, file_out_dir: str) -> dict[str, int]:
+	"""
+	Flattens a single file, from scratch unless it can resume from a
+	checkpoint. Runs in a worker process.
+	"""
+	resume = _worker_options.get('checkpoint') and os.path.exists(f'{file_out_dir}/.checkpoint.json')
+	if not resume:
+		shutil.rmtree(file_out_dir, ignore_errors = True)
+	return in_network_file_to_csv(
+		url = url,
+		out_dir = file_out_dir,
+		**_worker_options,
+	)
+
+
+def gen_urls(
+	urls: Iterable[str] = (),
+	url_file: str | None = None,
+	index: str | None = None,
+) -> Generator:
+	"""
+	Yields each in-network URL once, from a list of URLs, a file with one
+	URL per line and/or an index (table of contents) file.
+	"""
+	seen = set()
+
+	def sources():
+		yield from urls
+		if url_file:
+			with open(url_file) as f:
+				yield from (line.strip() for line in f)
+		if index:
+			yield from gen_in_network_links(index)
+
+	for url in sources():
+		if url and url not in seen:
+			seen.add(url)
+			yield url
+
+
+def file_out_dirs(urls: list[str], out_dir: str, taken: Iterable[str] = ()) -> dict[str, str]:
+	"""
+	Gives each URL its own output directory, named after the file.
+	Files that share a name (with each other or with a directory
+	in `taken`) get a numeric suffix.
+	"""
+	out_dirs = {}
+	taken = set(taken)
+	for url in urls:
+		name = extract_filename_from_url(url)
+		candidate = name
+		n = 1
+		while candidate in taken:
+			candidate = f'{name}-{n}'
+			n += 1
+		taken.add(candidate)
+		out_dirs[url] = f'{out_dir}/{candidate}'
+	return out_dirs
+
+
+def keep_failed_references(file_out_dir: str, out_dir: str) -> None:
+	"""Moves a file's failed_references.csv out of its directory before it's removed"""
+	report = f'{file_out_dir}/failed_references.csv'
+	if os.path.exists(report):
+		name = os.path.basename(file_out_dir)
+		shutil.move(report, f'{out_dir}/{name}.failed_references.csv')
+
+
+def read_merged(out_dir: str) -> dict[str, dict[str, int]]:
+	"""The files merged into `out_dir` by earlier runs, with their rows_written"""
+	merged = {}
+	path = f'{out_dir}/{MERGED_LOG}'
+	if os.path.exists(path):
+		with open(path) as f:
+			for line in f:
+				try:
+					record = json.loads(line)
+				except ValueError:
+					# Cut off by a crash, so that file wasn't done
+					continue
+				merged[record['url']] = record['rows']
+	return merged
+
+
+def _record_merged(out_dir: str, url: str, rows: dict[str, int]) -> None:
+	with open(f'{out_dir}/{MERGED_LOG}', 'a') as f:
+		f.write(json.dumps(dict(url = url, rows = rows)) + '\n')
+		f.flush()
+		os.fsync(f.fileno())
+
+
+def _first(pending: list[dict], running: list[dict]) -> dict | None:
+	return pending[0]
+
+
+def run_files(
+	results: list[dict],
+	out_dir: str,
+	workers: int = 4,
+	retries: int = 2,
+	merge: bool = False,
+	pick: Callable[[list[dict], list[dict]], dict | None] = _first,
+	on_change: Callable[[dict], None] | None = None,
+	**options,
+) -> list[dict]:
+	"""
+	The worker pool behind run_batch and scheduler.run_catalog. Runs the
+	files of the status rows in `results` (see run_batch), filling in
+	their status, attempts, seconds, rows and error as it goes.
+
+	Whenever a worker is free, `pick(pending, running)` chooses the row
+	to start next out of `pending`, or returns None to wait until one
+	that's running finishes. By default that's the first (retries go to
+	the back). `on_change` gets a row every time its status changes.
+
+	With `merge`, the files an earlier run already merged into `out_dir`
+	are skipped (and come back as done).
+	"""
+	make_dir(out_dir)
+	pending = list(results)
+	running = {}
+
+	def changed(result):
+		if on_change is not None:
+			on_change(result)
+
+	# Only a merging run needs a writer of its own
+	writer = None
+	if merge:
+		merged = read_merged(out_dir)
+		for result in results:
+			if result['url'] in merged:
+				# Left behind if the run died between merging and removing it
+				shutil.rmtree(result['out_dir'], ignore_errors = True)
+				result.update(status = 'done', rows = merged[result['url']], out_dir = out_dir, error = None)
+				pending.remove(result)
+				changed(result)
+		if merged:
+			log.info(f'Skipping {len(results) - len(pending)} files merged by an earlier run')
+
+		writer_class = WRITERS[options.get('output_format', 'csv')]
+		writer = writer_class(out_dir, **(options.get('output_options') or {}))
+
+	pool = ProcessPoolExecutor(
+		max_workers = workers,
+		initializer = _init_worker,
+		initargs = (options, helpers.hasher, helpers.range_connections, helpers.mirror),
+	)
+
+	def fill():
+		while pending and len(running) < workers:
+			result = pick(pending, [result for result, _ in running.values()])
+			if result is None:
+				return
+			pending.remove(result)
+			result['status'] = 'running'
+			result['attempts'] += 1
+			changed(result)
+			future = pool.submit(_run_file, result['url'], result['out_dir'])
+			running[future] = (result, time.time())
+
+	with pool, writer or contextlib.nullcontext():
+		n_finished = len(results) - len(pending)
+		fill()
+		while running:
+			finished, _ = wait(running, return_when = FIRST_COMPLETED)
+			for future in finished:
+				result, start = running.pop(future)
+				url = result['url']
+				result['seconds'] += time.time() - start
+
+				try:
+					rows = future.result()
+				except Exception as e:
+					result['error'] = repr(e)
+					if result['attempts'] <= retries:
+						log.warning(f'Retrying {url} after error: {e!r}')
+						result['status'] = 'pending'
+						changed(result)
+						pending.append(result)
+						continue
+
+					# Don't leave half-written tables around
+					result['status'] = 'failed'
+					shutil.rmtree(result['out_dir'], ignore_errors = True)
+					log.error(f'Failed {url} after {result["attempts"]} attempts: {e!r}')
+				else:
+					result['status'] = 'done'
+					result['rows'] = rows
+					result['error'] = None
+
+					if merge:
+						writer.merge(result['out_dir'], rows)
+						writer.flush()
+						keep_failed_references(result['out_dir'], out_dir)
+						_record_merged(out_dir, url, rows)
+						shutil.rmtree(result['out_dir'])
+						result['out_dir'] = out_dir
+
+				changed(result)
+				n_finished += 1
+				log.info(f'[{n_finished}/{len(results)}] {result["status"]}: {url}')
+
+			fill()
+
+	return results
+
+
+def run_batch(
+	urls: Iterable[str],
+	out_dir: str,
+	workers: int = 4,
+	retries: int = 2,
+	merge: bool = False,
+	checkpoint: bool = False,
+	**options,
+) -> list[dict]:
+	"""
+	Flattens every file in `urls` with `workers` processes. `options` are
+	passed on to in_network_file_to_csv (code_filter, npi_filter, ...),
+	and so is `checkpoint`.
+
+	Returns one status row per file:
+	{'url', 'out_dir', 'status', 'attempts', 'seconds', 'rows', 'error'}
+	where status is 'done' or 'failed'.
+	"""
+	urls = list(urls)
+	options['checkpoint'] = checkpoint
+	out_dirs = file_out_dirs(urls, out_dir)
+
+	results = [
+		dict(
+			url = url,
+			out_dir = out_dirs[url],
+			status = 'pending',
+			attempts = 0,
+			seconds = 0.,
+			rows = None,
+			error = None,
+		)
+		for url in urls
+	]
+	return run_files(results, out_dir, workers, retries, merge, **options)
+
+
+def summarize(results: list[dict]) -> dict:
+	"""Counts files by status and adds up the rows written per table"""
+	summary = {'done': 0, 'failed': 0, 'rows': {}}
+	for result in results:
+		summary[result['status']] += 1
+		for table_name, rows in (result['rows'] or {}).items():
+			summary['rows'][table_name] = summary['rows'].get(table_name, 0) + rows
+	return summary
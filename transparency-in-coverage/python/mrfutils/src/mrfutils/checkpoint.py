@@ -0,0 +1,172 @@
+"""
+Checkpoints
+###########
+
+Lets a run of `in_network_file_to_csv` that died halfway pick up where it
+left off, instead of starting from byte zero and appending duplicate rows.
+
+Every so often (between two in-network items) we flush the CSVs and write
+down:
+
+* the offset in the (decompressed) file just past the last item we read
+* how many in-network items we've read
+* the size of each CSV
+* the top-level metadata we've seen so far
+
+to `{out_dir}/.checkpoint.json`, next to a pickle of the reference map.
+
+A rerun with a checkpoint for the same file truncates the CSVs back to the
+recorded sizes and reopens the file at the recorded offset (see
+helpers.JSONOpen). Since everything before the offset has been written
+exactly once, the output ends up the same as that of an uninterrupted run.
+The checkpoint is removed once the file is done.
+
+Usage:
+
+>>> checkpoint = Checkpoint(out_dir, file_id)
+>>> state = checkpoint.start()
+>>> if state: resume from state['offset']
+>>> ...
+>>> if checkpoint.due():
+>>> 	checkpoint.save(writer, offset, items, metadata, reference_map)
+>>> ...
+>>> checkpoint.clear()
+"""
+from __future__ import annotations
+
+import json
+import logging
+import os
+import pickle
+import time
+
+from mrfutils.references import ReferenceStore
+from mrfutils.schema.schema import SCHEMA
+from mrfutils.writers import CSVWriter
+
+log = logging.getLogger(__name__)
+
+
+def _dump_atomic(data: bytes, file_loc: str) -> None:
+	tmp_loc = f'{file_loc}.tmp'
+	with open(tmp_loc, 'wb') as f:
+		f.write(data)
+	os.replace(tmp_loc, file_loc)
+
+
+class Checkpoint:
+	"""
+	Checkpoint for flattening the file `file_id` into `out_dir`, saved at
+	most once every `interval` seconds.
+	"""
+
+	def __init__(self, out_dir: str, file_id: int, interval: float = 60.):
+		self.out_dir = out_dir
+		self.file_id = file_id
+		self.interval = interval
+		self.state_loc = f'{out_dir}/.checkpoint.json'
+		self.refs_loc = f'{out_dir}/.checkpoint.refs.pickle'
+		self.metadata = {}
+		self.last_saved = time.time()
+		self.refs_saved = False
+
+	def table_sizes(self) -> dict[str, int]:
+		sizes = {}
+		for table_name in SCHEMA:
+			file_loc = f'{self.out_dir}/{table_name}.csv'
+			if os.path.exists(file_loc):
+				sizes[table_name] = os.path.getsize(file_loc)
+		return sizes
+
+	def load(self) -> dict | None:
+		if not os.path.exists(self.state_loc):
+			return
+
+		with open(self.state_loc) as f:
+			state = json.load(f)
+
+		if state['file_id'] != self.file_id:
+			log.warning(f'Ignoring checkpoint for a different file: {self.state_loc}')
+			return
+
+		return state
+
+	def truncate(self, sizes: dict[str, int]) -> None:
+		"""Rolls the tables back to `sizes`, removing the ones that didn't exist"""
+		for table_name in SCHEMA:
+			file_loc = f'{self.out_dir}/{table_name}.csv'
+			if table_name in sizes:
+				with open(file_loc, 'r+b') as f:
+					f.truncate(sizes[table_name])
+			elif os.path.exists(file_loc):
+				os.remove(file_loc)
+
+	def start(self) -> dict | None:
+		"""
+		If an earlier run of the same file left a checkpoint, rolls the
+		tables back to it and returns it. Otherwise, records the current
+		size of the tables, so that a rerun can roll back to them if this
+		run dies before its first checkpoint.
+
+		A checkpoint's `offset` is None if no items had been written yet.
+		"""
+		state = self.load()
+
+		if state is None:
+			state = dict(
+				file_id = self.file_id,
+				offset = None,
+				items = 0,
+				sizes = self.table_sizes(),
+				metadata = {},
+			)
+			_dump_atomic(json.dumps(state).encode(), self.state_loc)
+			return
+
+		self.truncate(state['sizes'])
+		self.metadata = state['metadata']
+		self.refs_saved = state['offset'] is not None
+		log.info(f'Resuming from checkpoint: {state["items"]} items, offset {state["offset"]}')
+		return state
+
+	def reference_map(self) -> ReferenceStore:
+		with open(self.refs_loc, 'rb') as f:
+			return pickle.load(f)
+
+	def due(self) -> bool:
+		return time.time() - self.last_saved >= self.interval
+
+	def save(
+		self,
+		writer: CSVWriter,
+		offset: int,
+		items: int,
+		metadata: dict | None,
+		reference_map: ReferenceStore,
+	) -> None:
+		"""
+		Saves a checkpoint. Everything up to `offset` (the first `items`
+		in-network items) must have been handed to `writer` already.
+		"""
+		writer.flush()
+
+		# The reference map doesn't change once we're in the items
+		if not self.refs_saved:
+			_dump_atomic(pickle.dumps(reference_map, pickle.HIGHEST_PROTOCOL), self.refs_loc)
+			self.refs_saved = True
+
+		state = dict(
+			file_id = self.file_id,
+			offset = offset,
+			items = items,
+			sizes = self.table_sizes(),
+			metadata = {**self.metadata, **(metadata or {})},
+		)
+		_dump_atomic(json.dumps(state).encode(), self.state_loc)
+		self.last_saved = time.time()
+		log.debug(f'Saved checkpoint: {items} items, offset {offset}')
+
+	def clear(self) -> None:
+		for file_loc in (self.state_loc, self.refs_loc):
+			if os.path.exists(file_loc):
+				os.remove(file_loc)
@@ -0,0 +1,233 @@
+"""
+Remote reference fetcher
+########################
+
+Downloads the provider references that live at a remote `location`.
+
+`make_reference_map` used to start 200 tasks that each did a bare
+`session.get`, with no timeout, and dropped any reference whose response
+wasn't a 200. A single 503 from an overloaded server would quietly lose the
+provider groups of every rate that pointed to it.
+
+`ReferenceFetcher` instead:
+
+* limits the connections, in total (`workers`) and per host
+  (`limit_per_host`), and gives up on a connection that doesn't make
+  progress for `timeout` seconds
+* retries timeouts, connection errors and 408/429/5xx responses up to
+  `retries` times, with exponential backoff (and some jitter), or after
+  as many seconds as the server asked for in a Retry-After header (up to
+  `max_retry_after`)
+* parses the groups out of the response as it streams in, so a large
+  reference file never has to be held in memory as a whole
+* goes through a ReferenceCache, if it has one (see refcache.py)
+* remembers the references that still failed, logs them, and writes them
+  to the `report` CSV (url, provider_group_id, error)
+
+The work queue holds at most `queue_size` references. The producer awaits
+`queue.put`, so reading the file waits for the downloads to catch up instead
+of queueing up every URL in the file.
+
+Usage:
+
+>>> fetcher = ReferenceFetcher(limit_per_host = 10, report = 'failed.csv')
+>>> reference_map = await make_reference_map(references, npi_filter, fetcher = fetcher)
+>>> fetcher.failed
+[('https://.../ref_1.json', 1, 'FetchError(404)')]
+"""
+from __future__ import annotations
+
+import asyncio
+import csv
+import email.utils
+import logging
+import os
+import random
+import time
+from typing import Callable
+
+import aiohttp
+import ijson
+
+from mrfutils.refcache import ReferenceCache
+
+log = logging.getLogger(__name__)
+
+RETRY_STATUSES = {408, 429, 500, 502, 503, 504}
+
+
+class FetchError(Exception):
+	"""Response with a status that isn't 200 (or a 304 for a cached reference)"""
+
+	def __init__(self, status: int, retry_after: float | None = None):
+		super().__init__(status)
+		self.status = status
+		self.retry_after = retry_after
+
+	@property
+	def retry(self) -> bool:
+		return self.status in RETRY_STATUSES
+
+
+def parse_retry_after(value: str | None) -> float | None:
+	"""Seconds to wait from a Retry-After header (delay-seconds or HTTP-date)"""
+	if not value:
+		return None
+	try:
+		return max(float(value), 0.)
+	except ValueError:
+		pass
+	try:
+		when = email.utils.parsedate_to_datetime(value)
+	except (TypeError, ValueError):
+		return None
+	return max(when.timestamp() - time.time(), 0.)
+
+
+class ReferenceFetcher:
+	"""
+	Fetches remote provider references. See the module docstring for
+	what the options do.
+	"""
+
+	def __init__(
+		self,
+		workers: int = 100,
+		limit_per_host: int = 20,
+		timeout: float = 60.,
+		retries: int = 4,
+		backoff: float = 1.,
+		queue_size: int = 1_000,
+		cache: ReferenceCache | None = None,
+		report: str | None = None,
+		max_retry_after: float = 300.,
+	):
+		self.workers = workers
+		self.limit_per_host = limit_per_host
+		self.timeout = timeout
+		self.retries = retries
+		self.backoff = backoff
+		self.queue_size = queue_size
+		self.cache = cache
+		self.report = report
+		self.max_retry_after = max_retry_after
+		self.failed: list[tuple[str, int, str]] = []
+
+	def session(self) -> aiohttp.ClientSession:
+		return aiohttp.ClientSession(
+			connector = aiohttp.TCPConnector(
+				limit = self.workers,
+				limit_per_host = self.limit_per_host,
+			),
+			# No total timeout: big files just take a while
+			timeout = aiohttp.ClientTimeout(
+				total = None,
+				sock_connect = self.timeout,
+				sock_read = self.timeout,
+			),
+		)
+
+	async def _get_groups(
+		self,
+		session: aiohttp.ClientSession,
+		url: str,
+		process: Callable,
+	) -> list[dict]:
+		"""A single attempt at getting the processed groups at `url`"""
+		cache = self.cache
+		entry = None
+		headers = {}
+		if cache is not None:
+			entry = cache.lookup(url)
+			if entry is not None and cache.is_fresh(entry):
+				return cache.hit(url, entry)
+			headers = cache.conditional_headers(entry)
+
+		async with session.get(url, headers = headers) as response:
+			if response.status == 304 and entry is not None:
+				log.debug(f'Remote provider reference not modified: {url}')
+				return cache.hit(url, entry, revalidated = True)
+
+			if response.status != 200:
+				raise FetchError(response.status, parse_retry_after(response.headers.get('Retry-After')))
+
+			log.debug(f'Opened remote provider reference: {url}')
+			groups = []
+			async for group in ijson.items_async(response.content, 'provider_groups.item', use_float = True):
+				if group := process(group):
+					groups.append(group)
+
+			if cache is not None:
+				cache.store(url, groups, response.headers)
+			return groups
+
+	async def fetch(
+		self,
+		session: aiohttp.ClientSession,
+		url: str,
+		process: Callable,
+	) -> list[dict]:
+		"""
+		Returns the groups at `url`, each passed through `process` (which
+		returns None to drop a group). Retries what can be retried.
+		"""
+		for attempt in range(self.retries + 1):
+			delay = self.backoff * 2 ** attempt * random.uniform(.5, 1.5)
+			try:
+				return await self._get_groups(session, url, process)
+			except FetchError as e:
+				if not e.retry or attempt == self.retries:
+					raise
+				if e.retry_after is not None:
+					delay = min(e.retry_after, self.max_retry_after)
+				error = e
+			except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+				if attempt == self.retries:
+					raise
+				error = e
+
+			log.debug(f'Retrying {url} in {delay:.1f}s after {error!r}')
+			await asyncio.sleep(delay)
+
+	async def worker(
+		self,
+		session: aiohttp.ClientSession,
+		queue: asyncio.Queue,
+		reference_map,
+		process: Callable,
+	) -> None:
+		"""Adds the references in `queue` to `reference_map` until cancelled"""
+		while True:
+			url, group_id = await queue.get()
+			try:
+				groups = await self.fetch(session, url, process)
+				if groups:
+					reference_map.add(group_id, groups)
+			except Exception as e:
+				log.warning(f'Failed to fetch provider reference {group_id}: {url}: {e!r}')
+				self.failed.append((url, group_id, repr(e)))
+			finally:
+				queue.task_done()
+
+	def finish(self) -> None:
+		"""Logs the cache stats and reports the references that failed"""
+		if self.cache is not None:
+			log.info(f'Remote reference cache: {self.cache.stats}')
+
+		if self.failed:
+			log.warning(f'{len(self.failed)} remote provider references failed')
+
+		if self.report is None:
+			return
+
+		if not self.failed:
+			# Don't leave the report of an earlier run around
+			if os.path.exists(self.report):
+				os.remove(self.report)
+			return
+
+		with open(self.report, 'w', newline = '') as f:
+			writer = csv.writer(f)
+			writer.writerow(['url', 'provider_group_id', 'error'])
+			writer.writerows(self.failed)
+		log.warning(f'Wrote the failed references to {self.report}')
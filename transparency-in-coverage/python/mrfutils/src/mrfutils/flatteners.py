@@ -36,23 +36,38 @@ NOTES: There's more than one way to go about this.
 as they are and write them later. But this way if you have a custom code -- NPI
 mapping you can optionally delete NPI numbers contingent on which billing code
 you're looking at.
-* Possible room for optimization: basic_parse instead of parse. You'd probably
-need to write a +1/-1 tracker every time you hit a start_map/end_map event, so
-that you can track your depth in the JSON tree.
+* basic_parse instead of parse: `parse_shallow` does this with a +1/-1
+tracker on every start_map/end_map event, so that it knows the depth in the
+JSON tree and only builds the prefixes that we actually compare against. Pick
+it with `engine = 'basic'`. The output is the same as with `engine = 'parse'`.
 
 Anything tagged #HOTFIX is a quick fix for a broken implementation of an MRF
 """
 from __future__ import annotations
 
 import asyncio
+import collections
+import functools
+import io
 import itertools
-from typing import Generator
+import json
+import multiprocessing
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Generator
 
-import aiohttp
 import ijson
 
+from mrfutils import helpers
+from mrfutils.checkpoint import Checkpoint
+from mrfutils.fetcher import ReferenceFetcher
+from mrfutils.npifilter import NPIFilter
+from mrfutils.refcache import ReferenceCache
+from mrfutils.references import DiskReferenceStore, ReferenceStore, code_filter_key
 from mrfutils.helpers import *
+from mrfutils.scanner import ScanningParser, open_in_array
 from mrfutils.schema.schema import SCHEMA
+from mrfutils.writers import CSVWriter, SeenKeys, WRITERS
 
 # You can remove this if necessary, but be warned
 # Right now this only works with python 3.9/3.10
@@ -73,31 +88,6 @@ Row = dict
 def extract_filename_from_url(url: str) -> str:
 	return Path(url).stem.split('.')[0]
 
-def write_table(
-	row_data: list[Row] | Row,
-	table_name: str,
-	out_dir: str,
-) -> None:
-
-	fieldnames = SCHEMA[table_name]
-	file_loc = f'{out_dir}/{table_name}.csv'
-	file_exists = os.path.exists(file_loc)
-
-	# newline = '' is to prevent Windows
-	# from adding \r\n\n to the end of each line
-	with open(file_loc, 'a', newline = '') as f:
-		writer = csv.DictWriter(f, fieldnames=fieldnames)
-
-		if not file_exists:
-			writer.writeheader()
-
-		if isinstance(row_data, list):
-			writer.writerows(row_data)
-
-		elif isinstance(row_data, dict):
-			writer.writerow(row_data)
-
-
 def file_row_from_url(
 	url: str
 ) -> Row:
@@ -249,36 +239,36 @@ def tin_rows_and_npi_tin_rows_from_dict(
 def write_in_network_item(
 	file_id: str,
 	in_network_item: dict,
-	out_dir
+	writer: CSVWriter,
 ) -> None:
 
 	code_row = code_row_from_dict(in_network_item)
-	write_table(code_row, 'code', out_dir)
+	writer.write(code_row, 'code')
 
 	for rate in in_network_item['negotiated_rates']:
 
 		rate_metadata_combined_rows = rate_metadata_combined_rows_from_dict(rate)
 		rate_metadata_rows = [a[0] for a in rate_metadata_combined_rows]
-		write_table(rate_metadata_rows, 'rate_metadata', out_dir)
+		writer.write(rate_metadata_rows, 'rate_metadata')
 
 		rate_rows = rate_rows_from_mixed(
 			code_row = code_row,
 			rate_metadata_combined_rows = rate_metadata_combined_rows,
 		)
-		write_table(rate_rows, 'rate', out_dir)
+		writer.write(rate_rows, 'rate')
 
 		groups = rate['provider_groups']
 
 		tin_rows, npi_tin_rows = tin_rows_and_npi_tin_rows_from_dict(groups)
-		write_table(tin_rows, 'tin', out_dir)
-		write_table(npi_tin_rows, 'npi_tin', out_dir)
+		writer.write(tin_rows, 'tin')
+		writer.write(npi_tin_rows, 'npi_tin')
 
 		tin_rate_file_rows = tin_rate_file_rows_from_mixed(
 			rate_rows = rate_rows,
 			tin_rows = tin_rows,
 			file_id = file_id
 		)
-		write_table(tin_rate_file_rows, 'tin_rate_file', out_dir)
+		writer.write(tin_rate_file_rows, 'tin_rate_file')
 
 	code_type = in_network_item['billing_code_type']
 	code = in_network_item['billing_code']
@@ -295,24 +285,31 @@ def process_arr(func, arr, *args, **kwargs):
 # experimental mod
 from array import array
 def process_group(group: dict, npi_filter: set) -> dict | None:
-	try:
-		group['npi'] = [int(n) for n in group['npi']]
-	except KeyError:
-		# I was alerted that sometimes this key is capitalized
-		# HOTFIX
-		group['npi'] = [int(n) for n in group['NPI']]
+	if isinstance(group.get('npi'), array):
+		# Already processed (from the ReferenceStore)
+		pass
+	else:
+		try:
+			group['npi'] = [int(n) for n in group['npi']]
+		except KeyError:
+			# I was alerted that sometimes this key is capitalized
+			# HOTFIX
+			group['npi'] = [int(n) for n in group['NPI']]
 
-	group['npi'] = array('L', group['npi'])
+		group['npi'] = array('L', group['npi'])
 
 	if not npi_filter:
 		return group
 
-	group['npi'] = [n for n in group['npi'] if n in npi_filter]
+	if isinstance(npi_filter, NPIFilter):
+		npis = npi_filter.filter(group['npi'])
+	else:
+		npis = array('L', [n for n in group['npi'] if n in npi_filter])
 
-	if not group['npi']:
+	if not npis:
 		return
 
-	group['npi'] = array('L', group['npi'])
+	group['npi'] = npis
 
 	return group
 
@@ -397,6 +394,41 @@ def ffwd(
 		raise NotImplementedError
 
 
+# The only item-level values that skip_item_by_code looks at
+SKIP_PREFIXES = {
+	'in_network.item.billing_code',
+	'in_network.item.billing_code_type',
+	'in_network.item.negotiation_arrangement',
+}
+
+def skip_value(parser: Generator, prefix: str) -> None:
+	"""
+	Skips the value of the top-level key `prefix`, right after its
+	map_key event. A ScanningParser doesn't even parse it.
+	"""
+	if isinstance(parser, ScanningParser):
+		parser.skip_value()
+		return
+
+	event = next(parser)[1]
+	if event == 'start_array':
+		ffwd(parser, to_prefix = prefix, to_event = 'end_array')
+	elif event == 'start_map':
+		ffwd(parser, to_prefix = prefix, to_event = 'end_map')
+
+
+def ffwd_item(parser: Generator, prefix: str = 'in_network.item') -> None:
+	"""
+	Fast-forwards past the end of the current in-network item (or the
+	current item of another top-level array, with `prefix`). A
+	ScanningParser can drop the item without parsing the rest of it.
+	"""
+	if isinstance(parser, ScanningParser):
+		parser.skip_item()
+	else:
+		ffwd(parser, to_prefix=prefix, to_event='end_map')
+
+
 def gen_in_network_items(
 	parser: Generator,
 	code_filter: set,
@@ -411,8 +443,10 @@ def gen_in_network_items(
 
 		builder.event(event, value)
 
-		# This line can be commented out! but it's faster with it in
-		if hasattr(builder, 'value') and len(builder.value) > 0:
+		# This line can be commented out! but it's faster with it in.
+		# The filter can only change its mind when one of the values it
+		# checks comes in, so there's no need to run it on every event
+		if prefix in SKIP_PREFIXES:
 			skip_item_by_code(parser, builder, code_filter)
 
 		if (prefix, event) == ('in_network.item', 'end_map'):
@@ -423,12 +457,26 @@ def gen_in_network_items(
 			return
 
 
-def gen_references(parser: Generator) -> Generator:
+def gen_references(parser: Generator, needed: set | None = None) -> Generator:
+	"""
+	Yields the provider references. With `needed`, only the ones whose
+	provider_group_id is in it. The others are skipped as soon as their
+	ID comes up, so their groups never get built.
+	"""
 	builder = ijson.ObjectBuilder()
 	for prefix, event, value in parser:
 		builder.event(event, value)
 
-		if (prefix, event) == ('provider_references.item', 'end_map'):
+		if (
+			needed is not None
+			and prefix == 'provider_references.item.provider_group_id'
+			and value not in needed
+		):
+			ffwd_item(parser, 'provider_references.item')
+			builder.value.pop()
+			builder.containers.pop()
+
+		elif (prefix, event) == ('provider_references.item', 'end_map'):
 			reference = builder.value.pop()
 			yield reference
 
@@ -453,7 +501,7 @@ def skip_item_by_code(
 	if code and code_type and code_filter:
 		if (code_type, str(code)) not in code_filter:
 			log.debug(f'Skipping {code_type} {code}: filtered out')
-			ffwd(parser, to_prefix='in_network.item', to_event='end_map')
+			ffwd_item(parser)
 			builder.value.pop()
 			builder.containers.pop()
 			return
@@ -461,58 +509,17 @@ def skip_item_by_code(
 	arrangement = item.get('negotiation_arrangement')
 	if arrangement and arrangement != 'ffs':
 		log.debug(f"Skipping item: arrangement: {arrangement} not 'ffs'")
-		ffwd(parser, to_prefix='in_network.item', to_event='end_map')
+		ffwd_item(parser)
 		builder.value.pop()
 		builder.containers.pop()
 		return
 
 
-async def fetch_remote_reference(
-	session: aiohttp.client.ClientSession,
-	url: str,
-):
-	response = await session.get(url)
-	assert response.status == 200
-
-	log.debug(f'Opened remote provider reference: {url}')
-
-	data = await response.read()
-	reference = json.loads(data)
-	return reference
-
-
-# TODO I hate this function name
-# and think this needs to be broken down into
-# smaller funcs
-async def append_processed_remote_reference(
-	queue: asyncio.Queue,
-	processed_references: list[dict],
-	npi_filter: set,
-):
-	while True:
-		try:
-			# Get a "work item" out of the queue.
-			session, url, group_id = await queue.get()
-
-			reference = await fetch_remote_reference(session, url)
-			reference['provider_group_id'] = group_id
-			reference = process_reference(reference, npi_filter)
-
-			if reference:
-				processed_references.append(reference)
-
-		except AssertionError:
-			# Response status was 404 or something
-			log.debug('Encountered bad response status')
-		finally:
-			# Notify the queue that the "work item" has been processed.
-			queue.task_done()
-
-
-# TODO simplify
 async def make_reference_map(
 	references: Generator,
-	npi_filter: set
+	npi_filter: set,
+	reference_map: ReferenceStore | DiskReferenceStore | None = None,
+	fetcher: ReferenceFetcher | None = None,
 ):
 	"""
 	Processes all provider references and return a map like:
@@ -521,54 +528,58 @@ async def make_reference_map(
 		2: [group1, group2, ...],
 	}
 	where each provider group has been filtered to only contain
-	the NPIs contained in `npi_filter`.
+	the NPIs contained in `npi_filter`. The map is a ReferenceStore,
+	which keeps the groups in compact form, unless you pass in a store
+	to fill (e.g. a DiskReferenceStore).
+
+	Remote references are downloaded by `fetcher` (see fetcher.py).
 	"""
-	# Create a queue that we will use to store our "workload".
-	queue: asyncio.Queue = asyncio.Queue()
+	if reference_map is None:
+		reference_map = ReferenceStore()
+	if fetcher is None:
+		fetcher = ReferenceFetcher()
 
-	# Tasks hold the consumers. reference is appended to
-	# by consumers and by the main loop of this function
-	tasks = []
-	processed_references: list[dict] = []
+	def process(group):
+		return process_group(group, npi_filter)
 
-	for i in range(200):
-		coro = append_processed_remote_reference(queue, processed_references, npi_filter)
-		task = asyncio.create_task(coro)
-		tasks.append(task)
+	# The queue is bounded, so we only read references from the file
+	# as fast as the workers can download the remote ones.
+	queue: asyncio.Queue = asyncio.Queue(fetcher.queue_size)
+
+	async with fetcher.session() as session:
+		# The workers add the remote references to reference_map,
+		# the main loop of this function the rest
+		tasks = [
+			asyncio.create_task(fetcher.worker(session, queue, reference_map, process))
+			for _ in range(fetcher.workers)
+		]
 
-	async with aiohttp.client.ClientSession() as session:
 		for reference in references:
 			if url := reference.get('location'):
-				group_id = reference['provider_group_id']
-				queue.put_nowait((session, url, group_id))
+				await queue.put((url, reference['provider_group_id']))
 				continue
 
 			reference = process_reference(reference, npi_filter)
 			if reference:
-				processed_references.append(reference)
+				reference_map.add(reference['provider_group_id'], reference['provider_groups'])
 
 		# Block until all items in the queue have been received and processed
 		await queue.join()
 
+		# Cancel our worker tasks, and wait until they're cancelled
+		for task in tasks:
+			task.cancel()
+		await asyncio.gather(*tasks, return_exceptions = True)
+
 	# To understand why this sleep is here, see:
 	# https://docs.aiohttp.org/en/stable/client_advanced.html#graceful-shutdown
 	await asyncio.sleep(.250)
 
-	# Cancel our worker tasks
-	for task in tasks:
-		task.cancel()
-
-	# Wait until all worker tasks are cancelled.
-	await asyncio.gather(*tasks, return_exceptions=True)
-
-	reference_map = {
-		reference['provider_group_id']: reference['provider_groups']
-		for reference in processed_references
-	}
+	fetcher.finish()
 	return reference_map
 
 
-async def _get_reference_map(parser, npi_filter) -> dict:
+async def _get_reference_map(parser, npi_filter, reference_map = None, fetcher = None, needed = None) -> ReferenceStore:
 	"""Possible file structures.
 	1. {    ...
 		'provider_references': <-- here (most common)
@@ -589,32 +600,68 @@ async def _get_reference_map(parser, npi_filter) -> dict:
 	# Case (1)
 	next_, parser = peek(parser)
 	if next_ == ('provider_references', 'start_array', None):
-		references = gen_references(parser)
-		return await make_reference_map(references, npi_filter)
+		references = gen_references(parser, needed)
+		return await make_reference_map(references, npi_filter, reference_map, fetcher)
 	try:
 		# Case (2)
 		ffwd(parser, to_prefix='', to_value='provider_references')
 	except StopIteration:
 		# StopIteration -> they don't exist (3)
-		return {}
+		return ReferenceStore()
 	else:
 		# Collect them (ends on ('', 'end_map', None))
-		references = gen_references(parser)
-		return await make_reference_map(references, npi_filter)
+		references = gen_references(parser, needed)
+		return await make_reference_map(references, npi_filter, reference_map, fetcher)
+
 
+def get_reference_map(parser, npi_filter, reference_map = None, fetcher = None, needed = None):
+	"""
+	Wrapper to turn _get_reference_map into a sync function.
 
-def get_reference_map(parser, npi_filter):
-	"""Wrapper to turn _get_reference_map into a sync function"""
-	return asyncio.run(_get_reference_map(parser, npi_filter))
+	`reference_map` is an (empty) store to fill instead of a new
+	ReferenceStore. A DiskReferenceStore that is already complete is
+	used as is, and the references in the file are skipped.
+
+	`fetcher` is the ReferenceFetcher for the remote references.
+
+	With `needed`, only the references whose provider_group_id is in it
+	are kept (see collect_reference_ids).
+	"""
+	if isinstance(reference_map, DiskReferenceStore):
+		if reference_map.complete:
+			log.info('Reusing the stored reference map')
+			skip_value(parser, 'provider_references')
+			return reference_map
+
+		reference_map.clear()
+		reference_map = asyncio.run(_get_reference_map(parser, npi_filter, reference_map, fetcher, needed))
+		reference_map.finish()
+		return reference_map
+
+	return asyncio.run(_get_reference_map(parser, npi_filter, reference_map, fetcher, needed))
+
+
+def collect_reference_ids(parser: Generator, code_filter: set | None) -> set:
+	"""
+	Reads through the in-network items (right after the in_network key)
+	and returns the provider_group_ids that the items which pass
+	`code_filter` refer to. Only those items get built.
+	"""
+	needed = set()
+	for item in gen_in_network_items(parser, code_filter):
+		for rate in item['negotiated_rates']:
+			needed.update(rate.get('provider_references') or ())
+	return needed
 
 
 def swap_references(
 	in_network_items: Generator,
-	reference_map: dict,
+	reference_map: ReferenceStore,
 ) -> Generator:
 	"""Takes the provider reference ID in the rate
 	and replaces it with the corresponding provider
-	groups from reference_map"""
+	groups from reference_map. The groups aren't copied
+	until the rate gets processed (see ResolvedGroups)"""
 
 	if reference_map is None:
 		yield from in_network_items
@@ -626,12 +673,9 @@ def swap_references(
 			references = rate.get('provider_references')
 			if not references:
 				continue
-			groups = rate.get('provider_groups', [])
-			for reference in references:
-				addl_groups = reference_map.get(reference, [])
-				groups.extend(addl_groups)
+			groups = rate.get('provider_groups')
 			rate.pop('provider_references')
-			rate['provider_groups'] = groups
+			rate['provider_groups'] = reference_map.resolve(groups, references)
 
 		item['negotiated_rates'] = [rate for rate in rates if rate.get('provider_groups')]
 
@@ -639,9 +683,213 @@ def swap_references(
 			yield item
 
 
-def start_parser(filename) -> Generator:
-	with JSONOpen(filename) as f:
-		yield from ijson.parse(f, use_float = True)
+def parse_shallow(f, max_depth: int = 3, **kwargs) -> Generator:
+	"""
+	Drop-in replacement for ijson.parse, built on ijson.basic_parse.
+
+	ijson.parse joins the full dotted path (in_network.item.negotiated_rates
+	.item.provider_groups.item.npi.item...) for every event, but the
+	flattener only compares prefixes near the top of the tree. This keeps
+	track of the depth with a +1/-1 counter and only builds the prefix
+	for events at most `max_depth` levels deep. Deeper events get None as
+	their prefix.
+	"""
+	path = []
+	for event, value in ijson.basic_parse(f, **kwargs):
+		if event == 'map_key':
+			depth = len(path) - 1
+			path[-1] = value
+		elif event == 'start_map':
+			depth = len(path)
+			path.append(None)
+		elif event == 'start_array':
+			depth = len(path)
+			path.append('item')
+		elif event == 'end_map' or event == 'end_array':
+			path.pop()
+			depth = len(path)
+		else:
+			depth = len(path)
+
+		if depth > max_depth:
+			yield None, event, value
+		else:
+			yield '.'.join(path[:depth]), event, value
+
+
+PARSE_ENGINES = {
+	'parse': ijson.parse,
+	'basic': parse_shallow,
+}
+
+
+def _gen_events(filename, parse, read_ahead) -> Generator:
+	with open_json(filename, read_ahead) as f:
+		yield from parse(f, use_float = True)
+
+
+def start_parser(
+	filename,
+	engine: str = 'parse',
+	fast_skip: bool = False,
+	read_ahead: bool = False,
+) -> Generator:
+	"""
+	Starts a parser with one of the PARSE_ENGINES. With fast_skip, the
+	top-level arrays are split into items at the byte level, so that
+	filtered-out items are skipped without being parsed. With read_ahead,
+	the file is decompressed in a background thread.
+
+	`filename` can also be a file-like object.
+	"""
+	parse = PARSE_ENGINES[engine]
+	if fast_skip:
+		return ScanningParser(filename, parse, read_ahead, use_float = True)
+	return _gen_events(filename, parse, read_ahead)
+
+
+### PARALLEL FLATTENING
+
+# Set in each worker process by _init_worker
+_worker_state = {}
+
+def _init_worker(
+	reference_map: ReferenceStore,
+	code_filter: set | None,
+	npi_filter: set | None,
+	engine: str,
+	hasher: str,
+	dedup: bool | int,
+	writer_class: type = CSVWriter,
+) -> None:
+	set_hasher(hasher)
+	_worker_state.update(
+		reference_map = reference_map,
+		code_filter = code_filter,
+		npi_filter = npi_filter,
+		engine = engine,
+		dedup = dedup,
+		writer_class = writer_class,
+	)
+
+
+def _write_batch(batch: bytes, file_id: str, shard_dir: str) -> dict[str, int]:
+	"""
+	Flattens a batch of raw in-network items (joined by commas) into
+	shards in `shard_dir`. Runs in a worker process.
+	"""
+	make_dir(shard_dir)
+
+	data = b'{"in_network":[' + batch + b']}'
+	parser = start_parser(io.BytesIO(data), _worker_state['engine'], fast_skip = True)
+	ffwd(parser, to_prefix = '', to_value = 'in_network')
+
+	writer_class = _worker_state['writer_class']
+	with writer_class(shard_dir, dedup = _worker_state['dedup']) as writer:
+		filtered_items = gen_in_network_items(parser, _worker_state['code_filter'])
+		swapped_items = swap_references(filtered_items, _worker_state['reference_map'])
+
+		for item in process_in_network(swapped_items, _worker_state['npi_filter']):
+			write_in_network_item(file_id, item, writer)
+
+	return writer.rows_written
+
+
+def gen_batches(
+	raw_items: Generator,
+	batch_bytes: int,
+	mark: Callable | None = None,
+) -> Generator:
+	"""
+	Joins raw items into comma-separated batches of about `batch_bytes`.
+	Yields (batch, mark()), with `mark` called right after the last item
+	of the batch was read.
+	"""
+	batch = []
+	size = 0
+	for raw_item in raw_items:
+		batch.append(raw_item)
+		size += len(raw_item)
+		last_mark = mark() if mark else None
+		if size >= batch_bytes:
+			yield b','.join(batch), last_mark
+			batch = []
+			size = 0
+	if batch:
+		yield b','.join(batch), last_mark
+
+
+def write_in_network_items_parallel(
+	raw_items: Generator,
+	file_id: str,
+	writer: CSVWriter,
+	reference_map: ReferenceStore,
+	code_filter: set | None,
+	npi_filter: set | None,
+	engine: str,
+	workers: int,
+	batch_bytes: int = 8 << 20,
+	mark: Callable | None = None,
+	on_merged: Callable | None = None,
+) -> None:
+	"""
+	Farms the in-network items out to `workers` processes in batches.
+
+	Each batch gets written to its own shards, which are merged
+	into `writer` in the order that the batches were read, so the
+	output is the same as if the items had been written one by one.
+
+	Where fork is available the workers inherit the reference map
+	(copy-on-write) instead of each getting a pickled copy.
+
+	If `writer` drops repeated rows, so do the workers (within their
+	batch), and `writer` drops repeats across batches when merging.
+
+	`on_merged(mark())` is called after each batch has been merged, with
+	`mark` called when the last item of that batch was read.
+	"""
+	if 'fork' in multiprocessing.get_all_start_methods():
+		context = multiprocessing.get_context('fork')
+	else:
+		context = None
+
+	pool = ProcessPoolExecutor(
+		max_workers = workers,
+		mp_context = context,
+		initializer = _init_worker,
+		initargs = (
+			reference_map,
+			code_filter,
+			npi_filter,
+			engine,
+			helpers.hasher,
+			writer.dedup,
+			type(writer),
+		),
+	)
+
+	with tempfile.TemporaryDirectory(dir = writer.out_dir) as shard_root, pool:
+		# Bounded so that we don't read
+		# the whole file into memory
+		pending = collections.deque()
+
+		def merge_next():
+			shard_dir, future, batch_mark = pending.popleft()
+			writer.merge(shard_dir, future.result())
+			if on_merged:
+				on_merged(batch_mark)
+
+		batches = gen_batches(raw_items, batch_bytes, mark)
+		for i, (batch, batch_mark) in enumerate(batches):
+			shard_dir = f'{shard_root}/{i}'
+			future = pool.submit(_write_batch, batch, file_id, shard_dir)
+			pending.append((shard_dir, future, batch_mark))
+
+			if len(pending) >= 2 * workers:
+				merge_next()
+
+		while pending:
+			merge_next()
 
 
 def in_network_file_to_csv(
@@ -650,7 +898,20 @@ def in_network_file_to_csv(
 	file:        str | None = None,
 	code_filter: set | None = None,
 	npi_filter:  set | None = None,
-) -> None:
+	engine:      str = 'parse',
+	fast_skip:   bool = False,
+	read_ahead:  bool = False,
+	single_pass: bool = False,
+	workers:     int = 1,
+	checkpoint:  bool = False,
+	dedup:       bool | int = False,
+	reference_db: str | None = None,
+	reference_cache: str | None = None,
+	fetch_options: dict | None = None,
+	prune_references: bool = False,
+	output_format: str = 'csv',
+	output_options: dict | None = None,
+) -> dict[str, int]:
 	"""
 	Writes MRF content to a flat file CSV in a specific schema.
 	The filename parameter is optional. If you only pass a URL we assume
@@ -658,27 +919,190 @@ def in_network_file_to_csv(
 
 	As of 1/2/2023 the filename is extracted from the URL, so this
 	isn't an optional parameter.
+
+	`engine` picks the event source (see PARSE_ENGINES). Both engines
+	produce the same output. `fast_skip` skips filtered-out in-network
+	items at the byte level (see scanner.py) instead of parsing them.
+	`read_ahead` moves decompression and downloading to a background
+	thread (see helpers.ReadAheadReader).
+
+	If the provider references come after the in-network items, we need
+	to come back to the items once we have the references. By default we
+	do that by opening the file again. With `single_pass`, the items are
+	put aside on the first pass instead (see scanner.StashedValue), so a
+	remote file is only downloaded once. This implies `fast_skip`.
+
+	With `workers` > 1, the in-network items are split off at the byte
+	level and flattened by that many processes (see
+	write_in_network_items_parallel). This also implies `fast_skip`.
+
+	With `checkpoint`, progress is saved about once a minute, and a rerun
+	after a crash picks up from the last checkpoint (see checkpoint.py).
+	This implies `fast_skip` too.
+
+	With `dedup`, rows that were already written in this run are dropped
+	(see writers.CSVWriter). The memory of what was written doesn't
+	survive a crash, so a resumed run can repeat some rows.
+
+	With `reference_db` (a path), the reference map is kept in a SQLite
+	database instead of in memory (see references.DiskReferenceStore).
+	If an earlier run already built it for this file and NPI filter, it
+	gets reused.
+
+	With `reference_cache` (a path), the remote provider references
+	(the ones with a `location`) are cached across runs and files (see
+	refcache.ReferenceCache) and only downloaded again if they changed.
+
+	`fetch_options` are passed on to the fetcher.ReferenceFetcher that
+	downloads the remote provider references (limit_per_host, retries,
+	timeout, ...). References that still fail get listed in
+	`{out_dir}/failed_references.csv`.
+
+	When the provider references come after the in-network items,
+	`prune_references` makes the first pass over the items (which would
+	otherwise just skip them) collect the provider_group_ids that the
+	items passing `code_filter` refer to. Only those references are then
+	built, processed and downloaded. This needs the two-pass mode: with
+	`single_pass`, the items aren't parsed until the references are in.
+
+	`output_format` is one of writers.WRITERS: 'csv', 'parquet' for
+	typed Parquet tables (see writers.ParquetWriter) or 'sql' to insert
+	the rows into a database (see writers.SQLWriter). `output_options`
+	are passed on to the writer, e.g. the `connect` function and
+	`dialect` of a SQLWriter. Checkpoints only work with CSV.
+
+	Returns the number of rows written to each table.
 	"""
-	if npi_filter:
+	if npi_filter and not isinstance(npi_filter, NPIFilter):
 		log.debug('Converting npi_filter to ints from strings')
-		npi_filter = set(int(n) for n in list(npi_filter))
+		npi_filter = NPIFilter(npi_filter)
 
 	assert url is not None
 	assert validate_url(url)
+	if checkpoint and output_format != 'csv':
+		raise ValueError('Checkpoints only work with CSV output')
 	make_dir(out_dir)
 
 	if file is None: file = url
 
-	completed = False
-	ref_map = None
-
 	metadata = ijson.ObjectBuilder()
-	parser = start_parser(file)
+	parser_options = dict(
+		engine = engine,
+		fast_skip = fast_skip or single_pass or workers > 1 or checkpoint,
+		read_ahead = read_ahead,
+	)
 
 	file_row = file_row_from_url(url)
 	file_row['url'] = url
 	file_id = file_row['id']
 
+	saver = None
+	ref_map = None
+	state = None
+
+	reference_store = None
+	if reference_db:
+		# Keyed on the version of the file too, so that a re-published
+		# file with the same name doesn't get the old file's map.
+		# A pruned map only has what this code filter needs.
+		source = f'{file_id}:{file_version(file)}'
+		if prune_references and code_filter:
+			source = f'{source}:{code_filter_key(code_filter)}'
+		reference_store = DiskReferenceStore(reference_db, source, npi_filter)
+		if reference_store.complete:
+			ref_map = reference_store
+
+	ref_cache = None
+	if reference_cache:
+		ref_cache = ReferenceCache(reference_cache, npi_filter)
+
+	fetcher = ReferenceFetcher(
+		cache = ref_cache,
+		report = f'{out_dir}/failed_references.csv',
+		**(fetch_options or {}),
+	)
+
+	if checkpoint:
+		saver = Checkpoint(out_dir, file_id)
+		state = saver.start()
+
+	if state and state['offset'] is not None:
+		source = open_in_array(file, b'"in_network"', state['offset'], read_ahead)
+		parser = start_parser(source, **parser_options)
+		parser.items_read = state['items']
+		ref_map = saver.reference_map()
+	else:
+		parser = start_parser(file, **parser_options)
+
+	writer = WRITERS[output_format](out_dir, dedup = dedup, **(output_options or {}))
+	try:
+		with writer:
+			_in_network_file_to_csv(
+				file = file,
+				parser = parser,
+				metadata = metadata,
+				file_id = file_id,
+				writer = writer,
+				code_filter = code_filter,
+				npi_filter = npi_filter,
+				parser_options = parser_options,
+				single_pass = single_pass,
+				workers = workers,
+				ref_map = ref_map,
+				checkpoint = saver,
+				reference_store = reference_store,
+				fetcher = fetcher,
+				prune_references = prune_references,
+			)
+
+			if saver is not None:
+				file_row.update(saver.metadata)
+			file_row.update(metadata.value)
+			writer.write(file_row, 'file')
+	finally:
+		# A map from a checkpoint has a connection of its own
+		for store in (reference_store, ref_map):
+			if isinstance(store, DiskReferenceStore):
+				store.close()
+		if ref_cache is not None:
+			ref_cache.close()
+
+	if saver is not None:
+		saver.clear()
+
+	return writer.rows_written
+
+
+def _in_network_file_to_csv(
+	file: str,
+	parser: Generator,
+	metadata: ijson.ObjectBuilder,
+	file_id: int,
+	writer: CSVWriter,
+	code_filter: set | None,
+	npi_filter: set | None,
+	parser_options: dict,
+	single_pass: bool,
+	workers: int = 1,
+	ref_map: ReferenceStore | None = None,
+	checkpoint: Checkpoint | None = None,
+	reference_store: DiskReferenceStore | None = None,
+	fetcher: ReferenceFetcher | None = None,
+	prune_references: bool = False,
+) -> None:
+	"""Main loop of in_network_file_to_csv"""
+	completed = False
+	stash = None
+	needed = None
+
+	def mark():
+		return parser.tell(), parser.items_read
+
+	def save_checkpoint(mark):
+		if checkpoint is not None and checkpoint.due():
+			offset, items = mark
+			checkpoint.save(writer, offset, items, metadata.value, ref_map)
+
 	while True:
 		# This loop runs as long as there's a parser.
 		# We don't use
@@ -694,14 +1118,19 @@ def in_network_file_to_csv(
 			prefix, event, value = next(parser)
 		except StopIteration:
 			if completed: break
-			if ref_map is None: ref_map = {}
-			parser = start_parser(file)
+			if ref_map is None: ref_map = ReferenceStore()
+			source = file if stash is None else stash.open()
+			parser = start_parser(source, **parser_options)
 			ffwd(parser, to_prefix='', to_value='in_network')
 			prefix, event, value = ('', 'map_key', 'in_network')
 			prepend(('', 'map_key', 'in_network'), parser)
 
 		if value == 'provider_references':
-			ref_map = get_reference_map(parser, npi_filter)
+			if completed:
+				# We're on the second pass, and have the map already
+				skip_value(parser, 'provider_references')
+			else:
+				ref_map = get_reference_map(parser, npi_filter, reference_store, fetcher, needed)
 
 		# There are four things that need to come before in_network
 		# 1. reporting_entity_name
@@ -710,86 +1139,336 @@ def in_network_file_to_csv(
 		# 4. last_updated_on
 		elif value == 'in_network':
 			if ref_map is None:
-				ffwd(parser, to_prefix = 'in_network', to_event = 'end_array')
+				if single_pass:
+					# Put the items aside and come back to
+					# them once we have the references
+					stash = parser.stash_value()
+				elif prune_references:
+					needed = collect_reference_ids(parser, code_filter)
+					log.info(f'The in-network items refer to {len(needed)} provider references')
+				else:
+					skip_value(parser, 'in_network')
 				continue
 
-			filtered_items = gen_in_network_items(parser, code_filter)
-			swapped_items = swap_references(filtered_items, ref_map)
+			if workers > 1:
+				write_in_network_items_parallel(
+					raw_items = parser.raw_items(),
+					file_id = file_id,
+					writer = writer,
+					reference_map = ref_map,
+					code_filter = code_filter,
+					npi_filter = npi_filter,
+					engine = parser_options['engine'],
+					workers = workers,
+					mark = mark,
+					on_merged = save_checkpoint,
+				)
+			else:
+				filtered_items = gen_in_network_items(parser, code_filter)
+				swapped_items = swap_references(filtered_items, ref_map)
 
-			for item in process_in_network(swapped_items, npi_filter):
-				write_in_network_item(file_id, item, out_dir)
+				for item in process_in_network(swapped_items, npi_filter):
+					write_in_network_item(file_id, item, writer)
+					if checkpoint is not None:
+						save_checkpoint(mark())
 
 			completed = True
 
 		elif not completed:
 			metadata.event(event, value)
 
-	file_row.update(metadata.value)
-	write_table(file_row, 'file', out_dir)
-
 ### TOOLS FOR PROCESSING INDEX FILES
+#
+# The same plans and in-network files show up under many reporting
+# structures (Anthem lists some files under hundreds of thousands of
+# plans), so toc_plan and toc_file rows are only written the first time
+# their ID comes up in the index. Every structure still gets its
+# toc_plan_file links, the cross product of its plans and its files.
+#
+# That cross product is most of the output. In the normalized mode, each
+# structure (link) gets a toc_link row instead, plus a toc_link_plan row
+# per plan and a toc_link_file row per file, so the output grows with the
+# plans plus the files rather than their product. Structures that repeat
+# an earlier one are dropped. The toc_plan_file_expanded view (schema.sql)
+# and expand_toc_links give back the cross product.
 
 def gen_plan_file(parser):
 	plan_file = ijson.ObjectBuilder()
 	for prefix, event, value in parser:
+		if (prefix, event) == ('reporting_structure', 'end_array'):
+			return
+
 		plan_file.event(event, value)
 
 		if (prefix, event) == ('reporting_structure.item', 'end_map'):
 			yield plan_file.value
 			plan_file = ijson.ObjectBuilder()
 
-		elif (prefix, event, value) == ('reporting_structure', 'end_array', None):
-			return
 
-def write_plan_file(plan_file, toc_id, out_dir):
+@functools.lru_cache(maxsize = 100_000)
+def _toc_file_id(url: str) -> tuple[int, str]:
+	"""ID and filename of a toc_file. The same URLs come up over and over."""
+	filename = extract_filename_from_url(url)
+	return dicthasher(dict(filename = filename)), filename
+
+
+def plan_file_rows(
+	plan_file: dict,
+	toc_id: int,
+	seen_plans: SeenKeys | None = None,
+	seen_files: SeenKeys | None = None,
+	normalized: bool = False,
+) -> tuple[list[Row], list[Row], dict[str, list[Row]]]:
+	"""
+	The toc_plan and toc_file rows of a reporting structure, and the
+	rows of its link tables by table name: toc_plan_file, or with
+	`normalized`, toc_link, toc_link_plan and toc_link_file.
 
+	With `seen_plans`/`seen_files`, only the toc_plan and toc_file rows
+	whose ID isn't in there yet.
+	"""
 	if not plan_file.get('in_network_files'):
-		return
+		return [], [], {}
 
 	toc_plan_file_link = dicthasher(plan_file)
 	plan_rows = []
 	file_rows = []
+	plan_ids = []
+	file_ids = []
 
 	for plan in plan_file['reporting_plans']:
 
 		plan_row = append_hash(plan, 'id')
-		plan_row['toc_id'] = toc_id
+		plan_ids.append(plan_row['id'])
+		if seen_plans is not None and seen_plans.seen(plan_row['id']):
+			continue
 
-		write_table(plan_row, 'toc_plan', out_dir)
+		plan_row['toc_id'] = toc_id
 		plan_rows.append(plan_row)
 
 	for file in plan_file['in_network_files']:
 
 		url = file['location']
+		file_id, filename = _toc_file_id(url)
+		file_ids.append(file_id)
+		if seen_files is not None and seen_files.seen(file_id):
+			continue
+
 		file_row = dict(
-			filename = extract_filename_from_url(url)
+			filename = filename,
+			id = file_id,
+			toc_id = toc_id,
+			url = url,
+			description = file['description'],
 		)
-		file_row = append_hash(file_row, 'id')
+		file_rows.append(file_row)
 
-		file_row['toc_id'] = toc_id
-		file_row['url'] = url
-		file_row['description'] = file['description']
+	if normalized:
+		link_tables = dict(
+			toc_link = [dict(link = toc_plan_file_link, toc_id = toc_id)],
+			toc_link_plan = [dict(link = toc_plan_file_link, toc_plan_id = plan_id) for plan_id in plan_ids],
+			toc_link_file = [dict(link = toc_plan_file_link, toc_file_id = file_id) for file_id in file_ids],
+		)
+	else:
+		link_tables = dict(
+			toc_plan_file = [
+				dict(
+					link = toc_plan_file_link,
+					toc_file_id = file_id,
+					toc_plan_id = plan_id,
+				)
+				for plan_id in plan_ids
+				for file_id in file_ids
+			],
+		)
 
-		write_table(file_row, 'toc_file', out_dir)
-		file_rows.append(file_row)
+	return plan_rows, file_rows, link_tables
+
+
+def write_plan_file(plan_file, toc_id, writer: CSVWriter, normalized: bool = False):
+	plan_rows, file_rows, link_tables = plan_file_rows(plan_file, toc_id, normalized = normalized)
+	writer.write(plan_rows, 'toc_plan')
+	writer.write(file_rows, 'toc_file')
+	for table_name, rows in link_tables.items():
+		writer.write(rows, table_name)
 
-	print(len(plan_rows))
-	print(len(file_rows))
 
-	for plan_row in plan_rows:
-		for file_row in file_rows:
-			toc_plan_file_row = dict(
-				link = toc_plan_file_link,
-				toc_file_id = file_row['id'],
-				toc_plan_id = plan_row['id'],
+def _write_toc_batch(batch: bytes, toc_id: int, shard_dir: str, normalized: bool) -> tuple:
+	"""
+	Writes the toc_plan_file rows of a batch of raw reporting structures
+	(joined by commas) to shards in `shard_dir`. Returns the rows written,
+	and the batch's distinct toc_plan and toc_file rows, which the main
+	process deduplicates across the whole index. With `normalized`, the
+	link tables of each structure are returned too, since repeated
+	structures are dropped across the whole index as well.
+	Runs in a worker process.
+	"""
+	make_dir(shard_dir)
+
+	seen_plans, seen_files = SeenKeys(), SeenKeys()
+	plan_rows, file_rows, links = [], [], []
+
+	writer_class = _worker_state['writer_class']
+	with writer_class(shard_dir, dedup = _worker_state['dedup']) as writer:
+		for plan_file in json.loads(b'[' + batch + b']'):
+			new_plans, new_files, link_tables = plan_file_rows(
+				plan_file, toc_id, seen_plans, seen_files, normalized,
 			)
-			write_table(toc_plan_file_row, 'toc_plan_file', out_dir)
+			plan_rows.extend(new_plans)
+			file_rows.extend(new_files)
+			if normalized:
+				links.append(link_tables)
+			elif link_tables:
+				writer.write(link_tables['toc_plan_file'], 'toc_plan_file')
+
+	return writer.rows_written, plan_rows, file_rows, links
+
+
+class _TOCRows:
+	"""
+	Collects the rows of the reporting structures and writes them
+	to `writer` in bulk, every `batch_rows` links
+	"""
+
+	def __init__(self, writer, batch_rows: int):
+		self.writer = writer
+		self.batch_rows = batch_rows
+		self.seen_plans = SeenKeys()
+		self.seen_files = SeenKeys()
+		self.seen_links = SeenKeys()
+		self.plan_rows: list[Row] = []
+		self.file_rows: list[Row] = []
+		self.link_rows: dict[str, list[Row]] = collections.defaultdict(list)
+		self.buffered_links = 0
+
+	def add(
+		self,
+		plan_rows: list[Row],
+		file_rows: list[Row],
+		link_tables: dict[str, list[Row]] | None = None,
+	) -> None:
+		self.plan_rows.extend(row for row in plan_rows if not self.seen_plans.seen(row['id']))
+		self.file_rows.extend(row for row in file_rows if not self.seen_files.seen(row['id']))
+
+		if link_tables:
+			links = link_tables.get('toc_link')
+			# A repeat of a structure has the same plans and files
+			if links is None or not self.seen_links.seen(links[0]['link']):
+				for table_name, rows in link_tables.items():
+					self.link_rows[table_name].extend(rows)
+					self.buffered_links += len(rows)
+
+		if self.buffered_links >= self.batch_rows:
+			self.flush()
+
+	def flush(self) -> None:
+		for rows, table_name in (
+			(self.plan_rows, 'toc_plan'),
+			(self.file_rows, 'toc_file'),
+			*((rows, table_name) for table_name, rows in self.link_rows.items()),
+		):
+			if rows:
+				self.writer.write(rows, table_name)
+				rows.clear()
+		self.buffered_links = 0
+
+	def log_stats(self) -> None:
+		log.info(
+			f'{self.seen_plans.misses} distinct plans out of {self.seen_plans.misses + self.seen_plans.hits}, '
+			f'{self.seen_files.misses} distinct files out of {self.seen_files.misses + self.seen_files.hits}'
+		)
+
+
+def write_plan_files(
+	raw_items: Generator,
+	toc_id: int,
+	writer: CSVWriter,
+	normalized: bool = False,
+	batch_rows: int = 100_000,
+) -> None:
+	"""Writes the raw reporting structures in `raw_items` to `writer`"""
+	rows = _TOCRows(writer, batch_rows)
+	for raw_item in raw_items:
+		rows.add(*plan_file_rows(json.loads(raw_item), toc_id, normalized = normalized))
+	rows.flush()
+	rows.log_stats()
+
+
+def write_plan_files_parallel(
+	raw_items: Generator,
+	toc_id: int,
+	writer: CSVWriter,
+	workers: int,
+	normalized: bool = False,
+	batch_bytes: int = 8 << 20,
+	batch_rows: int = 100_000,
+) -> None:
+	"""
+	Like write_plan_files, with the reporting structures farmed out to
+	`workers` processes in batches. The links get written to shards
+	and merged in order, as in write_in_network_items_parallel.
+	"""
+	pool = ProcessPoolExecutor(
+		max_workers = workers,
+		initializer = _init_worker,
+		initargs = (None, None, None, 'parse', helpers.hasher, writer.dedup, type(writer)),
+	)
+
+	rows = _TOCRows(writer, batch_rows)
+	with tempfile.TemporaryDirectory(dir = writer.out_dir) as shard_root, pool:
+		pending = collections.deque()
+
+		def merge_next():
+			shard_dir, future = pending.popleft()
+			rows_written, plan_rows, file_rows, links = future.result()
+			rows.add(plan_rows, file_rows)
+			for link_tables in links:
+				rows.add([], [], link_tables)
+			writer.merge(shard_dir, rows_written)
+
+		for i, (batch, _) in enumerate(gen_batches(raw_items, batch_bytes)):
+			shard_dir = f'{shard_root}/{i}'
+			pending.append((shard_dir, pool.submit(_write_toc_batch, batch, toc_id, shard_dir, normalized)))
+
+			if len(pending) >= 2 * workers:
+				merge_next()
+
+		while pending:
+			merge_next()
+
+	rows.flush()
+	rows.log_stats()
+
 
 def toc_file_to_csv(
 	url: str,
 	out_dir: str,
 	file:        str | None = None,
-) -> None:
+	read_ahead:  bool = False,
+	dedup:       bool | int = False,
+	output_format: str = 'csv',
+	output_options: dict | None = None,
+	workers:     int = 1,
+	normalized:  bool = False,
+) -> dict[str, int]:
+	"""
+	Flattens a table of contents (index) file into the toc, toc_plan,
+	toc_file and toc_plan_file tables.
+
+	The reporting structures are cut out of the file at the byte level
+	(see scanner.ScanningParser) and each one is loaded with json.loads.
+	toc_plan and toc_file rows are written once per ID across the whole
+	index. With `workers` > 1, the reporting structures are flattened by
+	that many processes. `dedup` drops repeated toc_plan_file rows too.
+
+	With `normalized`, the links between plans and files are written to
+	toc_link, toc_link_plan and toc_link_file instead of toc_plan_file
+	(see the comment above gen_plan_file). expand_toc_links (for CSVs)
+	or the toc_plan_file_expanded view (for SQL) turn them back into
+	toc_plan_file.
+
+	Returns the number of rows written to each table.
+	"""
 	assert url is not None
 	assert validate_url(url)
 	make_dir(out_dir)
@@ -797,9 +1476,9 @@ def toc_file_to_csv(
 	if file is None:
 		file = url
 
-	with JSONOpen(file) as f:
-
-		parser = ijson.parse(f)
+	writer = WRITERS[output_format](out_dir, dedup = dedup, **(output_options or {}))
+	with writer:
+		parser = start_parser(file, fast_skip = True, read_ahead = read_ahead)
 		toc_row = dict(
 			filename = extract_filename_from_url(url)
 		)
@@ -808,10 +1487,51 @@ def toc_file_to_csv(
 		toc_id = toc_row['id']
 		metadata = ijson.ObjectBuilder()
 		for prefix, event, value in parser:
-			if (prefix, event, value) == ('reporting_structure', 'start_array', None):
-				for plan_file in gen_plan_file(parser):
-					write_plan_file(plan_file, toc_id, out_dir)
+			if (prefix, event, value) == ('', 'map_key', 'reporting_structure'):
+				if workers > 1:
+					write_plan_files_parallel(parser.raw_items(), toc_id, writer, workers, normalized)
+				else:
+					write_plan_files(parser.raw_items(), toc_id, writer, normalized)
 			else:
 				metadata.event(event, value)
-	toc_row.update(metadata.value)
-	write_table(toc_row, 'toc', out_dir)
+
+		for key in ('reporting_entity_name', 'reporting_entity_type'):
+			toc_row[key] = metadata.value.get(key)
+		writer.write(toc_row, 'toc')
+
+	return writer.rows_written
+
+
+def expand_toc_links(out_dir: str, writer: CSVWriter | None = None) -> dict[str, int]:
+	"""
+	Writes the toc_plan_file rows that the normalized tables in `out_dir`
+	(toc_link_plan.csv and toc_link_file.csv) stand for, to `writer`
+	(by default, toc_plan_file.csv in `out_dir`). The file IDs of every
+	link (all of toc_link_file) are held in memory, while toc_link_plan
+	is streamed, so this needs memory for the files but not the plans.
+
+	>>> toc_file_to_csv(url, out_dir, normalized = True)
+	>>> expand_toc_links(out_dir)
+	{'toc_plan_file': 1600000}
+	"""
+	link_files = collections.defaultdict(list)
+	with open(f'{out_dir}/toc_link_file.csv', newline = '') as f:
+		for row in csv.DictReader(f):
+			link_files[int(row['link'])].append(int(row['toc_file_id']))
+
+	if writer is None:
+		writer = CSVWriter(out_dir)
+
+	with writer, open(f'{out_dir}/toc_link_plan.csv', newline = '') as f:
+		for row in csv.DictReader(f):
+			link = int(row['link'])
+			plan_id = int(row['toc_plan_id'])
+			writer.write(
+				[
+					dict(link = link, toc_file_id = file_id, toc_plan_id = plan_id)
+					for file_id in link_files[link]
+				],
+				'toc_plan_file',
+			)
+
+	return writer.rows_written
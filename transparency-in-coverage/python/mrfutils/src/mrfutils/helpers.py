@@ -1,9 +1,14 @@
+from __future__ import annotations
+
+import contextlib
 import csv
 import gzip
 import hashlib
 import json
 import logging
 import os
+import queue
+import threading
 from itertools import chain
 from pathlib import Path
 from urllib.parse import urlparse
@@ -11,10 +16,60 @@ from urllib.parse import urlparse
 import requests
 
 from mrfutils.exceptions import InvalidMRF
+from mrfutils.ranges import open_ranged
+
+# Faster drop-in replacements for the gzip module, if they're installed
+try:
+	from isal import igzip as gzip_backend
+except ImportError:
+	try:
+		from zlib_ng import gzip_ng as gzip_backend
+	except ImportError:
+		gzip_backend = gzip
+
+try:
+	import xxhash
+except ImportError:
+	xxhash = None
 
 log = logging.getLogger('mrfutils')
 log.setLevel(logging.INFO)
 
+# Connections used to download each remote file (see ranges.py). With 1,
+# remote files are read as a single stream. Set with `set_range_connections`.
+range_connections = 1
+
+
+def set_range_connections(connections: int) -> None:
+	global range_connections
+
+	if connections < 1:
+		raise ValueError(f'Need at least one connection, got {connections}')
+
+	range_connections = connections
+
+
+# Local copies of remote files (a mirror.FileMirror). Set with `set_mirror`.
+mirror = None
+
+
+def set_mirror(file_mirror) -> None:
+	global mirror
+	mirror = file_mirror
+
+
+def url_suffix(filename: str) -> str:
+	"""
+	The suffixes of a filename or URL (or its query, if the path has none)
+	>>> url_suffix('https://example.com/insurer.stuff.json.gz?sig=1')
+	'.stuff.json.gz'
+	"""
+	parsed_url = urlparse(filename)
+	suffix = ''.join(Path(parsed_url.path).suffixes)
+	if not suffix:
+		suffix = ''.join(Path(parsed_url.query).suffixes)
+	return suffix
+
 
 def prepend(value, iterator):
 	"""Prepend a single value in front of an iterator
@@ -35,6 +90,89 @@ def peek(iterator):
 	return next_, prepend(next_, iterator)
 
 
+class ReadAheadReader:
+	"""
+	Reads from `f` in a background thread and hands over the data through
+	a bounded queue. Decompression (and network reads, for remote files)
+	then happen on that thread, while the parser runs on this one. zlib and
+	socket reads release the GIL, so the two actually overlap.
+
+	At most `max_chunks` chunks of `chunk_size` bytes are read ahead.
+	"""
+
+	def __init__(self, f, chunk_size: int = 1 << 20, max_chunks: int = 16):
+		self.f = f
+		self.chunk_size = chunk_size
+		self.queue = queue.Queue(maxsize = max_chunks)
+		self.stopped = threading.Event()
+		self.buf = b''
+		self.pos = 0
+		self.eof = False
+		self.thread = threading.Thread(target = self._read_ahead, daemon = True)
+		self.thread.start()
+
+	def _put(self, item) -> bool:
+		while not self.stopped.is_set():
+			try:
+				self.queue.put(item, timeout = .1)
+				return True
+			except queue.Full:
+				continue
+		return False
+
+	def _read_ahead(self) -> None:
+		try:
+			while not self.stopped.is_set():
+				chunk = self.f.read(self.chunk_size)
+				if not self._put(chunk) or not chunk:
+					return
+		except Exception as e:
+			# Re-raised on the reading thread
+			self._put(e)
+
+	def _next_chunk(self) -> None:
+		item = self.queue.get()
+		if isinstance(item, Exception):
+			raise item
+		if not item:
+			self.eof = True
+		self.buf = item
+		self.pos = 0
+
+	def read(self, n: int = -1) -> bytes:
+		if n is None or n < 0:
+			parts = [self.buf[self.pos:]]
+			while not self.eof:
+				self._next_chunk()
+				parts.append(self.buf)
+			self.buf, self.pos = b'', 0
+			return b''.join(parts)
+
+		if n == 0:
+			return b''
+
+		if self.pos >= len(self.buf) and not self.eof:
+			self._next_chunk()
+
+		data = self.buf[self.pos:self.pos + n]
+		self.pos += len(data)
+		return data
+
+	def readable(self) -> bool:
+		return True
+
+	def close(self) -> None:
+		self.stopped.set()
+		# Make room in case the thread is blocked on a full queue
+		while True:
+			try:
+				self.queue.get_nowait()
+			except queue.Empty:
+				break
+		self.thread.join()
+		self.f.close()
+
+
 class JSONOpen:
 	"""
 	Context manager for opening JSON(.gz) MRFs.
@@ -43,18 +181,44 @@ class JSONOpen:
 	or
 	>>> with JSONOpen(some_json_url) as f:
 	including both zipped and unzipped files.
+
+	With read_ahead = True, decompression and network reads happen in a
+	background thread (see ReadAheadReader).
+
+	With `offset`, reading starts that many (decompressed) bytes into the
+	file. Local JSON files seek there and remote ones are fetched with a
+	Range request. Gzipped files have to be decompressed up to the offset,
+	but the skipped part never gets parsed.
+
+	Gzipped files are opened with isal or zlib-ng when one of them is
+	installed, since they inflate a good deal faster than zlib.
+
+	With more than one of `connections` (by default `range_connections`),
+	remote files are downloaded in parallel byte ranges when the server
+	allows it (see ranges.py), and as a single stream when it doesn't.
+
+	When a mirror is set (see mirror.py), remote files are opened from
+	their local copy instead.
 	"""
 
-	def __init__(self, filename):
+	def __init__(
+		self,
+		filename,
+		read_ahead: bool = False,
+		offset: int = 0,
+		connections: int | None = None,
+	):
 		self.filename = filename
+		self.read_ahead = read_ahead
+		self.offset = offset
+		self.connections = connections or range_connections
 		self.f = None
 		self.r = None
+		self.s = None
+		self.ranged = None
 		self.is_remote = None
 
-		parsed_url = urlparse(self.filename)
-		self.suffix = ''.join(Path(parsed_url.path).suffixes)
-		if not self.suffix:
-			self.suffix = ''.join(Path(parsed_url.query).suffixes)
+		self.suffix = url_suffix(self.filename)
 
 		if not (
 			self.suffix.endswith('.json.gz') or
@@ -62,44 +226,98 @@ class JSONOpen:
 		):
 			raise InvalidMRF(f'Suffix not JSON: {self.filename=} {self.suffix=}')
 
-		self.is_remote = parsed_url.scheme in ('http', 'https')
+		self.is_remote = urlparse(self.filename).scheme in ('http', 'https')
+		self.local_path = self.filename
 
 	def __enter__(self):
-		if (
+		# Whatever can't seek or Range-request
+		# to the offset reads its way up to it
+		skip = self.offset
+
+		if self.is_remote and mirror is not None:
+			self.local_path = mirror.get(self.filename)
+			self.is_remote = False
+
+		if self.is_remote:
+			self.s = requests.Session()
+			if self.connections > 1:
+				# Gzipped files are decompressed from the start
+				start = 0 if self.suffix.endswith('.json.gz') else self.offset
+				self.ranged = open_ranged(self.filename, start, self.connections, self.s)
+
+		if self.ranged is not None:
+			if self.suffix.endswith('.json.gz'):
+				self.f = gzip_backend.GzipFile(fileobj=self.ranged)
+			else:
+				self.f = self.ranged
+				skip = 0
+
+		elif (
 			self.is_remote
 			# endswith is used to protect against the case
 			# where the filename contains lots of dots
 			# insurer.stuff.json.gz
 			and self.suffix.endswith('.json.gz')
 		):
-			self.s = requests.Session()
 			self.r = self.s.get(self.filename, stream=True)
-			self.f = gzip.GzipFile(fileobj=self.r.raw)
+			self.f = gzip_backend.GzipFile(fileobj=self.r.raw)
 
 		elif (
 			self.is_remote
 			and self.suffix.endswith('.json')
 		):
-			self.s = requests.Session()
-			self.r = self.s.get(self.filename, stream=True)
+			headers = None
+			if self.offset:
+				# Ranges of an encoded response would be useless
+				headers = {'Range': f'bytes={self.offset}-', 'Accept-Encoding': 'identity'}
+			self.r = self.s.get(self.filename, stream=True, headers=headers)
 			self.r.raw.decode_content = True
 			self.f = self.r.raw
+			if self.r.status_code == 206:
+				skip = 0
 
-		elif self.suffix == '.json.gz':
-			self.f = gzip.open(self.filename, 'rb')
+		elif self.suffix.endswith('.json.gz'):
+			self.f = gzip_backend.open(self.local_path, 'rb')
 
 		else:
-			self.f = open(self.filename, 'rb')
+			self.f = open(self.local_path, 'rb')
+			self.f.seek(self.offset)
+			skip = 0
+
+		while skip:
+			chunk = self.f.read(min(skip, 1 << 20))
+			if not chunk:
+				raise InvalidMRF(f'Offset is past the end of the file: {self.filename}')
+			skip -= len(chunk)
+
+		if self.read_ahead:
+			self.f = ReadAheadReader(self.f)
 
 		log.info(f'Opened file: {self.filename}')
 		return self.f
 
 	def __exit__(self, exc_type, exc_val, exc_tb):
+		# Closing the file first stops the read-ahead thread
+		# before the connection goes away underneath it
+		self.f.close()
+
 		if self.is_remote:
 			self.s.close()
-			self.r.close()
+			# GzipFile leaves the file it was given open
+			if self.ranged is not None:
+				self.ranged.close()
+			if self.r is not None:
+				self.r.close()
 
-		self.f.close()
+
+def open_json(file, read_ahead: bool = False):
+	"""
+	JSONOpen for filenames and URLs. Anything that's already file-like
+	(has a read method) is used as it is, and closed on exit.
+	"""
+	if hasattr(file, 'read'):
+		return contextlib.closing(file)
+	return JSONOpen(file, read_ahead)
 
 
 def import_csv_to_set(filename: str):
@@ -124,14 +342,86 @@ def make_dir(out_dir):
 		os.mkdir(out_dir)
 
 
+# Row IDs
+#
+# A row's ID is a 64-bit hash of its key, which is the row as JSON with
+# sorted keys (exactly json.dumps(row, sort_keys = True)), encoded as
+# UTF-8. The hash is one of HASHERS:
+#
+# * sha256:  the first 8 bytes of the SHA-256 digest, little-endian. This
+#            is what the IDs have always been, so it's the default.
+# * blake2b: BLAKE2b with an 8 byte digest, little-endian
+# * xxh3:    XXH3 64-bit (needs `pip install xxhash`)
+#
+# The faster hashers give different IDs, so don't mix them with sha256 IDs
+# in one database. Pick one with `set_hasher` before flattening anything.
+#
+# Most rows (TINs especially) come up over and over, so the IDs of the
+# last HASH_CACHE_SIZE distinct rows are kept around. The cache keys on
+# the values *and* their types, since 1, 1.0 and True are equal in Python
+# but not in JSON.
+
+_json_key = json.JSONEncoder(sort_keys = True).encode
+
+def _sha256(key: bytes) -> int:
+	return int.from_bytes(hashlib.sha256(key).digest()[:8], 'little')
+
+def _blake2b(key: bytes) -> int:
+	return int.from_bytes(hashlib.blake2b(key, digest_size = 8).digest(), 'little')
+
+def _xxh3(key: bytes) -> int:
+	return xxhash.xxh3_64_intdigest(key)
+
+HASHERS = {
+	'sha256': _sha256,
+	'blake2b': _blake2b,
+	'xxh3': _xxh3,
+}
+
+HASH_CACHE_SIZE = 100_000
+
+hasher = 'sha256'
+_hash = _sha256
+_hash_cache = {}
+
+
+def set_hasher(name: str) -> None:
+	global hasher, _hash
+
+	if name == 'xxh3' and xxhash is None:
+		raise ImportError('The xxh3 hasher needs xxhash: pip install xxhash')
+
+	hasher = name
+	_hash = HASHERS[name]
+	_hash_cache.clear()
+
+
 def dicthasher(data: dict, n_bytes = 8) -> int:
 
 	if not data:
 		raise Exception("Hashed dictionary can't be empty")
 
-	data = json.dumps(data, sort_keys=True).encode('utf-8')
-	hash_s = hashlib.sha256(data).digest()[:n_bytes]
-	hash_i = int.from_bytes(hash_s, 'little')
+	if n_bytes != 8:
+		data = json.dumps(data, sort_keys=True).encode('utf-8')
+		hash_s = hashlib.sha256(data).digest()[:n_bytes]
+		return int.from_bytes(hash_s, 'little')
+
+	values = tuple(data.values())
+	cache_key = (tuple(data), values, tuple(map(type, values)))
+
+	try:
+		return _hash_cache[cache_key]
+	except KeyError:
+		pass
+	except TypeError:
+		# Unhashable (nested) values, don't cache
+		return _hash(_json_key(data).encode('utf-8'))
+
+	hash_i = _hash(_json_key(data).encode('utf-8'))
+
+	if len(_hash_cache) >= HASH_CACHE_SIZE:
+		_hash_cache.clear()
+	_hash_cache[cache_key] = hash_i
 
 	return hash_i
 
@@ -154,6 +444,39 @@ def filename_hasher(filename: str) -> int:
 	return filename_hash
 
 
+def file_version(filename: str) -> str:
+	"""
+	Something that changes when the file at `filename` does: the size and
+	mtime of a local file, the ETag, Last-Modified and size of a remote
+	one, or '' if the server doesn't say. Used to tell a re-published file
+	apart from the one of the same name that was there before.
+	"""
+	if urlparse(filename).scheme not in ('http', 'https'):
+		stat = os.stat(filename)
+		return f'{stat.st_size}:{stat.st_mtime_ns}'
+
+	# One byte with GET rather than HEAD, which some signed URLs don't allow
+	try:
+		response = requests.get(
+			filename,
+			headers = {'Range': 'bytes=0-0', 'Accept-Encoding': 'identity'},
+			stream = True,
+			timeout = 60,
+		)
+	except requests.RequestException as e:
+		log.debug(f'Could not get the version of {filename}: {e!r}')
+		return ''
+
+	with response:
+		if response.status_code not in (200, 206):
+			return ''
+		headers = response.headers
+		size = headers.get('Content-Range', '').rpartition('/')[2]
+		if response.status_code == 200:
+			size = headers.get('Content-Length', '')
+		return ':'.join((headers.get('ETag', ''), headers.get('Last-Modified', ''), size))
+
+
 def validate_url(test_url: str) -> bool:
 	# https://stackoverflow.com/a/38020041
 	try:
@@ -1,26 +1,309 @@
-import ijson
+"""
+Index files
+###########
+
+Tools for getting the URLs out of index (table of contents) files, and for
+keeping track of them and their sizes in a SQLite catalog.
+
+`gen_index_links` only looks for URLs at the prefixes where they belong
+(`LINK_PREFIXES`). For one kind of URL that's `ijson.items` with the
+prefix, which never builds the rest of the file into Python objects; for
+several, it's one pass of `ijson.parse` matching the prefixes. Either way
+the index is read once, and each URL comes out once.
+
+`LinkCatalog` keeps the URLs in one table per kind (`in_network_files`,
+...), with their sizes and the payer they came from, plus the index files
+that were already read. URLs are inserted in batches, in one transaction
+per batch, so several payers can share one catalog.
+
+`size_links` fills in the sizes with HEAD requests (or a one-byte GET, for
+servers that don't answer HEAD), at most `concurrency` at a time. URLs that
+failed keep a NULL size and get another go on the next run; -1 means the
+server didn't say.
+
+`catalog_index` puts it together, and can be run again after a crash: an
+index that was read completely isn't read again, and only the URLs without
+a size are sized.
+
+>>> catalog_index('https://.../index.json', 'payer.db', kinds = ('in_network', 'allowed_amount'))
+{'in_network': 1834, 'allowed_amount': 12}
+>>> LinkCatalog('payer.db').total_size('in_network')
+5342957010944
+"""
+from __future__ import annotations
+
+import asyncio
 import logging
+import random
+import re
+import sqlite3
+from typing import Generator, Iterable
+
+import aiohttp
+import ijson
+
 from mrfutils.helpers import JSONOpen
 
 log = logging.getLogger('mrfutils')
 log.setLevel(logging.DEBUG)
 
-def gen_in_network_links(index_loc,):
+# Where each kind of URL is. The provider references
+# are in in-network files rather than in indexes.
+LINK_PREFIXES = {
+    'in_network': 'reporting_structure.item.in_network_files.item.location',
+    'allowed_amount': 'reporting_structure.item.allowed_amount_file.location',
+    'provider_reference': 'provider_references.item.location',
+}
+
+# The catalog table of each kind
+LINK_TABLES = {
+    'in_network': 'in_network_files',
+    'allowed_amount': 'allowed_amount_files',
+    'provider_reference': 'provider_reference_files',
+}
+
+_content_range = re.compile(r'bytes\s+\d+-\d+/(\d+)')
+
+
+def gen_index_links(
+    index_loc,
+    kinds: Iterable[str] = ('in_network',),
+    read_ahead: bool = False,
+) -> Generator[tuple[str, str]]:
+    """
+    Yields (kind, url) for each distinct URL of the `kinds` (keys of
+    LINK_PREFIXES) in an index file, in the order they come up.
+    """
+    prefixes = {LINK_PREFIXES[kind]: kind for kind in kinds}
+    seen = {kind: set() for kind in prefixes.values()}
+
+    with JSONOpen(index_loc, read_ahead) as f:
+        if len(prefixes) == 1:
+            [(prefix, kind)] = prefixes.items()
+            found = ((kind, url) for url in ijson.items(f, prefix))
+        else:
+            found = (
+                (prefixes[prefix], url)
+                for prefix, event, url in ijson.parse(f)
+                if event == 'string' and prefix in prefixes
+            )
+
+        for kind, url in found:
+            if isinstance(url, str) and url not in seen[kind]:
+                seen[kind].add(url)
+                yield kind, url
+
+    for kind, urls in seen.items():
+        log.debug(f'Found: {len(urls)} {kind} files.')
+
+
+def gen_in_network_links(index_loc, read_ahead: bool = False):
     """
     Gets in-network files from index.json files
     :param index.json URL:
     """
-    with JSONOpen(index_loc) as f:
-        count = 0
-        parser = ijson.parse(f, use_float=True)
-        for prefix, event, value in parser:
-            if (
-                prefix.endswith('location')
-                and event == 'string'
-                and 'in-network' in value
-            ):
-                log.debug(value)
-                yield value
-                count += 1
-
-    log.debug(f'Found: {count} in-network files.')
\ No newline at end of file
+    for _, url in gen_index_links(index_loc, ('in_network',), read_ahead):
+        yield url
+
+
+class LinkCatalog:
+    """
+    SQLite catalog of the URLs found in index files and their sizes.
+    See the module docstring.
+    """
+
+    def __init__(self, path: str, batch_size: int = 1_000):
+        self.path = path
+        self.batch_size = batch_size
+        self.db = sqlite3.connect(path, timeout = 60)
+        self.db.execute('PRAGMA journal_mode = WAL')
+        with self.db:
+            # Same tables as the downloaders have always made, plus the payer
+            for table in LINK_TABLES.values():
+                self.db.execute(f'CREATE TABLE IF NOT EXISTS {table} (url PRIMARY KEY UNIQUE, size, payer)')
+                columns = [row[1] for row in self.db.execute(f'PRAGMA table_info({table})')]
+                if 'payer' not in columns:
+                    self.db.execute(f'ALTER TABLE {table} ADD COLUMN payer')
+            self.db.execute('CREATE TABLE IF NOT EXISTS fetched_index_files (url PRIMARY KEY UNIQUE)')
+
+    def add_links(self, links: Iterable[tuple], payer: str | None = None) -> dict[str, int]:
+        """
+        Adds the (kind, url) or (kind, url, size) links that aren't in the
+        catalog yet. Returns how many were new of each kind.
+        """
+        added = {}
+        batch = []
+
+        def insert():
+            by_table = {}
+            for kind, url, *size in batch:
+                by_table.setdefault(kind, []).append((url, size[0] if size else None, payer))
+            with self.db:
+                for kind, rows in by_table.items():
+                    cursor = self.db.executemany(
+                        f'INSERT OR IGNORE INTO {LINK_TABLES[kind]} (url, size, payer) VALUES (?, ?, ?)', rows,
+                    )
+                    added[kind] = added.get(kind, 0) + cursor.rowcount
+            batch.clear()
+
+        for link in links:
+            batch.append(link)
+            if len(batch) >= self.batch_size:
+                insert()
+        insert()
+        return added
+
+    def is_indexed(self, index_url: str) -> bool:
+        return self.db.execute(
+            'SELECT 1 FROM fetched_index_files WHERE url = ?', (index_url,)
+        ).fetchone() is not None
+
+    def mark_indexed(self, index_url: str) -> None:
+        with self.db:
+            self.db.execute('INSERT OR IGNORE INTO fetched_index_files VALUES (?)', (index_url,))
+
+    def unsized(self, kind: str, payer: str | None = None) -> list[str]:
+        if payer is None:
+            rows = self.db.execute(f'SELECT url FROM {LINK_TABLES[kind]} WHERE size IS NULL')
+        else:
+            rows = self.db.execute(
+                f'SELECT url FROM {LINK_TABLES[kind]} WHERE size IS NULL AND payer = ?', (payer,)
+            )
+        return [url for url, in rows]
+
+    def set_sizes(self, kind: str, sizes: Iterable[tuple[str, int]]) -> None:
+        with self.db:
+            self.db.executemany(
+                f'UPDATE {LINK_TABLES[kind]} SET size = ? WHERE url = ?',
+                [(size, url) for url, size in sizes],
+            )
+
+    def total_size(self, kind: str = 'in_network', payer: str | None = None) -> int:
+        query = f'SELECT COALESCE(SUM(size), 0) FROM {LINK_TABLES[kind]} WHERE size > 0'
+        if payer is None:
+            return self.db.execute(query).fetchone()[0]
+        return self.db.execute(query + ' AND payer = ?', (payer,)).fetchone()[0]
+
+    def close(self) -> None:
+        self.db.close()
+
+
+async def get_size(
+    session: aiohttp.ClientSession,
+    url: str,
+    retries: int = 2,
+    backoff: float = 1.,
+) -> int:
+    """
+    Size of the file at `url`, or -1 if the server won't say. Raises
+    if the server can't be reached after `retries` retries.
+    """
+    for attempt in range(retries + 1):
+        try:
+            async with session.head(url, allow_redirects = True) as response:
+                if response.status == 200 and response.content_length is not None:
+                    return response.content_length
+
+            # Some servers (signed S3 URLs, for one) only allow GET
+            async with session.get(url, headers = {'Range': 'bytes=0-0'}) as response:
+                if response.status == 206:
+                    match = _content_range.match(response.headers.get('Content-Range', ''))
+                    if match:
+                        return int(match[1])
+                if response.status == 200 and response.content_length is not None:
+                    return response.content_length
+            return -1
+
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            if attempt == retries:
+                raise
+            await asyncio.sleep(backoff * 2 ** attempt * random.uniform(.5, 1.5))
+
+
+async def size_links(
+    catalog: LinkCatalog,
+    kinds: Iterable[str] = ('in_network',),
+    concurrency: int = 50,
+    timeout: float = 60.,
+    retries: int = 2,
+    per_host: int = 0,
+    payer: str | None = None,
+) -> dict[str, int]:
+    """
+    Fills in the sizes of the URLs in `catalog` (only the `payer`'s, if
+    given) that don't have one yet, with at most `concurrency` requests at
+    a time, and at most `per_host` to any one host (0 for no limit). The
+    sizes are written in batches of the catalog's batch_size. Returns how
+    many URLs of each kind failed.
+    """
+    semaphore = asyncio.BoundedSemaphore(concurrency)
+    failed = {}
+
+    async with aiohttp.ClientSession(
+        connector = aiohttp.TCPConnector(limit = concurrency, limit_per_host = per_host),
+        timeout = aiohttp.ClientTimeout(total = timeout),
+    ) as session:
+
+        for kind in kinds:
+            urls = catalog.unsized(kind, payer)
+            log.info(f'Sizing {len(urls)} {kind} files...')
+            sizes = []
+            tasks = set()
+            failed[kind] = 0
+
+            async def size_one(url):
+                try:
+                    sizes.append((url, await get_size(session, url, retries)))
+                except Exception as e:
+                    log.warning(f'Failed to size {url}: {e!r}')
+                    failed[kind] += 1
+                finally:
+                    semaphore.release()
+
+            for url in urls:
+                # Waiting here, rather than in the task, keeps the
+                # number of tasks (and not just requests) bounded
+                await semaphore.acquire()
+                task = asyncio.create_task(size_one(url))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+
+                if len(sizes) >= catalog.batch_size:
+                    catalog.set_sizes(kind, sizes)
+                    sizes.clear()
+
+            await asyncio.gather(*tasks)
+            catalog.set_sizes(kind, sizes)
+
+    return failed
+
+
+def catalog_index(
+    index_loc: str,
+    catalog: LinkCatalog | str,
+    kinds: Iterable[str] = ('in_network',),
+    concurrency: int = 50,
+    read_ahead: bool = False,
+) -> dict[str, int]:
+    """
+    Adds the URLs of the `kinds` in an index file to `catalog` (a
+    LinkCatalog or the path of one) and sizes the ones that don't have
+    a size yet. Returns the number of new URLs of each kind.
+    """
+    if isinstance(catalog, str):
+        catalog = LinkCatalog(catalog)
+
+    kinds = tuple(kinds)
+    added = {}
+    if catalog.is_indexed(index_loc):
+        log.info(f'Already read {index_loc}')
+    else:
+        added = catalog.add_links(gen_index_links(index_loc, kinds, read_ahead))
+        catalog.mark_indexed(index_loc)
+
+    failed = asyncio.run(size_links(catalog, kinds, concurrency))
+    for kind, count in failed.items():
+        if count:
+            log.warning(f'Could not size {count} {kind} files, run again to retry them')
+
+    return added
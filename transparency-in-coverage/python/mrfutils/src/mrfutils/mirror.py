@@ -0,0 +1,430 @@
+"""
+Local mirror
+############
+
+Running a few different code or NPI filters over the same in-network file
+used to download the whole file again for every run, and those files are
+tens of GB.
+
+`FileMirror` downloads each URL once, into a directory:
+
+* the files are content-addressed: `objects/{sha256}{suffix}`, so two URLs
+  that serve the same bytes are stored once. An SQLite index maps the URLs
+  to them.
+* a download goes to `partial/` first, along with the ETag and size the
+  server reported. If it breaks off, the next attempt (up to `retries`) or
+  the next run picks up where it stopped with a Range request, as long as
+  the file didn't change in the meantime (If-Range). A file whose ETag or
+  Last-Modified wasn't kept, or didn't come back, is downloaded from the
+  start.
+* a finished download has to have the size the server said it would, and
+  the SHA-256 (`checksum`) or MD5 (a `Content-MD5` header) it should have,
+  if those are known. A local copy whose size doesn't match any more is
+  dropped and downloaded again; `verify = True` re-hashes it as well.
+* when the files take up more than `max_bytes`, the least recently used
+  ones are deleted, and room is made before a download when its size is
+  known up front.
+
+With `connections` > 1 the file comes down in parallel byte ranges (see
+ranges.py), if the server allows it. Those are pinned to the version of the
+file the download started on, as well.
+
+Once a mirror is set with `helpers.set_mirror`, JSONOpen opens the local copy
+of every remote file, downloading it first if it has to:
+
+>>> set_mirror(FileMirror('/data/mrf_mirror', max_bytes = 500 << 30))
+>>> in_network_file_to_csv(url = url, ...)   # downloads
+>>> in_network_file_to_csv(url = url, ...)   # local
+
+or on its own:
+
+>>> FileMirror('/data/mrf_mirror').get(url)
+'/data/mrf_mirror/objects/3f9c...e1.json.gz'
+"""
+from __future__ import annotations
+
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+from base64 import b64decode
+
+import requests
+import urllib3
+
+from mrfutils.helpers import url_suffix
+from mrfutils.ranges import RETRY_STATUSES, RangeProbe, open_probed, probe_ranges
+
+try:
+	import fcntl
+except ImportError:
+	fcntl = None
+
+log = logging.getLogger(__name__)
+
+
+MIRROR_SCHEMA = """
+CREATE TABLE IF NOT EXISTS mirrored_files (
+	url TEXT PRIMARY KEY,
+	object TEXT NOT NULL,
+	size INTEGER NOT NULL,
+	etag TEXT,
+	last_modified TEXT,
+	fetched REAL NOT NULL,
+	used REAL NOT NULL
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS mirrored_files_object ON mirrored_files (object);
+"""
+
+BLOCK_SIZE = 1 << 20
+
+
+class MirrorError(IOError):
+	"""A download that's incomplete or doesn't match its checksum"""
+
+
+class ChecksumError(MirrorError):
+	"""Downloading it again won't help"""
+
+
+class FileMirror:
+	"""
+	Local copies of remote files in `directory`. See the module
+	docstring for what the options do.
+	"""
+
+	def __init__(
+		self,
+		directory: str,
+		max_bytes: int = 200 << 30,
+		connections: int = 1,
+		retries: int = 4,
+		backoff: float = 1.,
+		timeout: float = 60.,
+		verify: bool = False,
+	):
+		self.directory = directory
+		self.max_bytes = max_bytes
+		self.connections = connections
+		self.retries = retries
+		self.backoff = backoff
+		self.timeout = timeout
+		self.verify = verify
+
+		os.makedirs(f'{directory}/objects', exist_ok = True)
+		os.makedirs(f'{directory}/partial', exist_ok = True)
+
+		self.path = f'{directory}/mirror.db'
+		self._db = None
+		self._pid = None
+
+	# Several processes (see batch.py) can share the mirror. Each opens
+	# its own connection, since they can't be shared across a fork.
+
+	@property
+	def db(self) -> sqlite3.Connection:
+		if self._pid != os.getpid():
+			self._db = sqlite3.connect(self.path, timeout = 60)
+			self._db.execute('PRAGMA journal_mode = WAL')
+			self._db.executescript(MIRROR_SCHEMA)
+			self._pid = os.getpid()
+		return self._db
+
+	def __getstate__(self) -> dict:
+		return {**self.__dict__, '_db': None, '_pid': None}
+
+	def object_path(self, name: str) -> str:
+		return f'{self.directory}/objects/{name}'
+
+	def lookup(self, url: str) -> str | None:
+		"""The local copy of `url`, or None if there isn't a (good) one"""
+		row = self.db.execute(
+			'SELECT object, size FROM mirrored_files WHERE url = ?', (url,)
+		).fetchone()
+		if row is None:
+			return None
+
+		name, size = row
+		path = self.object_path(name)
+		try:
+			intact = os.path.getsize(path) == size
+			if intact and self.verify:
+				intact = _sha256_file(path) == name.split('.')[0]
+		except FileNotFoundError:
+			intact = False
+
+		if not intact:
+			log.warning(f'Local copy is missing or damaged, downloading again: {url}')
+			self._remove_object(name)
+			return None
+
+		with self.db:
+			self.db.execute('UPDATE mirrored_files SET used = ? WHERE url = ?', (time.time(), url))
+		return path
+
+	def get(self, url: str, checksum: str | None = None) -> str:
+		"""
+		The path of the local copy of `url`, downloaded first if there
+		isn't one. `checksum` is the SHA-256 (hex) the file should have.
+		"""
+		path = self.lookup(url)
+		if path is not None:
+			log.info(f'Using local copy of {url}: {path}')
+			return path
+
+		partial = f'{self.directory}/partial/{_url_key(url)}'
+		with _locked(f'{partial}.lock'):
+			# Someone else may have downloaded it while we waited
+			path = self.lookup(url)
+			if path is not None:
+				return path
+
+			for attempt in range(self.retries + 1):
+				try:
+					return self._download(url, partial, checksum)
+				except (requests.RequestException, urllib3.exceptions.HTTPError, OSError) as e:
+					if isinstance(e, (ChecksumError, requests.HTTPError)) or attempt == self.retries:
+						raise
+					delay = self.backoff * 2 ** attempt
+					log.warning(f'Download of {url} failed ({e!r}), resuming in {delay:.1f}s')
+					time.sleep(delay)
+
+	def _open(self, url: str, session: requests.Session, have: int, meta: dict):
+		"""
+		Opens `url` from byte `have` on if `meta` (of the partial
+		download) still matches it, from the start otherwise. Returns
+		the body as a file-like object, where it starts, and the meta
+		of this download.
+		"""
+		if self.connections > 1:
+			probe = probe_ranges(url, session)
+			if probe is not None:
+				if have and not _same_version(meta, probe):
+					log.info(f'Can\'t tell that {url} is unchanged, downloading it from the start')
+					have = 0
+				ranged = open_probed(probe, have, self.connections, timeout = self.timeout)
+				new_meta = dict(
+					size = probe.size,
+					etag = probe.etag,
+					last_modified = probe.last_modified,
+					md5 = meta.get('md5') if have else None,
+				)
+				return ranged, have, new_meta
+
+		headers = {'Accept-Encoding': 'identity'}
+		# If-Range needs a strong ETag
+		validator = meta.get('etag')
+		if not validator or validator.startswith('W/'):
+			validator = meta.get('last_modified')
+		if have and validator:
+			headers['Range'] = f'bytes={have}-'
+			headers['If-Range'] = validator
+
+		response = session.get(url, stream = True, headers = headers, timeout = self.timeout)
+		if response.status_code not in (200, 206):
+			response.close()
+			if response.status_code in RETRY_STATUSES:
+				raise MirrorError(f'Status {response.status_code}: {url}')
+			response.raise_for_status()
+			raise MirrorError(f'Unexpected status {response.status_code}: {url}')
+
+		if response.status_code == 200:
+			# No resuming this one
+			have = 0
+			size = response.headers.get('Content-Length')
+		else:
+			size = response.headers.get('Content-Range', '').rpartition('/')[2]
+
+		if response.headers.get('Content-Encoding', 'identity') != 'identity':
+			# The size would be that of the encoded body
+			response.raw.decode_content = True
+			size = None
+
+		new_meta = dict(
+			size = int(size) if size and size.isdigit() else None,
+			etag = response.headers.get('ETag'),
+			last_modified = response.headers.get('Last-Modified'),
+			# That of the range, for a 206
+			md5 = response.headers.get('Content-MD5') if response.status_code == 200 else None,
+		)
+		if have:
+			# Keep what the server said when the download started
+			new_meta = {**new_meta, **{k: v for k, v in meta.items() if v}}
+		return contextlib.closing(response.raw), have, new_meta
+
+	def _download(self, url: str, partial: str, checksum: str | None) -> str:
+		part = f'{partial}.part'
+		meta_path = f'{partial}.json'
+
+		have = os.path.getsize(part) if os.path.exists(part) else 0
+		meta = {}
+		if have and os.path.exists(meta_path):
+			with open(meta_path) as f:
+				meta = json.load(f)
+
+		with requests.Session() as session:
+			body, have, meta = self._open(url, session, have, meta)
+			with body as body, open(part, 'r+b' if have else 'wb') as f:
+				f.truncate(have)
+				sha256, md5 = _hash_file(part, have)
+				f.seek(have)
+
+				with open(meta_path, 'w') as m:
+					json.dump(meta, m)
+
+				if meta['size'] is not None:
+					self.evict(reserve = meta['size'] - have)
+
+				if have:
+					log.info(f'Resuming download of {url} at {have:,} bytes')
+				else:
+					log.info(f'Downloading {url} to the mirror')
+
+				while block := body.read(BLOCK_SIZE):
+					f.write(block)
+					sha256.update(block)
+					md5.update(block)
+
+				size = f.tell()
+
+		if meta['size'] is not None and size != meta['size']:
+			if size > meta['size']:
+				os.remove(part)
+			raise MirrorError(f'Got {size:,} of {meta["size"]:,} bytes: {url}')
+
+		digest = sha256.hexdigest()
+		if checksum is not None and digest != checksum.lower():
+			os.remove(part)
+			raise ChecksumError(f'SHA-256 mismatch, expected {checksum}, got {digest}: {url}')
+
+		if meta.get('md5') and md5.digest() != _decode_md5(meta['md5']):
+			os.remove(part)
+			raise ChecksumError(f'Content-MD5 mismatch: {url}')
+
+		name = f'{digest}{url_suffix(url)}'
+		path = self.object_path(name)
+		if os.path.exists(path):
+			os.remove(part)
+		else:
+			os.replace(part, path)
+		os.remove(meta_path)
+
+		now = time.time()
+		with self.db:
+			self.db.execute(
+				'INSERT OR REPLACE INTO mirrored_files VALUES (?, ?, ?, ?, ?, ?, ?)',
+				(url, name, size, meta.get('etag'), meta.get('last_modified'), now, now),
+			)
+		log.info(f'Mirrored {url} ({size:,} bytes): {path}')
+
+		self.evict(keep = name)
+		return path
+
+	@property
+	def size(self) -> int:
+		return self.db.execute(
+			'SELECT COALESCE(SUM(size), 0) FROM '
+			'(SELECT DISTINCT object, size FROM mirrored_files)'
+		).fetchone()[0]
+
+	def evict(self, reserve: int = 0, keep: str | None = None) -> None:
+		"""
+		Deletes the least recently used files until they take up at most
+		`max_bytes` - `reserve`. The file `keep` stays.
+		"""
+		size = self.size
+		target = self.max_bytes - reserve
+		if size <= target:
+			return
+
+		rows = self.db.execute(
+			'SELECT object, size FROM mirrored_files GROUP BY object ORDER BY MAX(used)'
+		).fetchall()
+		for name, object_size in rows:
+			if size <= target:
+				break
+			if name == keep:
+				continue
+			log.info(f'Evicting {name} from the mirror')
+			self._remove_object(name)
+			size -= object_size
+
+	def _remove_object(self, name: str) -> None:
+		with self.db:
+			self.db.execute('DELETE FROM mirrored_files WHERE object = ?', (name,))
+		# Processes that still have it open keep reading it just fine
+		with contextlib.suppress(FileNotFoundError):
+			os.remove(self.object_path(name))
+
+	def remove(self, url: str) -> None:
+		"""Forgets `url`. Its file goes too, unless another URL has it."""
+		with self.db:
+			self.db.execute('DELETE FROM mirrored_files WHERE url = ?', (url,))
+		self.prune()
+
+	def prune(self) -> None:
+		"""Deletes the files no URL points to any more"""
+		names = {name for name, in self.db.execute('SELECT DISTINCT object FROM mirrored_files')}
+		for name in os.listdir(f'{self.directory}/objects'):
+			if name not in names:
+				os.remove(self.object_path(name))
+
+
+def _same_version(meta: dict, probe: RangeProbe) -> bool:
+	"""
+	Whether the partial download with `meta` is of the file `probe` saw.
+	Without a strong ETag or a Last-Modified date on both sides, that
+	can't be told, so it's taken to be another one.
+	"""
+	if meta.get('size') != probe.size:
+		return False
+	etag = meta.get('etag')
+	if etag and probe.etag and not etag.startswith('W/'):
+		return etag == probe.etag
+	if meta.get('last_modified') and probe.last_modified:
+		return meta['last_modified'] == probe.last_modified
+	return False
+
+
+def _url_key(url: str) -> str:
+	return hashlib.sha256(url.encode('utf-8')).hexdigest()[:32]
+
+
+def _hash_file(path: str, length: int):
+	"""SHA-256 and MD5 hashers fed the first `length` bytes of `path`"""
+	sha256, md5 = hashlib.sha256(), hashlib.md5()
+	if length:
+		with open(path, 'rb') as f:
+			while length > 0 and (block := f.read(min(BLOCK_SIZE, length))):
+				sha256.update(block)
+				md5.update(block)
+				length -= len(block)
+	return sha256, md5
+
+
+def _sha256_file(path: str) -> str:
+	return _hash_file(path, os.path.getsize(path))[0].hexdigest()
+
+
+def _decode_md5(value: str) -> bytes | None:
+	try:
+		return b64decode(value, validate = True)
+	except ValueError:
+		return None
+
+
+@contextlib.contextmanager
+def _locked(path: str):
+	"""Keeps other processes from downloading the same URL at the same time"""
+	with open(path, 'w') as f:
+		if fcntl is not None:
+			fcntl.flock(f, fcntl.LOCK_EX)
+		try:
+			yield
+		finally:
+			if fcntl is not None:
+				fcntl.flock(f, fcntl.LOCK_UN)
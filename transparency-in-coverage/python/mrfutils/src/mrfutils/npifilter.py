@@ -0,0 +1,145 @@
+"""
+NPI filter
+##########
+
+`process_group` used to filter a group's NPIs one at a time:
+
+>>> [n for n in group['npi'] if n in npi_filter]
+
+and it does that for every provider group of every reference and of every
+rate. The same NPI lists also come up over and over again (a group that's
+repeated across rates, or the same providers under many TINs).
+
+`NPIFilter` filters a whole list at once with numpy. A bitmap over the whole
+NPI space would take 250 MB, so instead each NPI is hashed into a bitmap
+about 16 times the size of the filter. Most NPIs that aren't in the filter
+land on a 0 and are dropped right there. The few that remain are looked up
+in a sorted array of the filter's NPIs (`searchsorted`) to get rid of the
+false positives. (`searchsorted` on its own is no faster than the set:
+binary search is all cache misses and unpredictable branches.)
+
+The result for each distinct list is cached, so a list that comes up again
+costs a hash and a dict lookup. The cache is keyed on a 16 byte BLAKE2b
+digest of the list rather than the list itself (a group can have tens of
+thousands of NPIs), and is cleared when it holds `cache_size` lists or
+`cache_bytes` bytes of results.
+
+Short lists are still checked against a set, since numpy's per-call
+overhead isn't worth it for those, and so is everything if numpy isn't
+installed.
+
+Usage:
+
+>>> npi_filter = NPIFilter(import_csv_to_set('npis.csv'))
+>>> npi_filter.filter(array('L', [1111111111, 1234567890]))
+array('L', [1234567890])
+"""
+from __future__ import annotations
+
+import hashlib
+from array import array
+from typing import Iterable
+
+try:
+	import numpy as np
+except ImportError:
+	np = None
+
+CACHE_SIZE = 100_000
+CACHE_BYTES = 64 << 20
+
+# Roughly what a cache entry costs on top of its NPIs
+_ENTRY_BYTES = 200
+
+# Lists shorter than this are filtered with the set
+MIN_VECTOR_SIZE = 256
+
+# Fibonacci hashing
+_HASH_MULTIPLIER = 0x9E3779B97F4A7C15
+
+
+class NPIFilter:
+	"""
+	The NPIs in `npis` (ints or strings). Iterating over it gives the
+	NPIs as sorted ints.
+	"""
+
+	def __init__(self, npis: Iterable, cache_size: int = CACHE_SIZE, cache_bytes: int = CACHE_BYTES):
+		self.npis = frozenset(int(n) for n in npis)
+		self.cache_size = cache_size
+		self.cache_bytes = cache_bytes
+		self.cache: dict[tuple, array] = {}
+		self.cached_bytes = 0
+		self.hits = 0
+		self.misses = 0
+
+		if np is not None:
+			self.sorted = np.array(sorted(self.npis), dtype = np.uint64)
+
+			bits = max(16, (16 * len(self.npis)).bit_length())
+			self.multiplier = np.uint64(_HASH_MULTIPLIER)
+			self.shift = np.uint64(64 - bits)
+			self.bitmap = np.zeros(1 << bits, dtype = bool)
+			self.bitmap[self._hash(self.sorted)] = True
+
+	def _hash(self, values):
+		# Overflow just wraps around
+		return (values * self.multiplier) >> self.shift
+
+	def __contains__(self, npi: int) -> bool:
+		return npi in self.npis
+
+	def __iter__(self):
+		return iter(sorted(self.npis))
+
+	def __len__(self) -> int:
+		return len(self.npis)
+
+	def _filter(self, npis: array) -> array:
+		if np is None or len(npis) < MIN_VECTOR_SIZE or npis.typecode not in 'LQ':
+			keep = self.npis
+			return array(npis.typecode, [n for n in npis if n in keep])
+
+		values = np.frombuffer(npis, dtype = f'u{npis.itemsize}')
+		candidates = values[self.bitmap[self._hash(values.astype(np.uint64))]]
+
+		# Anything past the last NPI gets clipped to it, and won't match
+		i = np.minimum(np.searchsorted(self.sorted, candidates), len(self.sorted) - 1)
+		kept = candidates[self.sorted[i] == candidates]
+
+		filtered = array(npis.typecode)
+		filtered.frombytes(kept.tobytes())
+		return filtered
+
+	def filter(self, npis: array) -> array:
+		"""
+		The NPIs in `npis` (an int array) that are in the filter, in the
+		same order. The result may be shared between calls, so it
+		shouldn't be modified.
+		"""
+		if not self.npis:
+			return array(npis.typecode)
+
+		key = (npis.typecode, hashlib.blake2b(npis, digest_size = 16).digest())
+		filtered = self.cache.get(key)
+		if filtered is not None:
+			self.hits += 1
+			return filtered
+
+		self.misses += 1
+		filtered = self._filter(npis)
+		size = _ENTRY_BYTES + len(filtered) * filtered.itemsize
+		if len(self.cache) >= self.cache_size or self.cached_bytes + size > self.cache_bytes:
+			self.cache.clear()
+			self.cached_bytes = 0
+		self.cache[key] = filtered
+		self.cached_bytes += size
+		return filtered
+
+	# The cache isn't worth sending to other processes
+
+	def __getstate__(self) -> dict:
+		return dict(npis = self.npis, cache_size = self.cache_size, cache_bytes = self.cache_bytes)
+
+	def __setstate__(self, state: dict) -> None:
+		self.__init__(state['npis'], state['cache_size'], state['cache_bytes'])
@@ -0,0 +1,295 @@
+"""
+Parallel range downloads
+########################
+
+A single HTTP stream from a payer's CDN tends to top out well below what
+the connection can do, and a multi-GB in-network file then takes most of an
+hour just to come down the wire.
+
+When the server supports Range requests, `RangeReader` splits the file into
+`chunk_size` byte chunks and downloads up to `connections` of them at once,
+each on its own thread. The chunks are handed back strictly in order, so to
+gzip and ijson it's just a file that gets read from start to end.
+
+At most `max_ahead` chunks (by default twice the connections) are fetched or
+held ahead of the reader, so a slow parser doesn't make it buffer the whole
+file. A chunk that fails (or comes back short) is retried with exponential
+backoff before the error is raised on the reading thread.
+
+`open_ranged` probes the server with a one-byte Range request first (some
+signed URLs only allow GET, so no HEAD), and returns None if it doesn't
+answer with a 206, so the caller can fall back to a single stream.
+
+Every chunk is pinned to the version of the file the probe saw: its ETag
+(If-Match and If-Range), or its Last-Modified date if it has no strong ETag.
+A chunk that comes back as a 412 or 416, as a 200 (the whole file, which
+is what If-Range does when the file changed), with another ETag or with
+another total size raises `FileChanged` instead of being stitched onto
+bytes of the old version.
+
+Usage:
+
+>>> f = open_ranged(url, connections = 8)
+>>> if f is None: f = requests.get(url, stream = True).raw
+>>> gzip.GzipFile(fileobj = f)
+"""
+from __future__ import annotations
+
+import io
+import logging
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import NamedTuple
+
+import requests
+
+log = logging.getLogger(__name__)
+
+CHUNK_SIZE = 8 << 20
+
+RETRY_STATUSES = {408, 429, 500, 502, 503, 504}
+
+_content_range = re.compile(r'bytes\s+\d+-\d+/(\d+)')
+
+
+class RangeError(IOError):
+	"""A Range request that didn't return the bytes it asked for"""
+
+	def __init__(self, message: str, retry: bool = True):
+		super().__init__(message)
+		self.retry = retry
+
+
+class FileChanged(RangeError):
+	"""The file isn't the one the download started on any more"""
+
+	def __init__(self, message: str):
+		super().__init__(message, retry = False)
+
+
+class RangeProbe(NamedTuple):
+	"""What the first Range request found out about a file"""
+	url: str
+	size: int
+	etag: str | None
+	last_modified: str | None
+
+
+def validator_headers(etag: str | None, last_modified: str | None) -> dict[str, str]:
+	"""
+	Headers that keep a Range request from returning bytes of a newer
+	version of the file. If-Range and If-Match need a strong ETag, so a
+	weak one is no use.
+	"""
+	if etag and not etag.startswith('W/'):
+		return {'If-Match': etag, 'If-Range': etag}
+	if last_modified:
+		return {'If-Unmodified-Since': last_modified, 'If-Range': last_modified}
+	return {}
+
+
+class RangeReader(io.RawIOBase):
+	"""
+	Reads `url` (which is `size` bytes long) from `start` on, in parallel
+	byte ranges. See the module docstring.
+	"""
+
+	def __init__(
+		self,
+		url: str,
+		size: int,
+		start: int = 0,
+		connections: int = 8,
+		chunk_size: int = CHUNK_SIZE,
+		max_ahead: int | None = None,
+		retries: int = 4,
+		backoff: float = 1.,
+		timeout: float = 60.,
+		etag: str | None = None,
+		last_modified: str | None = None,
+	):
+		super().__init__()
+		self.url = url
+		self.size = size
+		self.pos = start
+		self.etag = etag
+		self.last_modified = last_modified
+		self.headers = {'Accept-Encoding': 'identity', **validator_headers(etag, last_modified)}
+		self.chunk_size = chunk_size
+		self.max_ahead = max_ahead or 2 * connections
+		self.retries = retries
+		self.backoff = backoff
+		self.timeout = timeout
+
+		# Where the next chunk to be requested starts
+		self.next_start = start
+		self.pending: deque[Future] = deque()
+		self.buf = memoryview(b'')
+
+		# A session per thread, since sessions aren't thread-safe
+		self.local = threading.local()
+		self.sessions: list[requests.Session] = []
+		self.lock = threading.Lock()
+
+		self.pool = ThreadPoolExecutor(connections, thread_name_prefix = 'range')
+		while len(self.pending) < self.max_ahead and self._submit():
+			pass
+
+	def _session(self) -> requests.Session:
+		session = getattr(self.local, 'session', None)
+		if session is None:
+			session = self.local.session = requests.Session()
+			with self.lock:
+				self.sessions.append(session)
+		return session
+
+	def _submit(self) -> bool:
+		if self.next_start >= self.size:
+			return False
+		end = min(self.next_start + self.chunk_size, self.size)
+		self.pending.append(self.pool.submit(self._fetch, self.next_start, end))
+		self.next_start = end
+		return True
+
+	def _get_range(self, start: int, end: int) -> bytes:
+		response = self._session().get(
+			self.url,
+			headers = {**self.headers, 'Range': f'bytes={start}-{end - 1}'},
+			timeout = self.timeout,
+		)
+		with response:
+			if response.status_code in (200, 412, 416):
+				raise FileChanged(f'Range request returned {response.status_code}, the file changed: {self.url}')
+			if response.status_code != 206:
+				raise RangeError(
+					f'Range request returned {response.status_code}: {self.url}',
+					retry = response.status_code in RETRY_STATUSES,
+				)
+
+			# In case the server ignores If-Match and If-Range
+			etag = response.headers.get('ETag')
+			if self.etag and etag and etag != self.etag:
+				raise FileChanged(f'ETag changed from {self.etag} to {etag}: {self.url}')
+			match = _content_range.match(response.headers.get('Content-Range', ''))
+			if match and int(match[1]) != self.size:
+				raise FileChanged(f'Size changed from {self.size:,} to {int(match[1]):,} bytes: {self.url}')
+
+			data = response.content
+		if len(data) != end - start:
+			raise RangeError(f'Got {len(data)} bytes of range {start}-{end - 1}: {self.url}')
+		return data
+
+	def _fetch(self, start: int, end: int) -> bytes:
+		for attempt in range(self.retries + 1):
+			try:
+				return self._get_range(start, end)
+			except (requests.RequestException, RangeError) as e:
+				if self.closed or not getattr(e, 'retry', True) or attempt == self.retries:
+					raise
+				delay = self.backoff * 2 ** attempt
+				log.debug(f'Retrying range {start}-{end - 1} in {delay:.1f}s after {e!r}')
+				time.sleep(delay)
+
+	def readable(self) -> bool:
+		return True
+
+	def readinto(self, b) -> int:
+		if not self.buf:
+			if not self.pending:
+				return 0
+			# Raises whatever the chunk failed with
+			self.buf = memoryview(self.pending.popleft().result())
+			self._submit()
+
+		n = min(len(b), len(self.buf))
+		b[:n] = self.buf[:n]
+		self.buf = self.buf[n:]
+		self.pos += n
+		return n
+
+	def tell(self) -> int:
+		return self.pos
+
+	def close(self) -> None:
+		if self.closed:
+			return
+		super().close()
+		for future in self.pending:
+			future.cancel()
+		self.pending.clear()
+		self.buf = memoryview(b'')
+		# The pending futures are cancelled already (cancel_futures
+		# would need Python 3.9)
+		self.pool.shutdown(wait = False)
+		with self.lock:
+			for session in self.sessions:
+				session.close()
+
+
+def probe_ranges(url: str, session: requests.Session | None = None) -> RangeProbe | None:
+	"""
+	Asks for the first byte of `url`. Returns the URL it ended up at
+	(after redirects), the size of the file and its validators if the
+	server answered with a 206 and a usable Content-Range, None
+	otherwise.
+	"""
+	get = (session or requests).get
+	try:
+		response = get(url, headers = {'Range': 'bytes=0-0', 'Accept-Encoding': 'identity'}, timeout = 60)
+	except requests.RequestException as e:
+		log.debug(f'Range probe failed: {url}: {e!r}')
+		return None
+
+	with response:
+		if (
+			response.status_code != 206
+			or response.headers.get('Content-Encoding', 'identity') != 'identity'
+		):
+			return None
+		match = _content_range.match(response.headers.get('Content-Range', ''))
+		if not match:
+			return None
+		return RangeProbe(
+			response.url,
+			int(match[1]),
+			response.headers.get('ETag'),
+			response.headers.get('Last-Modified'),
+		)
+
+
+def open_ranged(
+	url: str,
+	start: int = 0,
+	connections: int = 8,
+	session: requests.Session | None = None,
+	**options,
+) -> RangeReader | None:
+	"""
+	A RangeReader for `url` from byte `start` on, or None if the server
+	doesn't do Range requests. `options` go to RangeReader.
+	"""
+	probe = probe_ranges(url, session)
+	if probe is None:
+		log.info(f'No Range support, using a single stream: {url}')
+		return None
+
+	return open_probed(probe, start, connections, **options)
+
+
+def open_probed(probe: RangeProbe, start: int = 0, connections: int = 8, **options) -> RangeReader:
+	"""A RangeReader for the file `probe` found, pinned to its version"""
+	log.info(f'Downloading {probe.size:,} bytes over {connections} connections: {probe.url}')
+	if not validator_headers(probe.etag, probe.last_modified):
+		log.warning(f'No ETag or Last-Modified, a change to the file may go unnoticed: {probe.url}')
+	return RangeReader(
+		probe.url,
+		probe.size,
+		start,
+		connections,
+		etag = probe.etag,
+		last_modified = probe.last_modified,
+		**options,
+	)
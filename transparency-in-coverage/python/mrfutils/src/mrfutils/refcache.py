@@ -0,0 +1,235 @@
+"""
+Remote reference cache
+######################
+
+Provider references can point to a remote JSON file (a `location`) instead of
+listing their groups inline. Payers tend to point all of their in-network files
+at the same few thousand of those, so flattening a whole table of contents
+downloads each of them over and over again.
+
+`ReferenceCache` keeps the processed (NPI-filtered) groups of each remote
+reference in a SQLite database, keyed on the URL and the NPI filter. Along
+with them it keeps the ETag and Last-Modified headers of the response, so
+that a cached reference can be revalidated with a conditional request
+(a 304 costs no download). With `max_age`, entries younger than that many
+seconds are used without asking the server at all.
+
+When the cached groups take up more than `max_bytes`, the least recently
+used entries are evicted.
+
+Hits don't write to the database one at a time: the times they were used
+(and revalidated) are kept in memory and written in batches of
+`batch_size`, and on `close`, which has to be called for the next run to
+see them.
+
+Usage:
+
+>>> cache = ReferenceCache('refcache.db', npi_filter)
+>>> entry = cache.lookup(url)
+>>> if entry and cache.is_fresh(entry): groups = cache.hit(url, entry)
+>>> else: response = get(url, headers = cache.conditional_headers(entry)) ...
+>>> cache.stats
+{'hits': 1200, 'revalidated': 1150, 'misses': 30}
+>>> cache.close()
+"""
+from __future__ import annotations
+
+import json
+import logging
+import sqlite3
+import time
+from typing import NamedTuple
+
+from mrfutils.references import dump_groups, gen_loaded_groups, npi_filter_key
+
+log = logging.getLogger(__name__)
+
+
+CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS remote_references (
+	url TEXT NOT NULL,
+	npi_filter TEXT NOT NULL,
+	groups TEXT NOT NULL,
+	etag TEXT,
+	last_modified TEXT,
+	fetched REAL NOT NULL,
+	used REAL NOT NULL,
+	size INTEGER NOT NULL,
+	PRIMARY KEY (url, npi_filter)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS remote_references_used ON remote_references (used);
+"""
+
+
+class CachedReference(NamedTuple):
+	groups: str
+	etag: str | None
+	last_modified: str | None
+	fetched: float
+
+
+class ReferenceCache:
+	"""
+	On-disk cache of processed remote references for one NPI filter.
+
+	`max_bytes` bounds the size of the stored groups (not counting
+	SQLite's overhead). `max_age` is how long, in seconds, an entry is
+	trusted without revalidating it; by default every entry is
+	revalidated.
+	"""
+
+	def __init__(
+		self,
+		path: str,
+		npi_filter: set | None = None,
+		max_bytes: int = 1 << 30,
+		max_age: float = 0.,
+		batch_size: int = 1_000,
+	):
+		self.path = path
+		self.filter_key = npi_filter_key(npi_filter)
+		self.max_bytes = max_bytes
+		self.max_age = max_age
+		self.batch_size = batch_size
+
+		# url: (used, fetched), fetched being None unless revalidated
+		self.pending: dict[str, tuple[float, float | None]] = {}
+
+		self.hits = 0
+		self.revalidated = 0
+		self.misses = 0
+
+		# Several processes (see batch.py) can share the cache
+		self.db = sqlite3.connect(path, timeout = 60)
+		self.db.execute('PRAGMA journal_mode = WAL')
+		self.db.executescript(CACHE_SCHEMA)
+		self.size = self._stored_size()
+
+	def _stored_size(self) -> int:
+		return self.db.execute('SELECT COALESCE(SUM(size), 0) FROM remote_references').fetchone()[0]
+
+	def lookup(self, url: str) -> CachedReference | None:
+		row = self.db.execute(
+			'SELECT groups, etag, last_modified, fetched FROM remote_references '
+			'WHERE url = ? AND npi_filter = ?',
+			(url, self.filter_key),
+		).fetchone()
+		if row is None:
+			return
+		entry = CachedReference(*row)
+		if url in self.pending and self.pending[url][1] is not None:
+			entry = entry._replace(fetched = self.pending[url][1])
+		return entry
+
+	def is_fresh(self, entry: CachedReference) -> bool:
+		return time.time() - entry.fetched < self.max_age
+
+	@staticmethod
+	def conditional_headers(entry: CachedReference | None) -> dict[str, str]:
+		"""Headers that make the server answer 304 if `entry` is still good"""
+		headers = {}
+		if entry is not None:
+			if entry.etag:
+				headers['If-None-Match'] = entry.etag
+			if entry.last_modified:
+				headers['If-Modified-Since'] = entry.last_modified
+		return headers
+
+	def hit(self, url: str, entry: CachedReference, revalidated: bool = False) -> list[dict]:
+		"""
+		Records a use of `entry` and returns its groups. `revalidated`
+		means the server just confirmed it (304), which restarts its
+		max_age.
+		"""
+		self.hits += 1
+		now = time.time()
+		if revalidated:
+			self.revalidated += 1
+			self.pending[url] = (now, now)
+		else:
+			fetched = self.pending[url][1] if url in self.pending else None
+			self.pending[url] = (now, fetched)
+
+		if len(self.pending) >= self.batch_size:
+			self.flush()
+		return list(gen_loaded_groups(json.loads(entry.groups)))
+
+	def flush(self) -> None:
+		"""Writes down when the entries that were hit were used and revalidated"""
+		if not self.pending:
+			return
+		with self.db:
+			self.db.executemany(
+				'UPDATE remote_references SET used = ?, fetched = COALESCE(?, fetched) '
+				'WHERE url = ? AND npi_filter = ?',
+				[(used, fetched, url, self.filter_key) for url, (used, fetched) in self.pending.items()],
+			)
+		self.pending.clear()
+
+	def store(self, url: str, groups: list[dict] | None, headers) -> None:
+		"""
+		Caches the processed `groups` of a reference (None or [] if the
+		NPI filter removed all of them) fetched from `url`. `headers` are
+		the response headers.
+		"""
+		self.misses += 1
+		self.pending.pop(url, None)
+		data = dump_groups(groups or [])
+		now = time.time()
+		with self.db:
+			# A refetched entry replaces the old one, and its size
+			replaced = self.db.execute(
+				'SELECT size FROM remote_references WHERE url = ? AND npi_filter = ?',
+				(url, self.filter_key),
+			).fetchone()
+			self.db.execute(
+				'INSERT OR REPLACE INTO remote_references VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+				(
+					url,
+					self.filter_key,
+					data,
+					headers.get('ETag'),
+					headers.get('Last-Modified'),
+					now,
+					now,
+					len(data),
+				),
+			)
+		self.size += len(data) - (replaced[0] if replaced else 0)
+
+		if self.size > self.max_bytes:
+			self.evict()
+
+	def evict(self) -> None:
+		"""Removes the least recently used entries until we're 10% under budget"""
+		self.flush()
+		self.size = self._stored_size()
+		target = self.max_bytes * .9
+		if self.size <= target:
+			return
+
+		rows = self.db.execute(
+			'SELECT url, npi_filter, size FROM remote_references ORDER BY used'
+		).fetchall()
+		evict = []
+		for url, filter_key, size in rows:
+			if self.size <= target:
+				break
+			evict.append((url, filter_key))
+			self.size -= size
+
+		with self.db:
+			self.db.executemany(
+				'DELETE FROM remote_references WHERE url = ? AND npi_filter = ?',
+				evict,
+			)
+		log.debug(f'Evicted {len(evict)} cached references')
+
+	@property
+	def stats(self) -> dict[str, int]:
+		return dict(hits = self.hits, revalidated = self.revalidated, misses = self.misses)
+
+	def close(self) -> None:
+		self.flush()
+		self.db.close()
@@ -0,0 +1,385 @@
+"""
+Reference store
+###############
+
+The reference map used to be a dict like
+
+>>> {provider_group_id: [{'npi': array('L', [...]), 'tin': {...}}, ...]}
+
+which, on files with hundreds of thousands of provider references, takes many
+GB of small Python objects before a single in-network item gets written.
+
+`ReferenceStore` holds the same data in a few flat arrays:
+
+* TINs are interned: each distinct (type, value) gets an integer ID
+* the NPIs of all the groups live in one array, and each group is a
+  (TIN ID, start, length) slice of it
+* each provider_group_id maps to a (first group, number of groups) slice
+  of the groups. The IDs usually come in increasing order, in which case
+  they're kept in a sorted array too, and only switch to a dict if they
+  don't
+
+Groups are only turned back into dicts while the rates that reference them
+are being processed.
+
+For reference sections that don't fit in memory even like that,
+`DiskReferenceStore` keeps them in a SQLite database instead, with an LRU of
+the hot references in front of it. The database can be kept around and
+reused: a reference map that was completed in an earlier run (for the same
+file and NPI filter) doesn't have to be built again.
+
+Usage:
+
+>>> store = ReferenceStore()
+>>> store.add(provider_group_id, provider_groups)
+>>> rate['provider_groups'] = store.resolve(rate.get('provider_groups'), references)
+"""
+from __future__ import annotations
+
+import collections
+import hashlib
+import json
+import os
+import sqlite3
+from array import array
+from bisect import bisect_left
+from typing import Generator
+
+
+class ResolvedGroups:
+	"""
+	The provider groups of a rate: its own `groups`, then the groups of
+	each of its `references`. The referenced groups are made into dicts
+	as they're iterated over, so nothing gets copied up front.
+	"""
+
+	def __init__(self, store: ReferenceStore, groups: list[dict], references: list[int]):
+		self.store = store
+		self.groups = groups
+		self.references = references
+
+	def __len__(self) -> int:
+		n_groups = self.store.n_groups
+		return len(self.groups) + sum(n_groups(ref) for ref in self.references)
+
+	def __iter__(self) -> Generator[dict]:
+		yield from self.groups
+		for reference in self.references:
+			yield from self.store.gen_groups(reference)
+
+
+class ReferenceStore:
+	"""
+	Compact map from provider_group_id to provider groups. Groups that
+	are added must have been processed already (NPIs as ints).
+
+	Adding the same provider_group_id twice replaces its groups.
+	"""
+
+	def __init__(self):
+		self.tin_ids: dict[tuple, int] = {}
+		self.tins: list[tuple] = []
+
+		# NPIs are 10 digits starting with 1 or 2, so they fit in 32 bits
+		self.npis = array('I')
+		self.group_tins = array('I')
+		self.group_starts = array('Q')
+		self.group_lengths = array('I')
+
+		# Sorted IDs, or the ID -> index dict once they turn out not to be
+		self.ref_ids = array('Q')
+		self.ref_index: dict | None = None
+		self.ref_firsts = array('Q')
+		self.ref_lengths = array('I')
+
+	def _intern_tin(self, tin: dict) -> int:
+		key = (tin['type'], tin['value'])
+		tin_id = self.tin_ids.get(key)
+		if tin_id is None:
+			tin_id = self.tin_ids[key] = len(self.tins)
+			self.tins.append(key)
+		return tin_id
+
+	def _find(self, group_id: int) -> int | None:
+		if self.ref_index is not None:
+			return self.ref_index.get(group_id)
+
+		if not isinstance(group_id, int):
+			return
+		i = bisect_left(self.ref_ids, group_id)
+		if i < len(self.ref_ids) and self.ref_ids[i] == group_id:
+			return i
+
+	def _add_id(self, group_id: int) -> None:
+		if self.ref_index is None:
+			ref_ids = self.ref_ids
+			if (
+				isinstance(group_id, int)
+				and 0 <= group_id < 1 << 64
+				and (not ref_ids or group_id > ref_ids[-1])
+			):
+				ref_ids.append(group_id)
+				return
+
+			self.ref_index = {ref_id: i for i, ref_id in enumerate(ref_ids)}
+			self.ref_ids = None
+
+		self.ref_index[group_id] = len(self.ref_firsts)
+
+	def add(self, group_id: int, groups: list[dict]) -> None:
+		self._add_id(group_id)
+		self.ref_firsts.append(len(self.group_tins))
+		self.ref_lengths.append(len(groups))
+
+		for group in groups:
+			self.group_tins.append(self._intern_tin(group['tin']))
+			self.group_starts.append(len(self.npis))
+			self.group_lengths.append(len(group['npi']))
+			npis = list(group['npi'])
+			try:
+				self.npis.fromlist(npis)
+			except OverflowError:
+				# Not a real NPI, but we don't throw data away
+				self.npis = array('Q', self.npis)
+				self.npis.fromlist(npis)
+
+	def __len__(self) -> int:
+		if self.ref_index is None:
+			return len(self.ref_ids)
+		return len(self.ref_index)
+
+	def __contains__(self, group_id: int) -> bool:
+		return self._find(group_id) is not None
+
+	def n_groups(self, group_id: int) -> int:
+		i = self._find(group_id)
+		return 0 if i is None else self.ref_lengths[i]
+
+	def gen_groups(self, group_id: int) -> Generator[dict]:
+		i = self._find(group_id)
+		if i is None:
+			return
+
+		first = self.ref_firsts[i]
+		for g in range(first, first + self.ref_lengths[i]):
+			start = self.group_starts[g]
+			tin_type, tin_value = self.tins[self.group_tins[g]]
+			yield {
+				'npi': array('L', self.npis[start:start + self.group_lengths[g]]),
+				'tin': {'type': tin_type, 'value': tin_value},
+			}
+
+	def get(self, group_id: int, default = None) -> list[dict] | None:
+		if group_id not in self:
+			return default
+		return list(self.gen_groups(group_id))
+
+	def resolve(self, groups: list[dict] | None, references: list[int]) -> ResolvedGroups:
+		return ResolvedGroups(self, groups or [], references)
+
+
+DISK_SCHEMA = """
+CREATE TABLE IF NOT EXISTS reference_map (
+	id INTEGER PRIMARY KEY,
+	source TEXT NOT NULL,
+	npi_filter TEXT NOT NULL,
+	complete INTEGER NOT NULL DEFAULT 0,
+	UNIQUE (source, npi_filter)
+);
+
+CREATE TABLE IF NOT EXISTS provider_groups (
+	map_id INTEGER NOT NULL,
+	group_id NOT NULL,
+	groups TEXT NOT NULL,
+	PRIMARY KEY (map_id, group_id)
+) WITHOUT ROWID;
+"""
+
+
+def dump_groups(groups: list[dict]) -> str:
+	"""Groups as JSON: [[tin_type, tin_value, [npi, ...]], ...]"""
+	return json.dumps([
+		[group['tin']['type'], group['tin']['value'], list(group['npi'])]
+		for group in groups
+	])
+
+
+def gen_loaded_groups(data: list) -> Generator[dict]:
+	"""Turns groups decoded from dump_groups' JSON back into dicts"""
+	for tin_type, tin_value, npis in data:
+		yield {
+			'npi': array('L', npis),
+			'tin': {'type': tin_type, 'value': tin_value},
+		}
+
+
+def npi_filter_key(npi_filter: set | None) -> str:
+	"""Short, stable fingerprint of an NPI filter ('' for no filter)"""
+	if not npi_filter:
+		return ''
+	data = ','.join(str(npi) for npi in sorted(int(n) for n in npi_filter))
+	return hashlib.sha256(data.encode()).hexdigest()[:16]
+
+
+def code_filter_key(code_filter: set | None) -> str:
+	"""Same, for a code filter of (billing_code_type, billing_code) tuples"""
+	if not code_filter:
+		return ''
+	data = ','.join(sorted(f'{code_type}:{code}' for code_type, code in code_filter))
+	return hashlib.sha256(data.encode()).hexdigest()[:16]
+
+
+class DiskReferenceStore:
+	"""
+	Reference map kept in the SQLite database at `path`, with the
+	`cache_size` most recently used references cached in memory. Same
+	interface as ReferenceStore.
+
+	One database can hold the maps of many files. Each one is keyed on the
+	file (`source`, e.g. the file ID and helpers.file_version, so that a
+	re-published file doesn't get a stale map) and on the NPI filter it
+	was built with, since the stored groups have been filtered already. `complete`
+	says whether the map was finished, possibly by an earlier run, in
+	which case it can be used as is. Otherwise, `clear` it and `add` the
+	references, then call `finish`.
+
+	Each row stores the groups of one reference as JSON (see
+	dump_groups).
+	"""
+
+	def __init__(
+		self,
+		path: str,
+		source,
+		npi_filter: set | None = None,
+		cache_size: int = 10_000,
+		batch_size: int = 1_000,
+	):
+		self.path = path
+		self.source = str(source)
+		self.filter_key = npi_filter_key(npi_filter)
+		self.cache_size = cache_size
+		self.batch_size = batch_size
+		self._connect()
+
+	def _connect(self) -> None:
+		self.conn = sqlite3.connect(self.path)
+		self.pid = os.getpid()
+		self.pending: list[tuple] = []
+		self.cache = collections.OrderedDict()
+
+		self.conn.executescript(DISK_SCHEMA)
+		with self.conn:
+			self.conn.execute(
+				'INSERT OR IGNORE INTO reference_map (source, npi_filter) VALUES (?, ?)',
+				(self.source, self.filter_key),
+			)
+		self.map_id, complete = self.conn.execute(
+			'SELECT id, complete FROM reference_map WHERE source = ? AND npi_filter = ?',
+			(self.source, self.filter_key),
+		).fetchone()
+		self.complete = bool(complete)
+
+	@property
+	def db(self) -> sqlite3.Connection:
+		# SQLite connections can't be shared with forked processes
+		if os.getpid() != self.pid:
+			self._connect()
+		return self.conn
+
+	def clear(self) -> None:
+		"""Removes what's stored for this map, e.g. from an unfinished run"""
+		self.pending = []
+		self.cache.clear()
+		with self.db:
+			self.db.execute('DELETE FROM provider_groups WHERE map_id = ?', (self.map_id,))
+			self.db.execute('UPDATE reference_map SET complete = 0 WHERE id = ?', (self.map_id,))
+		self.complete = False
+
+	def add(self, group_id: int, groups: list[dict]) -> None:
+		self.pending.append((self.map_id, group_id, dump_groups(groups)))
+		self.cache.pop(group_id, None)
+
+		if len(self.pending) >= self.batch_size:
+			self.flush()
+
+	def flush(self) -> None:
+		if not self.pending:
+			return
+		with self.db:
+			self.db.executemany(
+				'INSERT OR REPLACE INTO provider_groups VALUES (?, ?, ?)',
+				self.pending,
+			)
+		self.pending = []
+
+	def finish(self) -> None:
+		"""Marks the map as complete, so that later runs can reuse it"""
+		self.flush()
+		with self.db:
+			self.db.execute('UPDATE reference_map SET complete = 1 WHERE id = ?', (self.map_id,))
+		self.complete = True
+
+	def _lookup(self, group_id: int) -> list | None:
+		cache = self.cache
+		if group_id in cache:
+			cache.move_to_end(group_id)
+			return cache[group_id]
+
+		self.flush()
+		row = self.db.execute(
+			'SELECT groups FROM provider_groups WHERE map_id = ? AND group_id = ?',
+			(self.map_id, group_id),
+		).fetchone()
+
+		# Misses get cached too
+		groups = None if row is None else json.loads(row[0])
+		cache[group_id] = groups
+		if len(cache) > self.cache_size:
+			cache.popitem(last = False)
+		return groups
+
+	def __len__(self) -> int:
+		self.flush()
+		return self.db.execute(
+			'SELECT COUNT(*) FROM provider_groups WHERE map_id = ?',
+			(self.map_id,),
+		).fetchone()[0]
+
+	def __contains__(self, group_id: int) -> bool:
+		return self._lookup(group_id) is not None
+
+	def n_groups(self, group_id: int) -> int:
+		groups = self._lookup(group_id)
+		return 0 if groups is None else len(groups)
+
+	def gen_groups(self, group_id: int) -> Generator[dict]:
+		yield from gen_loaded_groups(self._lookup(group_id) or [])
+
+	def get(self, group_id: int, default = None) -> list[dict] | None:
+		if group_id not in self:
+			return default
+		return list(self.gen_groups(group_id))
+
+	def resolve(self, groups: list[dict] | None, references: list[int]) -> ResolvedGroups:
+		return ResolvedGroups(self, groups or [], references)
+
+	def close(self) -> None:
+		self.flush()
+		self.db.close()
+
+	# Pickles (e.g. for checkpoints) only hold on to where the map is
+
+	def __getstate__(self) -> dict:
+		self.flush()
+		return dict(
+			path = self.path,
+			source = self.source,
+			filter_key = self.filter_key,
+			cache_size = self.cache_size,
+			batch_size = self.batch_size,
+		)
+
+	def __setstate__(self, state: dict) -> None:
+		self.__dict__.update(state)
+		self._connect()
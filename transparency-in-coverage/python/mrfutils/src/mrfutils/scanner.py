@@ -0,0 +1,658 @@
+"""
+Byte-level scanning
+###################
+
+ijson has to produce an event for every token in the file, even the ones we're
+about to throw away. When `skip_item_by_code` rejects an in-network item, the
+parser still has to chew through every rate and provider group in it before
+we get to the next item.
+
+The functions here work on the raw (decompressed) bytes instead. To find where a
+JSON value ends you only need to keep track of three things:
+
+* the depth ({ and [ go up, } and ] go down)
+* whether you're inside a string (brackets inside strings don't count)
+* whether a quote is escaped (\\" doesn't end a string)
+
+If numpy is installed the scan is vectorized, otherwise it falls back to a
+pure-python scan built on `re`.
+
+`ScanningParser` uses this to split the top-level arrays of an MRF
+(`provider_references`, `in_network`) into items, and parses each item with a
+fresh parser. It produces the same events as `ijson.parse`, but an item can be
+dropped without parsing the rest of it:
+
+>>> parser = ScanningParser('in-network-rates.json.gz')
+>>> for prefix, event, value in parser:
+>>> 	if some_condition:
+>>> 		parser.skip_item()
+"""
+from __future__ import annotations
+
+import json
+import re
+import tempfile
+from typing import Callable, Generator
+
+import ijson
+
+from mrfutils import helpers
+from mrfutils.exceptions import InvalidMRF
+from mrfutils.helpers import JSONOpen, open_json, validate_url
+
+try:
+	import numpy as np
+except ImportError:
+	np = None
+
+OPEN_BRACE, CLOSE_BRACE = ord('{'), ord('}')
+OPEN_BRACKET, CLOSE_BRACKET = ord('['), ord(']')
+QUOTE, BACKSLASH = ord('"'), ord('\\')
+
+_WHITESPACE = re.compile(rb'[ \t\n\r]*')
+_STRUCTURAL = re.compile(rb'[\[\]{}"]')
+# The rest of a string, up to and including the closing quote
+_STRING_REST = re.compile(rb'[^"\\]*(?:\\.[^"\\]*)*"', re.DOTALL)
+_SCALAR = re.compile(rb'[^ \t\n\r,\]}]*')
+
+
+def _scan_py(
+	buf: bytes,
+	pos: int,
+	end: int,
+	depth: int,
+	in_string: bool,
+) -> tuple[int, int, int, bool]:
+	"""
+	Scans buf[pos:end] for the bracket that takes `depth` to zero.
+
+	Returns (value_end, resume, depth, in_string). `value_end` is the index
+	just past the closing bracket, or -1 if the value doesn't end in this
+	range. In that case, scanning should carry on from `resume` with the
+	returned depth and in_string once there's more data.
+	"""
+	while True:
+		if in_string:
+			m = _STRING_REST.match(buf, pos, end)
+			if m is None:
+				# The string doesn't end here. Rescan it from the
+				# start once we have more data.
+				return -1, pos, depth, True
+			pos = m.end()
+			in_string = False
+
+		m = _STRUCTURAL.search(buf, pos, end)
+		if m is None:
+			return -1, end, depth, False
+
+		pos = m.end()
+		c = buf[pos - 1]
+		if c == QUOTE:
+			in_string = True
+		elif c == OPEN_BRACE or c == OPEN_BRACKET:
+			depth += 1
+		else:
+			depth -= 1
+			if depth == 0:
+				return pos, pos, 0, False
+
+
+if np is not None:
+	# 1 = opening bracket, 2 = closing bracket, 3 = quote, 4 = backslash
+	_CLASSES = np.zeros(256, dtype = np.int8)
+	_CLASSES[[OPEN_BRACE, OPEN_BRACKET]] = 1
+	_CLASSES[[CLOSE_BRACE, CLOSE_BRACKET]] = 2
+	_CLASSES[QUOTE] = 3
+	_CLASSES[BACKSLASH] = 4
+
+
+class _BracketIndex:
+	"""
+	Vectorized index of the brackets in buf[base:end] (numpy only).
+
+	`positions` holds the positions of the brackets that aren't inside
+	strings and `depths` holds the depth right after each one, counting
+	from zero at `base`. Finding the end of a value is then a search for
+	the first bracket that brings the depth back down, which is cheap
+	enough to do once per item.
+	"""
+
+	def __init__(self, buf: bytes, base: int, in_string: bool):
+		end = len(buf)
+		# Don't split up an escape sequence. Backslashes only show up
+		# inside strings, so leaving them for the next index is safe
+		while end > base and buf[end - 1] == BACKSLASH:
+			end -= 1
+		self.end = end
+
+		a = np.frombuffer(buf, dtype = np.uint8, count = end - base, offset = base)
+		classes = np.take(_CLASSES, a)
+		positions = np.flatnonzero(classes)
+		classes = classes[positions]
+
+		quotes = classes == 3
+		backslashes = classes == 4
+		if backslashes.any():
+			# A character is escaped if it comes right after a run of
+			# backslashes of odd length. Number the backslashes within
+			# each run; the even-numbered ones escape the next character
+			n = len(positions)
+			adjacent = np.zeros(n, dtype = bool)
+			adjacent[1:] = np.diff(positions) == 1
+			run_starts = backslashes.copy()
+			run_starts[1:] &= ~(backslashes[:-1] & adjacent[1:])
+			idx = np.arange(n)
+			last_start = np.maximum.accumulate(np.where(run_starts, idx, 0))
+			escaping = backslashes & ((idx - last_start) % 2 == 0)
+			quotes[1:] &= ~(escaping[:-1] & adjacent[1:])
+
+		string_parity = np.cumsum(quotes, dtype = np.int32)
+		if in_string:
+			string_parity += 1
+		self.in_string = bool(string_parity[-1] & 1) if len(positions) else in_string
+
+		outside = (string_parity & 1) == 0
+		brackets = ((classes == 1) | (classes == 2)) & outside
+		delta = np.where(classes[brackets] == 1, 1, -1).astype(np.int32)
+
+		self.positions = positions[brackets] + base
+		self.depths = np.cumsum(delta, dtype = np.int32)
+
+	def find_close(self, k: int, target: int) -> int:
+		"""Index of the first bracket from k on where the depth is target"""
+		window = 64
+		depths = self.depths
+		while k < len(depths):
+			hits = np.flatnonzero(depths[k:k + window] == target)
+			if len(hits):
+				return k + int(hits[0])
+			k += window
+			window *= 4
+		return -1
+
+
+class JSONScanner:
+	"""
+	Walks through a JSON document one value at a time, without parsing it.
+
+	`tell` gives the offset (in decompressed bytes) of the next byte that
+	hasn't been consumed.
+	"""
+
+	def __init__(self, f, chunk_size: int = 1 << 20):
+		self.f = f
+		self.chunk_size = chunk_size
+		self.buf = b''
+		self.pos = 0
+		# Offset of buf[0] in the document
+		self.offset = 0
+		self.eof = False
+		self.index: _BracketIndex | None = None
+
+	def tell(self) -> int:
+		return self.offset + self.pos
+
+	def _fill(self) -> bool:
+		"""Reads another chunk, dropping everything before self.pos"""
+		if self.eof:
+			return False
+
+		chunk = self.f.read(self.chunk_size)
+		if not chunk:
+			self.eof = True
+			return False
+
+		self.offset += self.pos
+		self.buf = self.buf[self.pos:] + chunk
+		self.pos = 0
+		self.index = None
+		return True
+
+	def peek(self) -> int | None:
+		"""Skips whitespace and returns the next byte (None at EOF)"""
+		while True:
+			self.pos = _WHITESPACE.match(self.buf, self.pos).end()
+			if self.pos < len(self.buf):
+				return self.buf[self.pos]
+			if not self._fill():
+				return None
+
+	def expect(self, char: bytes) -> None:
+		if self.peek() != ord(char):
+			raise InvalidMRF(f'Expected {char} at offset {self.tell()}')
+		self.pos += 1
+
+	def _read_token(self, pattern: re.Pattern, start: int) -> bytes:
+		"""Reads a string (pattern = _STRING_REST) or a scalar"""
+		while True:
+			m = pattern.match(self.buf, start)
+			if m and (m.end() < len(self.buf) or self.eof):
+				token = self.buf[self.pos:m.end()]
+				self.pos = m.end()
+				return token
+			offset = start - self.pos
+			if not self._fill():
+				if m is None:
+					raise InvalidMRF(f'Unterminated string at offset {self.tell()}')
+				continue
+			start = self.pos + offset
+
+	def read_string(self) -> bytes:
+		"""Reads a string, quotes and all"""
+		if self.peek() != QUOTE:
+			raise InvalidMRF(f'Expected a string at offset {self.tell()}')
+		return self._read_token(_STRING_REST, self.pos + 1)
+
+	def _scan_value(self, write: Callable | None) -> None:
+		"""
+		Scans past the next value, passing its bytes to `write` in one or
+		more pieces (unless write is None).
+		"""
+		c = self.peek()
+		if c is None:
+			raise InvalidMRF('Unexpected end of file')
+
+		if c == QUOTE:
+			token = self.read_string()
+		elif c != OPEN_BRACE and c != OPEN_BRACKET:
+			token = self._read_token(_SCALAR, self.pos)
+		elif np is None:
+			return self._scan_compound_py(write)
+		else:
+			return self._scan_compound_np(write)
+
+		if write is not None:
+			write(token)
+
+	def _scan_compound_py(self, write: Callable | None) -> None:
+		depth, in_string = 0, False
+		start = resume = self.pos
+
+		while True:
+			value_end, resume, depth, in_string = _scan_py(
+				self.buf, resume, len(self.buf), depth, in_string
+			)
+
+			if value_end != -1:
+				if write is not None:
+					write(self.buf[start:value_end])
+				self.pos = value_end
+				return
+
+			# Out of data. Hand over what we have and start a new
+			# buffer, carrying over anything the scan couldn't consume
+			if write is not None:
+				write(self.buf[start:resume])
+			self.pos = resume
+			if not self._fill():
+				raise InvalidMRF('Unexpected end of file')
+			start = resume = 0
+
+	def _scan_compound_np(self, write: Callable | None) -> None:
+		if self.index is None:
+			# self.pos is always between tokens, so not in a string
+			self.index = _BracketIndex(self.buf, self.pos, False)
+
+		start = self.pos
+		index = self.index
+		k = int(np.searchsorted(index.positions, start))
+		target = index.depths[k] - 1
+
+		while True:
+			close = index.find_close(k, target)
+
+			if close != -1:
+				value_end = int(index.positions[close]) + 1
+				if write is not None:
+					write(self.buf[start:value_end])
+				self.pos = value_end
+				return
+
+			# Out of data. Hand over what we have and index a new
+			# buffer, carrying over the depth and string state
+			if write is not None:
+				write(self.buf[start:index.end])
+			depth = (int(index.depths[-1]) if len(index.depths) else 0) - target
+			self.pos = index.end
+			if not self._fill():
+				raise InvalidMRF('Unexpected end of file')
+			self.index = index = _BracketIndex(self.buf, 0, index.in_string)
+			start = k = 0
+			target = -depth
+
+	def read_value(self) -> bytes:
+		"""Returns the raw bytes of the next value"""
+		parts = []
+		self._scan_value(parts.append)
+		return b''.join(parts)
+
+	def skip_value(self) -> None:
+		"""Like read_value, but doesn't keep the bytes around"""
+		self._scan_value(None)
+
+	def copy_value(self, f) -> None:
+		"""Like read_value, but writes the bytes to `f` as it goes"""
+		self._scan_value(f.write)
+
+
+class _GrowingReader:
+	"""
+	File-like wrapper around bytes that hands them out in small reads
+	first. Parsers tokenize everything they read in one go, so this keeps
+	them from tokenizing an item that we're going to skip after seeing its
+	billing code.
+	"""
+
+	def __init__(self, data: bytes, first_read: int = 1 << 10):
+		self.data = data
+		self.pos = 0
+		self.size = first_read
+
+	def read(self, n: int = -1) -> bytes:
+		if n == 0:
+			return b''
+		if n < 0:
+			n = len(self.data)
+		size = min(n, self.size)
+		self.size *= 4
+		chunk = self.data[self.pos:self.pos + size]
+		self.pos += len(chunk)
+		return chunk
+
+
+class _RangeReader:
+	"""
+	File-like object that reads `head`, `length` bytes of `f` (or all of
+	it, if `length` is None), then `tail`.
+
+	`base_offset` is the offset in the original file that corresponds to
+	the start of this reader, so that a ScanningParser reading it can
+	report offsets in the original file.
+	"""
+
+	def __init__(
+		self,
+		f,
+		length: int | None,
+		head: bytes = b'',
+		tail: bytes = b'',
+		on_close: Callable | None = None,
+		base_offset: int = 0,
+	):
+		self.f = f
+		self.remaining = length
+		self.head = head
+		self.tail = tail
+		self.on_close = on_close
+		self.base_offset = base_offset
+
+	def read(self, n: int = -1) -> bytes:
+		if n is None or n < 0:
+			return b''.join(iter(lambda: self.read(1 << 20), b''))
+
+		if n == 0:
+			return b''
+
+		if self.head:
+			data, self.head = self.head[:n], self.head[n:]
+			return data
+
+		if self.remaining is None:
+			data = self.f.read(n)
+			if data:
+				return data
+			self.remaining = 0
+
+		if self.remaining:
+			data = self.f.read(min(n, self.remaining))
+			if not data:
+				raise InvalidMRF('File ended before the end of the stashed value')
+			self.remaining -= len(data)
+			return data
+
+		data, self.tail = self.tail[:n], self.tail[n:]
+		return data
+
+	def close(self) -> None:
+		if self.on_close is not None:
+			self.on_close()
+			self.on_close = None
+
+
+class StashedValue:
+	"""
+	The raw bytes of a top-level value, put aside to be parsed later.
+
+	Values in local files aren't copied. We remember where they are and
+	read them again. Values in remote files get spooled to a temporary
+	file, so that the remote file only has to be downloaded once.
+
+	`open` returns a file-like object that reads as the document
+	{key: value}. It can only be opened once.
+	"""
+
+	def __init__(
+		self,
+		raw_key: bytes,
+		filename,
+		start: int,
+		end: int,
+		spool = None,
+	):
+		self.raw_key = raw_key
+		self.filename = filename
+		self.start = start
+		self.end = end
+		self.spool = spool
+
+	def open(self) -> _RangeReader:
+		head = b'{' + self.raw_key + b':'
+		length = self.end - self.start
+
+		base_offset = self.start - len(head)
+
+		if self.spool is not None:
+			self.spool.seek(0)
+			return _RangeReader(self.spool, length, head, b'}', self.close, base_offset)
+
+		# Gzipped files can only get there by decompressing up to the
+		# offset, but that's still much cheaper than parsing up to it
+		opener = JSONOpen(self.filename, offset = self.start)
+		f = opener.__enter__()
+		on_close = lambda: opener.__exit__(None, None, None)
+		return _RangeReader(f, length, head, b'}', on_close, base_offset)
+
+	def close(self) -> None:
+		if self.spool is not None:
+			self.spool.close()
+			self.spool = None
+
+
+def open_in_array(
+	filename,
+	raw_key: bytes,
+	offset: int,
+	read_ahead: bool = False,
+) -> _RangeReader:
+	"""
+	Opens `filename` `offset` bytes in, where `offset` is just past an
+	item of the top-level array `raw_key` (see ScanningParser.tell). It
+	reads as the rest of the file with {raw_key:[ in front, and the
+	ScanningParser takes that (stray leading comma and all) as if the
+	array had started there.
+	"""
+	head = b'{' + raw_key + b':['
+	opener = JSONOpen(filename, read_ahead, offset)
+	f = opener.__enter__()
+	on_close = lambda: opener.__exit__(None, None, None)
+	return _RangeReader(f, None, head, b'', on_close, offset - len(head))
+
+
+class ScanningParser:
+	"""
+	Produces the same (prefix, event, value) triples as `parse` (one of
+	ijson.parse, flatteners.parse_shallow, ...) for a JSON MRF.
+
+	The items of top-level arrays are found with a JSONScanner and each one
+	gets parsed on its own, so `skip_item` can drop the rest of the current
+	item without parsing it. `stash_value` puts a whole top-level value
+	aside without parsing it, and `raw_items` hands over the items of a
+	top-level array as bytes.
+
+	`tell` gives the offset of the parser in the file, and `items_read`
+	the number of top-level array items read so far. Between items, that's
+	enough to pick up from the same spot with `open_in_array`.
+
+	`filename` can also be a file-like object.
+	"""
+
+	def __init__(
+		self,
+		filename,
+		parse: Callable = ijson.parse,
+		read_ahead: bool = False,
+		**kwargs,
+	):
+		self.filename = filename
+		self.parse = parse
+		self.read_ahead = read_ahead
+		self.kwargs = kwargs
+		self.scanner: JSONScanner | None = None
+		self.item: Generator | None = None
+		self.raw_key: bytes | None = None
+		self.base_offset = 0
+		self.items_read = 0
+		# Set when the value of the last key was
+		# consumed outside of the event stream
+		self.consumed = False
+		self.events = self._gen_events()
+
+	def __iter__(self):
+		return self
+
+	def __next__(self):
+		return next(self.events)
+
+	def tell(self) -> int:
+		return self.base_offset + self.scanner.tell()
+
+	def skip_item(self) -> None:
+		"""Drops the remaining events of the current array item"""
+		if self.item is not None:
+			self.item.close()
+
+	def stash_value(self) -> StashedValue:
+		"""
+		Puts aside the value of the top-level key that was just yielded,
+		instead of producing its events.
+		"""
+		scanner = self.scanner
+		scanner.peek()
+		start = self.tell()
+
+		# We can only go back to the value later
+		# if we can open the file again cheaply (a mirrored one is local too)
+		local = isinstance(self.filename, str) and (
+			not validate_url(self.filename) or helpers.mirror is not None
+		)
+		if local:
+			spool = None
+			scanner.skip_value()
+		else:
+			spool = tempfile.TemporaryFile()
+			scanner.copy_value(spool)
+
+		self.consumed = True
+		return StashedValue(self.raw_key, self.filename, start, self.tell(), spool)
+
+	def skip_value(self) -> None:
+		"""
+		Drops the value of the top-level key that was just yielded,
+		without producing its events.
+		"""
+		self.scanner.skip_value()
+		self.consumed = True
+
+	def raw_items(self) -> Generator[bytes]:
+		"""
+		Yields the raw bytes of each item of the top-level array whose key
+		was just yielded, instead of producing their events.
+		"""
+		self.scanner.expect(b'[')
+		self.consumed = True
+		return self._gen_raw_items()
+
+	def _gen_raw_items(self) -> Generator[bytes]:
+		scanner = self.scanner
+		while True:
+			c = scanner.peek()
+			if c == CLOSE_BRACKET:
+				scanner.pos += 1
+				return
+			if c == ord(','):
+				scanner.pos += 1
+				continue
+			item = scanner.read_value()
+			self.items_read += 1
+			yield item
+
+	def _parse_wrapped(self, data: bytes, head: int, stop: tuple) -> Generator:
+		"""
+		Parses `data`, dropping the first `head` events and stopping at
+		the event (prefix, event) == `stop`. This is how we get the right
+		prefixes for values that we've cut out of the document.
+		"""
+		events = self.parse(_GrowingReader(data), **self.kwargs)
+		for _ in range(head):
+			next(events)
+		for prefix, event, value in events:
+			if (prefix, event) == stop:
+				return
+			yield prefix, event, value
+
+	def _gen_array_items(self, key: str, raw_key: bytes) -> Generator:
+		open_ = b'{' + raw_key + b':['
+		stop = (key, 'end_array')
+
+		for item in self._gen_raw_items():
+			self.item = self._parse_wrapped(open_ + item + b']}', 3, stop)
+			yield from self.item
+			self.item = None
+
+	def _gen_events(self) -> Generator:
+		with open_json(self.filename, self.read_ahead) as f:
+			self.scanner = scanner = JSONScanner(f)
+			self.base_offset = getattr(f, 'base_offset', 0)
+
+			scanner.expect(b'{')
+			yield '', 'start_map', None
+
+			while True:
+				c = scanner.peek()
+				if c == CLOSE_BRACE:
+					scanner.pos += 1
+					break
+				if c == ord(','):
+					scanner.pos += 1
+					continue
+
+				self.raw_key = raw_key = scanner.read_string()
+				key = json.loads(raw_key)
+				scanner.expect(b':')
+				yield '', 'map_key', key
+
+				if self.consumed:
+					self.consumed = False
+					continue
+
+				if scanner.peek() == OPEN_BRACKET:
+					scanner.pos += 1
+					yield key, 'start_array', None
+					yield from self._gen_array_items(key, raw_key)
+					yield key, 'end_array', None
+				else:
+					value = scanner.read_value()
+					data = b'{' + raw_key + b':' + value + b'}'
+					yield from self._parse_wrapped(data, 2, ('', 'end_map'))
+
+			yield '', 'end_map', None
@@ -0,0 +1,196 @@
+"""
+Scheduling from the catalog
+###########################
+
+Flattens the in-network files listed in a catalog (a `LinkCatalog`, which
+the downloaders' crawler fills in) with a pool of worker processes,
+planning the work by file size.
+
+Files are handed out largest first: whenever a worker frees up, it gets the
+biggest file that's left. That way the run doesn't end with one worker
+chewing on a 50 GB file that started last while the others sit idle.
+
+At most `max_large` files of `large_size` bytes or more run at the same time
+(files of unknown size count as large), so that a pool of workers never
+holds several multi-GB downloads and their tables on disk and in memory at
+once. While that many are running, a free worker takes the biggest small
+file instead.
+
+The state of each file (pending, running, done or failed) is kept in the
+`flatten_jobs` table of the catalog, so a run can be stopped and started
+again: files that were running go back to pending, and done files are
+skipped. Files that failed `retries` times are skipped too, unless
+`retry_failed = True`.
+
+Usage:
+
+>>> results = run_catalog('catalog.db', 'csv_output', workers = 8, max_large = 2, code_filter = codes)
+>>> summarize(results)
+{'done': 118, 'failed': 2, 'rows': {...}}
+"""
+from __future__ import annotations
+
+import json
+import logging
+import math
+import os
+import sqlite3
+
+from mrfutils.batch import file_out_dirs, run_files
+from mrfutils.idxutils import LinkCatalog
+
+log = logging.getLogger(__name__)
+
+LARGE_SIZE = 1 << 30
+
+JOBS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS flatten_jobs (
+	url PRIMARY KEY UNIQUE,
+	size,
+	name,
+	status,
+	attempts,
+	seconds,
+	rows,
+	error
+)
+"""
+
+
+def is_large(size: int | None, large_size: int = LARGE_SIZE) -> bool:
+	return size is None or size < 0 or size >= large_size
+
+
+def _largest_first(job: dict) -> float:
+	size = job['size']
+	return -math.inf if size is None or size < 0 else -size
+
+
+def plan_jobs(
+	db: sqlite3.Connection,
+	payer: str | None = None,
+	retry_failed: bool = False,
+) -> list[dict]:
+	"""
+	Adds a pending job for each in-network file in the catalog that doesn't
+	have one, puts the jobs that were left running back to pending, and
+	returns the pending jobs (of `payer`, if given), largest first.
+	"""
+	with db:
+		db.execute(JOBS_SCHEMA)
+		db.execute("UPDATE flatten_jobs SET status = 'pending' WHERE status = 'running'")
+		if retry_failed:
+			db.execute("UPDATE flatten_jobs SET status = 'pending', attempts = 0 WHERE status = 'failed'")
+
+		new = db.execute(
+			'SELECT url, size FROM in_network_files WHERE url NOT IN (SELECT url FROM flatten_jobs)'
+		).fetchall()
+		taken = [name for name, in db.execute('SELECT name FROM flatten_jobs')]
+		names = file_out_dirs([url for url, _ in new], '', taken)
+		db.executemany(
+			"INSERT INTO flatten_jobs VALUES (?, ?, ?, 'pending', 0, 0, NULL, NULL)",
+			[(url, size, os.path.basename(names[url])) for url, size in new],
+		)
+
+		# The crawler may have sized files since they were planned
+		db.execute("""
+			UPDATE flatten_jobs
+			SET size = (SELECT size FROM in_network_files f WHERE f.url = flatten_jobs.url)
+			WHERE status = 'pending'
+		""")
+
+	query = """
+		SELECT j.url, j.size, j.name, j.attempts
+		FROM flatten_jobs j JOIN in_network_files f ON f.url = j.url
+		WHERE j.status = 'pending'
+	"""
+	params = ()
+	if payer is not None:
+		query += ' AND f.payer = ?'
+		params = (payer,)
+
+	jobs = [
+		dict(url = url, size = size, name = name, attempts = attempts)
+		for url, size, name, attempts in db.execute(query, params)
+	]
+	jobs.sort(key = _largest_first)
+	return jobs
+
+
+def pick_job(pending: list[dict], n_large: int, max_large: int, large_size: int = LARGE_SIZE) -> dict | None:
+	"""
+	The first (largest) job in `pending` that can start with `n_large`
+	large files running, or None if none can.
+	"""
+	for job in pending:
+		if n_large < max_large or not is_large(job['size'], large_size):
+			return job
+	return None
+
+
+def run_catalog(
+	catalog: str,
+	out_dir: str,
+	workers: int = 4,
+	retries: int = 2,
+	merge: bool = False,
+	max_large: int = 1,
+	large_size: int = LARGE_SIZE,
+	payer: str | None = None,
+	retry_failed: bool = False,
+	**options,
+) -> list[dict]:
+	"""
+	Flattens the pending in-network files in the catalog at `catalog` with
+	`workers` processes. See the module docstring for the order. `merge`
+	and `options` work as in run_batch.
+
+	Returns one status row per file that was run, as run_batch does, plus
+	its 'size'.
+	"""
+	if max_large < 1:
+		raise ValueError('max_large has to be at least 1, or large files never run')
+
+	db = LinkCatalog(catalog).db
+	jobs = plan_jobs(db, payer, retry_failed)
+	large = sum(is_large(job['size'], large_size) for job in jobs)
+	log.info(f'{len(jobs)} files to flatten, {large} of them large')
+
+	results = [
+		dict(
+			url = job['url'],
+			size = job['size'],
+			out_dir = f'{out_dir}/{job["name"]}',
+			status = 'pending',
+			attempts = job['attempts'],
+			seconds = 0.,
+			rows = None,
+			error = None,
+		)
+		for job in jobs
+	]
+
+	def pick(pending, running):
+		# Retries go back in by size
+		pending.sort(key = _largest_first)
+		n_large = sum(is_large(result['size'], large_size) for result in running)
+		return pick_job(pending, n_large, max_large, large_size)
+
+	def update(result):
+		with db:
+			db.execute(
+				'UPDATE flatten_jobs SET status = ?, attempts = ?, seconds = ?, rows = ?, error = ? WHERE url = ?',
+				(
+					result['status'],
+					result['attempts'],
+					result['seconds'],
+					json.dumps(result['rows']) if result['rows'] is not None else None,
+					result['error'],
+					result['url'],
+				),
+			)
+
+	try:
+		return run_files(results, out_dir, workers, retries, merge, pick, update, **options)
+	finally:
+		db.close()
@@ -76,4 +76,115 @@ SCHEMA = {
         "toc_plan_id",
         "toc_file_id",
     ],
-}
\ No newline at end of file
+    # The normalized form of toc_plan_file (see VIEWS)
+    "toc_link": [
+        "link",
+        "toc_id",
+    ],
+    "toc_link_plan": [
+        "link",
+        "toc_plan_id",
+    ],
+    "toc_link_file": [
+        "link",
+        "toc_file_id",
+    ],
+}
+
+# From schema.sql
+PRIMARY_KEYS = {
+    "file": ["id"],
+    "code": ["id"],
+    "rate_metadata": ["id"],
+    "rate": ["id"],
+    "tin": ["id"],
+    "tin_rate_file": ["rate_id", "tin_id"],
+    "npi_tin": ["npi", "tin_id"],
+    "toc": ["id"],
+    "toc_plan": ["id"],
+    "toc_file": ["id"],
+    "toc_plan_file": ["link", "toc_plan_id", "toc_file_id"],
+    "toc_link": ["link"],
+    "toc_link_plan": ["link", "toc_plan_id"],
+    "toc_link_file": ["link", "toc_file_id"],
+}
+
+# Types of the columns that aren't plain strings, for the typed outputs
+# (see writers.ParquetWriter). From schema.sql: the hash IDs are all
+# BIGINT UNSIGNED, and the ENUMs get dictionary-encoded.
+COLUMN_TYPES = {
+    "file": {
+        "id": "uint64",
+        "reporting_entity_type": "enum",
+        "plan_id_type": "enum",
+        "plan_market_type": "enum",
+    },
+    "code": {
+        "id": "uint64",
+        "billing_code_type": "enum",
+    },
+    "rate_metadata": {
+        "id": "uint64",
+        "billing_class": "enum",
+        "negotiated_type": "enum",
+    },
+    "rate": {
+        "id": "uint64",
+        "code_id": "uint64",
+        "rate_metadata_id": "uint64",
+        "negotiated_rate": "float64",
+    },
+    "tin": {
+        "id": "uint64",
+        "tin_type": "enum",
+    },
+    "tin_rate_file": {
+        "tin_id": "uint64",
+        "rate_id": "uint64",
+        "file_id": "uint64",
+    },
+    "npi_tin": {
+        "npi": "uint64",
+        "tin_id": "uint64",
+    },
+    "toc": {
+        "id": "uint64",
+        "reporting_entity_type": "enum",
+    },
+    "toc_plan": {
+        "id": "uint64",
+        "toc_id": "uint64",
+        "plan_id_type": "enum",
+        "plan_market_type": "enum",
+    },
+    "toc_file": {
+        "id": "uint64",
+        "toc_id": "uint64",
+    },
+    "toc_plan_file": {
+        "link": "uint64",
+        "toc_plan_id": "uint64",
+        "toc_file_id": "uint64",
+    },
+    "toc_link": {
+        "link": "uint64",
+        "toc_id": "uint64",
+    },
+    "toc_link_plan": {
+        "link": "uint64",
+        "toc_plan_id": "uint64",
+    },
+    "toc_link_file": {
+        "link": "uint64",
+        "toc_file_id": "uint64",
+    },
+}
+
+# From schema.sql. toc_plan_file_expanded has the same rows as
+# toc_plan_file, from the normalized tables.
+VIEWS = {
+    "toc_plan_file_expanded": (
+        "SELECT lp.link, lp.toc_plan_id, lf.toc_file_id "
+        "FROM toc_link_plan lp JOIN toc_link_file lf ON lf.link = lp.link"
+    ),
+}
@@ -110,4 +110,35 @@ CREATE TABLE IF NOT EXISTS toc_plan_file (
     PRIMARY KEY (link, toc_plan_id, toc_file_id),
     FOREIGN KEY (toc_plan_id) REFERENCES toc_plan(id),
     FOREIGN KEY (toc_file_id) REFERENCES toc_file(id)
-);
\ No newline at end of file
+);
+
+-- toc_plan_file is the cross product of the plans and the files of each
+-- reporting structure (link). These store the plans and the files of each
+-- link instead, and the view puts the cross product back together.
+
+CREATE TABLE IF NOT EXISTS toc_link (
+    link BIGINT UNSIGNED,
+    toc_id BIGINT UNSIGNED,
+    PRIMARY KEY (link),
+    FOREIGN KEY (toc_id) REFERENCES toc(id)
+);
+
+CREATE TABLE IF NOT EXISTS toc_link_plan (
+    link BIGINT UNSIGNED,
+    toc_plan_id BIGINT UNSIGNED,
+    PRIMARY KEY (link, toc_plan_id),
+    FOREIGN KEY (link) REFERENCES toc_link(link),
+    FOREIGN KEY (toc_plan_id) REFERENCES toc_plan(id)
+);
+
+CREATE TABLE IF NOT EXISTS toc_link_file (
+    link BIGINT UNSIGNED,
+    toc_file_id BIGINT UNSIGNED,
+    PRIMARY KEY (link, toc_file_id),
+    FOREIGN KEY (link) REFERENCES toc_link(link),
+    FOREIGN KEY (toc_file_id) REFERENCES toc_file(id)
+);
+
+CREATE OR REPLACE VIEW toc_plan_file_expanded AS
+SELECT lp.link, lp.toc_plan_id, lf.toc_file_id
+FROM toc_link_plan lp JOIN toc_link_file lf ON lf.link = lp.link;
\ No newline at end of file
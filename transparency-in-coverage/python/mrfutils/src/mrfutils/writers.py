@@ -0,0 +1,692 @@
+"""
+Table writers
+#############
+
+Opening, appending to and closing a CSV file for every write is fine for a
+handful of rows, but `write_in_network_item` writes several times per
+negotiated rate, so on a big file most of the time would go into open/close
+syscalls.
+
+`CSVWriter` keeps one open handle (and one csv writer) per table for the whole
+run. Rows are written into an in-memory buffer per table and flushed to disk in
+bulk once the buffer gets big enough.
+
+Tables written by other CSVWriters (e.g. in worker processes) can be appended
+with `merge`.
+
+The same TIN, code and rate metadata rows come up over and over again in an
+MRF. With `dedup`, each table remembers the primary keys (see
+schema.PRIMARY_KEYS) of the rows it wrote and drops repeats, so every
+distinct row is written once per run. `dedup = True` remembers every key.
+`dedup = n` remembers only the `n` most recently seen keys per table, which
+bounds the memory but lets the odd repeat through.
+
+`ParquetWriter` has the same interface, but writes typed Parquet (uint64 IDs,
+float64 rates, dictionary-encoded enums) instead of text, which takes up a
+fraction of the space and loads much faster in polars or pandas. It needs
+pyarrow.
+
+`SQLWriter` inserts the rows straight into SQLite, or a MySQL-protocol
+database like Dolt, in batched transactions, so there's no CSV to import.
+
+All three are `TableWriter`s, which do the dedup and the counting
+(`rows_written`, `hit_rates`); each one only adds its own buffering and
+output. `WRITERS` maps the output format names to the writers.
+
+Usage:
+
+>>> with CSVWriter(out_dir) as writer:
+>>> 	writer.write(code_row, 'code')
+>>> 	writer.write(rate_rows, 'rate')
+>>> writer.rows_written
+{'code': 1, 'rate': 12}
+"""
+from __future__ import annotations
+
+import abc
+import collections
+import csv
+import io
+import logging
+import os
+import shutil
+import sqlite3
+from operator import itemgetter
+from typing import Callable
+
+from mrfutils.helpers import make_dir
+from mrfutils.schema.schema import COLUMN_TYPES, PRIMARY_KEYS, SCHEMA, VIEWS
+
+try:
+	import pyarrow as pa
+	import pyarrow.parquet as pq
+except ImportError:
+	pa = None
+
+log = logging.getLogger(__name__)
+
+
+class SeenKeys:
+	"""
+	Set of the keys seen so far, or, with `max_size`, an LRU of the
+	`max_size` most recently seen keys. Counts hits and misses.
+	"""
+
+	def __init__(self, max_size: int | None = None):
+		self.max_size = max_size
+		self.keys = set() if max_size is None else collections.OrderedDict()
+		self.hits = 0
+		self.misses = 0
+
+	def seen(self, key) -> bool:
+		"""Checks whether `key` was seen before, and adds it if not"""
+		keys = self.keys
+		if key in keys:
+			self.hits += 1
+			if self.max_size is not None:
+				keys.move_to_end(key)
+			return True
+
+		self.misses += 1
+		if self.max_size is None:
+			keys.add(key)
+		else:
+			keys[key] = None
+			if len(keys) > self.max_size:
+				keys.popitem(last = False)
+		return False
+
+	@property
+	def hit_rate(self) -> float:
+		total = self.hits + self.misses
+		return self.hits / total if total else 0.
+
+
+class _Table(abc.ABC):
+	"""Row counters and dedup for a single table. Subclasses add the sink."""
+
+	def __init__(self, key_fields: list[str] | None = None, seen: SeenKeys | None = None):
+		self.buffered_rows = 0
+		self.rows_written = 0
+
+		# Only used for dedup
+		self.seen = seen
+		if key_fields:
+			self.key_fields = key_fields
+			self.row_key = itemgetter(*key_fields)
+
+	def new_rows(self, rows: list[dict]) -> list[dict]:
+		row_key = self.row_key
+		seen = self.seen.seen
+		return [row for row in rows if not seen(row_key(row))]
+
+	@abc.abstractmethod
+	def flush(self) -> None:
+		"""Writes out the buffered rows"""
+
+	def close(self) -> None:
+		self.flush()
+
+
+class TableWriter(abc.ABC):
+	"""
+	What the writers have in common: one _Table per table name, opened
+	on its first write, dedup, and the counts in `rows_written` and
+	`hit_rates`. A subclass makes its tables (`_new_table`), buffers
+	the rows (`_add`) and merges shards (`merge`).
+	"""
+
+	def __init__(self, out_dir: str, dedup: bool | int = False):
+		self.out_dir = out_dir
+		self.dedup = dedup
+		self.tables: dict[str, _Table] = {}
+		self._rows_written: dict[str, int] = {}
+		self.seen: dict[str, SeenKeys] = {}
+
+	@abc.abstractmethod
+	def _new_table(self, table_name: str, key_fields: list[str] | None, seen: SeenKeys | None) -> _Table:
+		"""Opens the table `table_name`"""
+
+	def _get_table(self, table_name: str) -> _Table:
+		table = self.tables.get(table_name)
+		if table is None:
+			if self.dedup is False:
+				table = self._new_table(table_name, None, None)
+			else:
+				max_size = None if self.dedup is True else self.dedup
+				seen = self.seen.setdefault(table_name, SeenKeys(max_size))
+				table = self._new_table(table_name, PRIMARY_KEYS[table_name], seen)
+			self.tables[table_name] = table
+		return table
+
+	@abc.abstractmethod
+	def _add(self, table: _Table, rows: list[dict]) -> None:
+		"""Buffers `rows` (deduped already), flushing as needed"""
+
+	def write(self, row_data: list[dict] | dict, table_name: str) -> None:
+		table = self._get_table(table_name)
+
+		if isinstance(row_data, dict):
+			row_data = [row_data]
+		if table.seen is not None:
+			row_data = table.new_rows(row_data)
+
+		self._add(table, row_data)
+
+	def flush(self, table_name: str | None = None) -> None:
+		tables = self.tables.values() if table_name is None else [self.tables[table_name]]
+		for table in tables:
+			table.flush()
+
+	@abc.abstractmethod
+	def merge(self, shard_dir: str, rows_written: dict[str, int]) -> None:
+		"""Appends the tables that a writer of the same kind wrote to `shard_dir`"""
+
+	def close(self) -> None:
+		for table_name, table in self.tables.items():
+			table.close()
+			self._rows_written[table_name] = table.rows_written
+			log.info(f'Wrote {table.rows_written} rows to {table_name}')
+		self.tables = {}
+
+		for table_name, seen in self.seen.items():
+			log.info(
+				f'Dropped {seen.hits} repeated rows from {table_name} '
+				f'(hit rate {seen.hit_rate:.1%})'
+			)
+
+	@property
+	def hit_rates(self) -> dict[str, float]:
+		"""Fraction of the rows per table that dedup dropped"""
+		return {table_name: seen.hit_rate for table_name, seen in self.seen.items()}
+
+	@property
+	def rows_written(self) -> dict[str, int]:
+		"""Rows written (and flushed) per table so far"""
+		rows_written = dict(self._rows_written)
+		for table_name, table in self.tables.items():
+			rows_written[table_name] = table.rows_written
+		return rows_written
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.close()
+
+
+class _CSVTable(_Table):
+	"""Open file handle and row buffer for a single table"""
+
+	def __init__(
+		self,
+		file_loc: str,
+		fieldnames: list[str],
+		key_fields: list[str] | None = None,
+		seen: SeenKeys | None = None,
+	):
+		super().__init__(key_fields, seen)
+		file_exists = os.path.exists(file_loc) and os.path.getsize(file_loc) > 0
+
+		# newline = '' is to prevent Windows
+		# from adding \r\n\n to the end of each line
+		self.f = open(file_loc, 'a', newline = '')
+		self.buffer = io.StringIO()
+		self.writer = csv.DictWriter(self.buffer, fieldnames = fieldnames)
+
+		if key_fields:
+			self.key_columns = [fieldnames.index(field) for field in key_fields]
+
+		if not file_exists:
+			self.writer.writeheader()
+
+	def csv_row_key(self, csv_row: list[str]):
+		"""Key of a row read back from a CSV (the key columns are all ints)"""
+		key = tuple(int(csv_row[i]) for i in self.key_columns)
+		return key[0] if len(key) == 1 else key
+
+	def flush(self) -> None:
+		if self.buffer.tell():
+			self.f.write(self.buffer.getvalue())
+			self.buffer.seek(0)
+			self.buffer.truncate()
+
+		self.rows_written += self.buffered_rows
+		self.buffered_rows = 0
+		self.f.flush()
+
+	def close(self) -> None:
+		self.flush()
+		self.f.close()
+
+
+class CSVWriter(TableWriter):
+	"""
+	Writes rows to `{out_dir}/{table_name}.csv`, keeping the files open
+	until `close` is called (or the context manager exits).
+
+	A table's buffer is flushed when it holds more than `max_rows` rows
+	or more than `max_bytes` bytes of CSV text, whichever comes first.
+
+	`dedup` drops rows whose primary key was already written: True for
+	all of them, or an int to only remember that many keys per table.
+	"""
+
+	def __init__(
+		self,
+		out_dir: str,
+		max_rows: int = 10_000,
+		max_bytes: int = 1 << 20,
+		dedup: bool | int = False,
+	):
+		super().__init__(out_dir, dedup)
+		self.max_rows = max_rows
+		self.max_bytes = max_bytes
+
+	def _new_table(self, table_name: str, key_fields: list[str] | None, seen: SeenKeys | None) -> _CSVTable:
+		return _CSVTable(f'{self.out_dir}/{table_name}.csv', SCHEMA[table_name], key_fields, seen)
+
+	def _add(self, table: _CSVTable, rows: list[dict]) -> None:
+		table.writer.writerows(rows)
+		table.buffered_rows += len(rows)
+
+		if (
+			table.buffered_rows >= self.max_rows
+			or table.buffer.tell() >= self.max_bytes
+		):
+			table.flush()
+
+	def merge(self, shard_dir: str, rows_written: dict[str, int]) -> None:
+		"""
+		Appends the tables that another CSVWriter wrote to `shard_dir`
+		(minus their headers) to our own tables, and removes the shards.
+		`rows_written` is the other writer's `rows_written`.
+		"""
+		for table_name, rows in rows_written.items():
+			table = self._get_table(table_name)
+			table.flush()
+
+			shard_loc = f'{shard_dir}/{table_name}.csv'
+			with open(shard_loc, newline = '') as f:
+				f.readline()
+				if table.seen is None:
+					shutil.copyfileobj(f, table.f)
+				else:
+					rows = self._merge_new_rows(f, table)
+
+			table.rows_written += rows
+			os.remove(shard_loc)
+
+	def _merge_new_rows(self, f, table: _CSVTable) -> int:
+		"""Copies the rows from `f` that `table` hasn't seen yet"""
+		writer = csv.writer(table.f)
+		seen = table.seen.seen
+		rows = 0
+		for csv_row in csv.reader(f):
+			if not seen(table.csv_row_key(csv_row)):
+				writer.writerow(csv_row)
+				rows += 1
+		return rows
+
+
+def arrow_schema(table_name: str) -> pa.Schema:
+	"""Arrow schema of a table, with the types in schema.COLUMN_TYPES"""
+	types = COLUMN_TYPES.get(table_name, {})
+	fields = []
+	for column in SCHEMA[table_name]:
+		column_type = types.get(column)
+		if column_type == 'uint64':
+			fields.append(pa.field(column, pa.uint64()))
+		elif column_type == 'float64':
+			fields.append(pa.field(column, pa.float64()))
+		elif column_type == 'enum':
+			fields.append(pa.field(column, pa.dictionary(pa.int32(), pa.string())))
+		else:
+			fields.append(pa.field(column, pa.string()))
+	return pa.schema(fields)
+
+
+class _ParquetTable(_Table):
+	"""Parquet writer and row buffer for a single table"""
+
+	def __init__(
+		self,
+		table_dir: str,
+		table_name: str,
+		compression: str,
+		key_fields: list[str] | None = None,
+		seen: SeenKeys | None = None,
+	):
+		super().__init__(key_fields, seen)
+		self.table_dir = table_dir
+		self.schema = arrow_schema(table_name)
+		self.compression = compression
+		self.writer = None
+
+		# Rows that haven't been converted yet, then the converted chunks
+		self.rows: list[dict] = []
+		self.chunks: list[pa.Table] = []
+
+	def new_rows_mask(self, table: pa.Table) -> list[bool]:
+		"""Which rows of an Arrow `table` we haven't seen yet"""
+		columns = [table.column(field).to_pylist() for field in self.key_fields]
+		keys = columns[0] if len(columns) == 1 else zip(*columns)
+		seen = self.seen.seen
+		return [not seen(key) for key in keys]
+
+	def convert(self) -> None:
+		"""Turns the buffered rows into an Arrow table"""
+		if not self.rows:
+			return
+
+		columns = []
+		for field in self.schema:
+			values = [row.get(field.name) for row in self.rows]
+			if pa.types.is_dictionary(field.type) or pa.types.is_string(field.type):
+				# Whatever the CSV would have held
+				values = [v if v is None or type(v) is str else str(v) for v in values]
+			columns.append(pa.array(values, field.type))
+
+		self.chunks.append(pa.Table.from_arrays(columns, schema = self.schema))
+		self.rows = []
+
+	def open(self) -> None:
+		# Each writer gets its own part, since Parquet files can't be
+		# appended to
+		make_dir(self.table_dir)
+		n = 0
+		while os.path.exists(f'{self.table_dir}/part-{n}.parquet'):
+			n += 1
+		self.writer = pq.ParquetWriter(
+			f'{self.table_dir}/part-{n}.parquet',
+			self.schema,
+			compression = self.compression,
+		)
+
+	def flush(self) -> None:
+		self.convert()
+		if not self.chunks:
+			return
+
+		if self.writer is None:
+			self.open()
+
+		table = pa.concat_tables(self.chunks)
+		self.writer.write_table(table, row_group_size = max(len(table), 1))
+		self.chunks = []
+		self.rows_written += self.buffered_rows
+		self.buffered_rows = 0
+
+	def close(self) -> None:
+		self.flush()
+		if self.writer is not None:
+			self.writer.close()
+
+
+class ParquetWriter(TableWriter):
+	"""
+	Same interface as CSVWriter, but writes each table as typed Parquet
+	to `{out_dir}/{table_name}/part-{n}.parquet` (see schema.COLUMN_TYPES).
+	Every ParquetWriter writes a new part, so to read a table:
+
+	>>> polars.read_parquet(f'{out_dir}/rate/*.parquet')
+
+	Rows are buffered until a table has `row_group_size` of them, then
+	written as one row group, compressed with `compression`.
+
+	Needs pyarrow (`pip install .[parquet]`).
+	"""
+
+	def __init__(
+		self,
+		out_dir: str,
+		row_group_size: int = 1 << 17,
+		compression: str = 'zstd',
+		dedup: bool | int = False,
+	):
+		if pa is None:
+			raise ImportError('ParquetWriter needs pyarrow: pip install pyarrow')
+
+		super().__init__(out_dir, dedup)
+		self.row_group_size = row_group_size
+		self.compression = compression
+
+	def _new_table(self, table_name: str, key_fields: list[str] | None, seen: SeenKeys | None) -> _ParquetTable:
+		return _ParquetTable(f'{self.out_dir}/{table_name}', table_name, self.compression, key_fields, seen)
+
+	def _add(self, table: _ParquetTable, rows: list[dict]) -> None:
+		table.rows.extend(rows)
+		table.buffered_rows += len(rows)
+
+		# Converting in smaller chunks keeps the
+		# Python objects from piling up
+		if len(table.rows) >= 1 << 14:
+			table.convert()
+		if table.buffered_rows >= self.row_group_size:
+			table.flush()
+
+	def merge(self, shard_dir: str, rows_written: dict[str, int]) -> None:
+		"""
+		Adds the tables that another ParquetWriter wrote to `shard_dir`
+		to our own tables, and removes the shards. `rows_written` is the
+		other writer's `rows_written`.
+		"""
+		for table_name, rows in rows_written.items():
+			table = self._get_table(table_name)
+			table.convert()
+
+			shard_dir_table = f'{shard_dir}/{table_name}'
+			for part in sorted(os.listdir(shard_dir_table)):
+				shard = pq.read_table(f'{shard_dir_table}/{part}', schema = table.schema)
+				if table.seen is not None:
+					shard = shard.filter(pa.array(table.new_rows_mask(shard)))
+				table.chunks.append(shard)
+				table.buffered_rows += len(shard)
+
+			shutil.rmtree(shard_dir_table)
+			if table.buffered_rows >= self.row_group_size:
+				table.flush()
+
+
+SQL_TYPES = {
+	'sqlite': {'uint64': 'INTEGER', 'float64': 'REAL', None: 'TEXT'},
+	'mysql': {'uint64': 'BIGINT UNSIGNED', 'float64': 'DOUBLE', None: 'TEXT'},
+}
+
+_INT64_MAX = (1 << 63) - 1
+
+
+def _to_int64(value: int | None) -> int | None:
+	"""uint64 hash as SQLite's signed 64-bit INTEGER (same bits)"""
+	if value is not None and value > _INT64_MAX:
+		return value - (1 << 64)
+	return value
+
+
+def _to_uint64(value: int | None) -> int | None:
+	if value is not None and value < 0:
+		return value + (1 << 64)
+	return value
+
+
+def create_table_sql(table_name: str, dialect: str = 'sqlite') -> str:
+	"""CREATE TABLE statement for a table, with its primary key"""
+	sql_types = SQL_TYPES[dialect]
+	column_types = COLUMN_TYPES.get(table_name, {})
+	columns = []
+	for column in SCHEMA[table_name]:
+		column_type = column_types.get(column)
+		columns.append(f'{column} {sql_types.get(column_type, sql_types[None])}')
+	columns.append(f'PRIMARY KEY ({", ".join(PRIMARY_KEYS[table_name])})')
+	return f'CREATE TABLE IF NOT EXISTS {table_name} ({", ".join(columns)})'
+
+
+def create_view_sql(view_name: str, dialect: str = 'sqlite') -> str:
+	"""CREATE VIEW statement for one of schema.VIEWS"""
+	if dialect == 'mysql':
+		return f'CREATE OR REPLACE VIEW {view_name} AS {VIEWS[view_name]}'
+	return f'CREATE VIEW IF NOT EXISTS {view_name} AS {VIEWS[view_name]}'
+
+
+class _SQLTable(_Table):
+	"""Row buffer and insert statement for a single table"""
+
+	def __init__(
+		self,
+		table_name: str,
+		conn,
+		dialect: str,
+		key_fields: list[str] | None = None,
+		seen: SeenKeys | None = None,
+	):
+		super().__init__(key_fields, seen)
+		self.conn = conn
+		self.fieldnames = SCHEMA[table_name]
+		self.rows: list[tuple] = []
+
+		column_types = COLUMN_TYPES.get(table_name, {})
+		self.uint64_columns = [
+			i for i, column in enumerate(self.fieldnames)
+			if column_types.get(column) == 'uint64'
+		]
+		self.signed = dialect == 'sqlite'
+
+		columns = ', '.join(self.fieldnames)
+		if dialect == 'sqlite':
+			placeholders = ', '.join('?' for _ in self.fieldnames)
+			self.insert = f'INSERT OR IGNORE INTO {table_name} ({columns}) VALUES ({placeholders})'
+		else:
+			placeholders = ', '.join('%s' for _ in self.fieldnames)
+			self.insert = f'INSERT IGNORE INTO {table_name} ({columns}) VALUES ({placeholders})'
+
+	def add(self, rows: list[dict]) -> None:
+		fieldnames = self.fieldnames
+		int64_columns = self.uint64_columns if self.signed else ()
+		for row in rows:
+			values = [row.get(field) for field in fieldnames]
+			for i in int64_columns:
+				values[i] = _to_int64(values[i])
+			self.rows.append(tuple(values))
+		self.buffered_rows = len(self.rows)
+
+	def flush(self) -> None:
+		"""Inserts the buffered rows (the caller commits)"""
+		if not self.rows:
+			return
+
+		cursor = self.conn.cursor()
+		cursor.executemany(self.insert, self.rows)
+		# The number of rows that weren't ignored, if the driver knows it
+		inserted = cursor.rowcount
+		self.rows_written += inserted if inserted >= 0 else len(self.rows)
+		self.rows = []
+		self.buffered_rows = 0
+
+
+class SQLWriter(TableWriter):
+	"""
+	Same interface as CSVWriter, but inserts the rows into a database.
+
+	By default that's the SQLite database `{out_dir}/mrf.db`. For a
+	MySQL-protocol server like Dolt (`dolt sql-server`), pass
+	`connect`, a function that returns a DB-API connection, and
+	`dialect = 'mysql'`:
+
+	>>> SQLWriter(out_dir, connect = lambda: pymysql.connect(...), dialect = 'mysql')
+
+	The tables are created from schema.SCHEMA if they don't exist, with
+	the primary keys in schema.PRIMARY_KEYS, and so are schema.VIEWS. Rows go in with INSERT OR
+	IGNORE (INSERT IGNORE in MySQL), so a row whose key is already in the
+	database is dropped, across files and runs. Rows are sent in
+	`executemany` batches of `batch_size` per table, and committed every
+	`commit_rows` rows.
+
+	SQLite's INTEGER is signed, so there the uint64 IDs are stored as
+	the signed int64 with the same bits. Joins work the same. To get the
+	unsigned ID back, add 2**64 to the negative ones.
+	"""
+
+	def __init__(
+		self,
+		out_dir: str,
+		connect: Callable | None = None,
+		dialect: str = 'sqlite',
+		batch_size: int = 10_000,
+		commit_rows: int = 500_000,
+		dedup: bool | int = False,
+	):
+		super().__init__(out_dir, dedup)
+		self.dialect = dialect
+		self.batch_size = batch_size
+		self.commit_rows = commit_rows
+		self.uncommitted = 0
+
+		if connect is None:
+			self.conn = sqlite3.connect(f'{out_dir}/mrf.db')
+			self.conn.execute('PRAGMA journal_mode = WAL')
+			self.conn.execute('PRAGMA synchronous = NORMAL')
+		else:
+			self.conn = connect()
+
+		cursor = self.conn.cursor()
+		for table_name in SCHEMA:
+			cursor.execute(create_table_sql(table_name, dialect))
+		for view_name in VIEWS:
+			cursor.execute(create_view_sql(view_name, dialect))
+		self.conn.commit()
+
+	def _new_table(self, table_name: str, key_fields: list[str] | None, seen: SeenKeys | None) -> _SQLTable:
+		return _SQLTable(table_name, self.conn, self.dialect, key_fields, seen)
+
+	def _add(self, table: _SQLTable, rows: list[dict]) -> None:
+		table.add(rows)
+		if table.buffered_rows >= self.batch_size:
+			self.uncommitted += table.buffered_rows
+			table.flush()
+			if self.uncommitted >= self.commit_rows:
+				self.conn.commit()
+				self.uncommitted = 0
+
+	def flush(self, table_name: str | None = None) -> None:
+		super().flush(table_name)
+		self.conn.commit()
+		self.uncommitted = 0
+
+	def merge(self, shard_dir: str, rows_written: dict[str, int]) -> None:
+		"""
+		Inserts the rows that another (SQLite) SQLWriter wrote to
+		`shard_dir`, and removes the shard database.
+		"""
+		shard_loc = f'{shard_dir}/mrf.db'
+		if not os.path.exists(shard_loc):
+			return
+
+		shard = sqlite3.connect(shard_loc)
+		for table_name in rows_written:
+			table = self._get_table(table_name)
+			uint64_columns = table.uint64_columns
+			rows = shard.execute(f'SELECT {", ".join(table.fieldnames)} FROM {table_name}')
+			for row in rows:
+				row = dict(zip(table.fieldnames, row))
+				for i in uint64_columns:
+					field = table.fieldnames[i]
+					row[field] = _to_uint64(row[field])
+				self.write(row, table_name)
+		shard.close()
+
+		for suffix in ('', '-wal', '-shm'):
+			if os.path.exists(shard_loc + suffix):
+				os.remove(shard_loc + suffix)
+
+	def close(self) -> None:
+		self.flush()
+		super().close()
+		self.conn.close()
+
+
+# Output formats for in_network_file_to_csv and friends
+WRITERS = {
+	'csv': CSVWriter,
+	'parquet': ParquetWriter,
+	'sql': SQLWriter,
+}
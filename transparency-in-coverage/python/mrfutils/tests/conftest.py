@@ -0,0 +1,116 @@
+"""
+Local stand-ins for the servers mrfutils downloads from
+"""
+from __future__ import annotations
+
+import functools
+import os
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from mrfs import write_mrfs
+
+DATA = os.urandom(100_000)
+
+
+class RangeServer(ThreadingHTTPServer):
+	"""
+	Serves `data` at any path. Honours Range, If-Match and If-Range,
+	unless told not to.
+	"""
+
+	daemon_threads = True
+
+	def __init__(self):
+		super().__init__(('127.0.0.1', 0), RangeHandler)
+		self.ranges = True
+		self.conditions = True
+		self.validators = True
+		self.requests = []
+		self.set_data(DATA)
+
+	def set_data(self, data: bytes) -> None:
+		self.data = data
+		self.etag = f'"{hash(data) & 0xffffffff:x}"'
+
+	@property
+	def url(self) -> str:
+		return f'http://127.0.0.1:{self.server_address[1]}/in-network.json'
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+
+	def log_message(self, *args):
+		pass
+
+	def send_body(self, status: int, body: bytes, headers: dict) -> None:
+		self.send_response(status)
+		headers = {**headers, 'Content-Length': len(body)}
+		if self.server.validators:
+			headers['ETag'] = self.server.etag
+		for name, value in headers.items():
+			self.send_header(name, str(value))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def do_GET(self):
+		server = self.server
+		server.requests.append(dict(self.headers))
+		data = server.data
+		if_match = self.headers.get('If-Match')
+		if server.conditions and if_match and if_match != server.etag:
+			return self.send_body(412, b'', {})
+
+		match = re.match(r'bytes=(\d+)-(\d+)', self.headers.get('Range', ''))
+		if_range = self.headers.get('If-Range')
+		if (
+			not server.ranges
+			or not match
+			or (server.conditions and if_range and if_range != server.etag)
+		):
+			return self.send_body(200, data, {})
+
+		start, end = int(match[1]), min(int(match[2]), len(data) - 1)
+		if start >= len(data):
+			return self.send_body(416, b'', {'Content-Range': f'bytes */{len(data)}'})
+		self.send_body(206, data[start:end + 1], {'Content-Range': f'bytes {start}-{end}/{len(data)}'})
+
+
+@pytest.fixture
+def server():
+	server = RangeServer()
+	thread = threading.Thread(target = server.serve_forever, daemon = True)
+	thread.start()
+	yield server
+	server.shutdown()
+	server.server_close()
+
+
+class _QuietHandler(SimpleHTTPRequestHandler):
+	def log_message(self, *args):
+		pass
+
+
+@pytest.fixture(scope = 'session')
+def mrfs(tmp_path_factory) -> dict[str, str]:
+	"""
+	Serves the files in mrfs.py, and returns their URLs, e.g.
+	mrfs['refs_after.json.gz']
+	"""
+	directory = tmp_path_factory.mktemp('mrfs')
+	paths = write_mrfs(directory)
+
+	handler = functools.partial(_QuietHandler, directory = str(directory))
+	server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+	server.daemon_threads = True
+	threading.Thread(target = server.serve_forever, daemon = True).start()
+	port = server.server_address[1]
+	yield {
+		name: f'http://127.0.0.1:{port}/{os.path.basename(path)}'
+		for name, path in paths.items()
+	}
+	server.shutdown()
+	server.server_close()
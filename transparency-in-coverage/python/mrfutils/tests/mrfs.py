@@ -0,0 +1,152 @@
+"""
+Small made-up in-network files for the tests, in the layouts that matter
+to the flattener: provider references before the items, after them, or
+none at all. The strings have escaped quotes, backslashes and brackets in
+them, to keep the byte-level scanner honest.
+"""
+from __future__ import annotations
+
+import gzip
+import json
+import os
+import random
+
+HEADER = dict(
+	reporting_entity_name = 'Test Co',
+	reporting_entity_type = 'insurer',
+	plan_name = 'P',
+	plan_id_type = 'EIN',
+	plan_id = '123',
+	plan_market_type = 'group',
+	last_updated_on = '2022-01-01',
+	version = '1.0.0',
+)
+
+NPIS = [1_000_000_000 + i for i in range(200)]
+
+CODES = {('CPT', str(code)) for code in range(100, 106)}
+NPI_FILTER = set(NPIS[::3])
+
+LAYOUTS = {
+	'refs_first': ['provider_references', 'in_network'],
+	'refs_after': ['in_network', 'provider_references'],
+	'no_refs': ['in_network'],
+}
+
+
+def make_mrf(n_items: int = 40, n_refs: int = 30, seed: int = 0) -> dict:
+	rng = random.Random(seed)
+
+	def group():
+		return {
+			# Some payers give the NPIs as strings
+			'npi': [str(n) if rng.random() < .5 else n for n in rng.sample(NPIS, rng.randint(1, 6))],
+			'tin': {'type': 'ein', 'value': f'{rng.randint(0, 20):09d}'},
+		}
+
+	def rate():
+		rate = {'negotiated_prices': [{
+			'negotiated_type': rng.choice(['negotiated', 'fee schedule']),
+			'negotiated_rate': round(rng.random() * 1000, 2) if rng.random() < .8 else rng.randint(1, 500),
+			'expiration_date': '9999-12-31',
+			'billing_class': rng.choice(['professional', 'institutional']),
+			'service_code': rng.sample(['11', '22', '02'], 2) if rng.random() < .5 else [],
+			'additional_information': 'a {weird} "str\\\\" [x]' if rng.random() < .2 else '',
+			'billing_code_modifier': ['26'] if rng.random() < .3 else None,
+		}]}
+		if rng.random() < .7:
+			rate['provider_references'] = rng.sample(range(n_refs), 3)
+		else:
+			rate['provider_groups'] = [group() for _ in range(2)]
+		return rate
+
+	items = [
+		{
+			'negotiation_arrangement': 'ffs',
+			'name': 'Thing \\u00e9 "quoted" \\\\ [bracket] {brace}',
+			'billing_code_type': rng.choice(['CPT', 'HCPCS']),
+			'billing_code_type_version': '2022',
+			'billing_code': str(rng.randint(100, 110)),
+			'description': 'desc {',
+			'negotiated_rates': [rate() for _ in range(rng.randint(1, 4))],
+		}
+		for _ in range(n_items)
+	]
+	references = [
+		{'provider_group_id': i, 'provider_groups': [group() for _ in range(rng.randint(1, 3))]}
+		for i in range(n_refs)
+	]
+	return dict(HEADER, provider_references = references, in_network = items)
+
+
+def make_index(n_structures: int = 30, seed: int = 0) -> dict:
+	"""
+	A table of contents whose plans and files show up under several
+	reporting structures, with some structures repeated outright
+	"""
+	rng = random.Random(seed)
+	plans = [
+		dict(plan_name = f'Plan {i}', plan_id_type = 'EIN', plan_id = f'{i:09d}', plan_market_type = 'group')
+		for i in range(12)
+	]
+	files = [
+		dict(description = f'file {i}', location = f'https://a.example/in-network/{i}.json.gz')
+		for i in range(15)
+	]
+
+	structures = []
+	for i in range(n_structures):
+		if structures and rng.random() < .2:
+			structures.append(rng.choice(structures))
+			continue
+		structure = dict(
+			reporting_plans = rng.sample(plans, rng.randint(1, 4)),
+			in_network_files = rng.sample(files, rng.randint(0, 5)),
+		)
+		if rng.random() < .5:
+			structure['allowed_amount_file'] = dict(
+				description = 'allowed amounts',
+				location = f'https://a.example/allowed-amounts/{i % 4}.json.gz',
+			)
+		structures.append(structure)
+
+	return dict(
+		reporting_entity_name = 'Test Co',
+		reporting_entity_type = 'insurer',
+		reporting_structure = structures,
+		version = '1.0.0',
+	)
+
+
+def write_mrfs(directory, **kwargs) -> dict[str, str]:
+	"""
+	Writes each layout as `{name}.json` (indented) and `{name}.json.gz`,
+	and the index as index.json, and returns {name + suffix: path}
+	"""
+	mrf = make_mrf(**kwargs)
+	paths = {}
+	for name, keys in LAYOUTS.items():
+		data = dict(HEADER, **{key: mrf[key] for key in keys})
+		path = os.path.join(str(directory), name)
+		with open(f'{path}.json', 'w') as f:
+			json.dump(data, f, indent = 1)
+		with gzip.open(f'{path}.json.gz', 'wt') as f:
+			json.dump(data, f)
+		paths[f'{name}.json'] = f'{path}.json'
+		paths[f'{name}.json.gz'] = f'{path}.json.gz'
+
+	path = os.path.join(str(directory), 'index.json')
+	with open(path, 'w') as f:
+		json.dump(make_index(), f)
+	paths['index.json'] = path
+	return paths
+
+
+def read_tables(out_dir) -> dict[str, bytes]:
+	"""The CSVs in `out_dir`, as bytes"""
+	tables = {}
+	for name in sorted(os.listdir(out_dir)):
+		if name.endswith('.csv'):
+			with open(os.path.join(str(out_dir), name), 'rb') as f:
+				tables[name] = f.read()
+	return tables
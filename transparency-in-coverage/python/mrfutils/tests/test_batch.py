@@ -0,0 +1,43 @@
+from __future__ import annotations
+
+import os
+
+from mrfs import read_tables
+from mrfutils.batch import MERGED_LOG, read_merged, run_batch, summarize
+
+
+def test_merge_rerun_skips_merged_files(mrfs, tmp_path):
+	urls = [mrfs['refs_first.json.gz'], mrfs['no_refs.json.gz']]
+	out_dir = str(tmp_path / 'out')
+
+	results = run_batch(urls[:1], out_dir, workers = 2, merge = True)
+	assert summarize(results)['done'] == 1
+	tables = read_tables(out_dir)
+	assert list(read_merged(out_dir)) == urls[:1]
+
+	# As if the first run died after merging the first file
+	results = run_batch(urls, out_dir, workers = 2, merge = True)
+	assert [result['status'] for result in results] == ['done', 'done']
+	assert results[0]['attempts'] == 0
+	assert results[0]['rows'] == read_merged(out_dir)[urls[0]]
+	assert list(read_merged(out_dir)) == urls
+
+	rows = summarize(results)['rows']
+	for name, data in read_tables(out_dir).items():
+		# Only no_refs' rows were added, no repeats of refs_first's
+		n_rows = len(data.splitlines()) - 1
+		assert n_rows == rows[name[:-len('.csv')]]
+		assert data.startswith(tables.get(name, b''))
+
+	# Nothing left to do
+	results = run_batch(urls, out_dir, merge = True)
+	assert all(result['attempts'] == 0 for result in results)
+
+
+def test_no_writer_without_merge(mrfs, tmp_path):
+	out_dir = str(tmp_path / 'out')
+	results = run_batch([mrfs['refs_after.json.gz']], out_dir, output_format = 'sql')
+
+	assert summarize(results)['done'] == 1
+	assert sorted(os.listdir(out_dir)) == ['refs_after']
+	assert not os.path.exists(f'{out_dir}/{MERGED_LOG}')
@@ -0,0 +1,46 @@
+from __future__ import annotations
+
+import os
+
+import pytest
+
+from mrfs import read_tables
+from mrfutils import flatteners
+from mrfutils.checkpoint import Checkpoint
+from mrfutils.flatteners import in_network_file_to_csv
+
+
+class Crash(Exception):
+	pass
+
+
+@pytest.mark.parametrize('name', ['refs_first.json.gz', 'refs_after.json.gz', 'no_refs.json'])
+@pytest.mark.parametrize('crash_after', [1, 17])
+def test_resume_matches_clean_run(mrfs, tmp_path, monkeypatch, name, crash_after):
+	url = mrfs[name]
+	clean_dir = str(tmp_path / 'clean')
+	in_network_file_to_csv(url, clean_dir)
+
+	# Checkpoint after every item, and die partway through
+	monkeypatch.setattr(Checkpoint, 'due', lambda self: True)
+	write_item = flatteners.write_in_network_item
+	n_written = 0
+
+	def crashing_write(*args, **kwargs):
+		nonlocal n_written
+		n_written += 1
+		if n_written > crash_after:
+			raise Crash
+		write_item(*args, **kwargs)
+
+	out_dir = str(tmp_path / 'resumed')
+	monkeypatch.setattr(flatteners, 'write_in_network_item', crashing_write)
+	with pytest.raises(Crash):
+		in_network_file_to_csv(url, out_dir, checkpoint = True)
+	assert os.path.exists(f'{out_dir}/.checkpoint.json')
+
+	monkeypatch.setattr(flatteners, 'write_in_network_item', write_item)
+	in_network_file_to_csv(url, out_dir, checkpoint = True)
+	assert not os.path.exists(f'{out_dir}/.checkpoint.json')
+
+	assert read_tables(out_dir) == read_tables(clean_dir)
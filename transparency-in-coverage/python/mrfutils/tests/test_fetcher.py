@@ -0,0 +1,155 @@
+"""
+ReferenceFetcher against a local stand-in for a payer's reference server
+"""
+from __future__ import annotations
+
+import asyncio
+import csv
+import time
+from collections import Counter
+
+from aiohttp import web
+
+from mrfutils.fetcher import ReferenceFetcher, parse_retry_after
+from mrfutils.flatteners import make_reference_map, tin_rows_and_npi_tin_rows_from_dict
+from mrfutils.refcache import ReferenceCache
+from mrfutils.references import DiskReferenceStore
+
+GROUPS = {'provider_groups': [{'npi': [1111111111, 2222222222], 'tin': {'type': 'ein', 'value': '12-3456789'}}]}
+
+# Some payers give the TIN as a number, sometimes a float
+NUMERIC_TIN = {'provider_groups': [{'npi': [3333333333], 'tin': {'type': 'ein', 'value': 123456789.0}}]}
+
+
+def make_app(hits: Counter) -> web.Application:
+	async def flaky(request):
+		hits['flaky'] += 1
+		if hits['flaky'] == 1:
+			return web.Response(status = 503)
+		return web.json_response(GROUPS)
+
+	async def limited(request):
+		hits['limited'] += 1
+		if hits['limited'] == 1:
+			return web.Response(status = 429, headers = {'Retry-After': '1'})
+		return web.json_response(GROUPS)
+
+	async def missing(request):
+		hits['missing'] += 1
+		return web.Response(status = 404)
+
+	async def down(request):
+		hits['down'] += 1
+		return web.Response(status = 503)
+
+	async def numeric(request):
+		hits['numeric'] += 1
+		return web.json_response(NUMERIC_TIN)
+
+	app = web.Application()
+	app.router.add_get('/numeric.json', numeric)
+	app.router.add_get('/flaky.json', flaky)
+	app.router.add_get('/limited.json', limited)
+	app.router.add_get('/missing.json', missing)
+	app.router.add_get('/down.json', down)
+	return app
+
+
+async def fetch_references(names: list[str], fetcher: ReferenceFetcher, hits: Counter, reference_map = None):
+	runner = web.AppRunner(make_app(hits))
+	await runner.setup()
+	site = web.TCPSite(runner, '127.0.0.1', 0)
+	await site.start()
+	host, port = runner.addresses[0][:2]
+	try:
+		references = [
+			{'provider_group_id': i, 'location': f'http://{host}:{port}/{name}.json'}
+			for i, name in enumerate(names)
+		]
+		return await make_reference_map(iter(references), None, reference_map, fetcher)
+	finally:
+		await runner.cleanup()
+
+
+def test_retries_503():
+	hits = Counter()
+	fetcher = ReferenceFetcher(workers = 1, retries = 2, backoff = .01)
+	reference_map = asyncio.run(fetch_references(['flaky'], fetcher, hits))
+
+	assert hits['flaky'] == 2
+	assert fetcher.failed == []
+	assert list(reference_map.get(0)[0]['npi']) == [1111111111, 2222222222]
+
+
+def test_waits_for_retry_after():
+	hits = Counter()
+	fetcher = ReferenceFetcher(workers = 1, retries = 2, backoff = .01)
+	start = time.time()
+	reference_map = asyncio.run(fetch_references(['limited'], fetcher, hits))
+
+	assert time.time() - start >= 1
+	assert hits['limited'] == 2
+	assert 0 in reference_map
+
+
+def test_retry_after_is_capped():
+	hits = Counter()
+	fetcher = ReferenceFetcher(workers = 1, retries = 2, backoff = .01, max_retry_after = .01)
+	start = time.time()
+	asyncio.run(fetch_references(['limited'], fetcher, hits))
+
+	assert time.time() - start < 1
+	assert hits['limited'] == 2
+
+
+def test_writes_failed_references(tmp_path):
+	report = tmp_path / 'failed_references.csv'
+	hits = Counter()
+	fetcher = ReferenceFetcher(workers = 2, retries = 1, backoff = .01, report = str(report))
+	reference_map = asyncio.run(fetch_references(['flaky', 'missing', 'down'], fetcher, hits))
+
+	# A 404 isn't retried, a 503 is until we run out of retries
+	assert hits['missing'] == 1
+	assert hits['down'] == 2
+	assert 0 in reference_map
+
+	with open(report, newline = '') as f:
+		rows = list(csv.DictReader(f))
+	assert sorted((row['url'].rsplit('/', 1)[1], row['provider_group_id'], row['error']) for row in rows) == [
+		('down.json', '2', 'FetchError(503)'),
+		('missing.json', '1', 'FetchError(404)'),
+	]
+
+	# A run without failures removes the old report
+	fetcher = ReferenceFetcher(workers = 1, backoff = .01, report = str(report))
+	asyncio.run(fetch_references(['flaky'], fetcher, Counter()))
+	assert not report.exists()
+
+
+def test_numeric_tin(tmp_path):
+	cache = ReferenceCache(str(tmp_path / 'refcache.db'))
+	store = DiskReferenceStore(str(tmp_path / 'refs.db'), 'file')
+	fetcher = ReferenceFetcher(workers = 1, cache = cache)
+	asyncio.run(fetch_references(['numeric'], fetcher, Counter(), store))
+	store.finish()
+	assert fetcher.failed == []
+
+	# Stored and cached as what json.loads gives, not a Decimal
+	groups = store.get(0)
+	assert groups[0]['tin'] == {'type': 'ein', 'value': 123456789.0}
+	assert type(groups[0]['tin']['value']) is float
+	assert cache.lookup(next(iter(cache.db.execute('SELECT url FROM remote_references')))[0]).groups == (
+		'[["ein", 123456789.0, [3333333333]]]'
+	)
+	tin_rows, npi_tin_rows = tin_rows_and_npi_tin_rows_from_dict(groups)
+	assert tin_rows[0]['tin_value'] == 123456789.0
+	assert npi_tin_rows[0]['npi'] == 3333333333
+	store.close()
+	cache.close()
+
+
+def test_parse_retry_after():
+	assert parse_retry_after(None) is None
+	assert parse_retry_after('120') == 120
+	assert parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT') == 0
+	assert parse_retry_after('soon') is None
@@ -0,0 +1,141 @@
+from __future__ import annotations
+
+import csv
+import json
+import sqlite3
+
+import pytest
+
+from mrfs import CODES, NPI_FILTER, make_index, read_tables
+from mrfutils.flatteners import PARSE_ENGINES, expand_toc_links, in_network_file_to_csv, toc_file_to_csv
+from mrfutils.references import ReferenceStore
+from mrfutils.writers import _to_uint64
+
+
+@pytest.mark.parametrize('fast_skip', [False, True])
+@pytest.mark.parametrize('name', ['refs_first.json.gz', 'refs_after.json', 'no_refs.json.gz'])
+def test_engines_agree(mrfs, tmp_path, name, fast_skip):
+	tables = {}
+	for engine in PARSE_ENGINES:
+		out_dir = str(tmp_path / engine)
+		in_network_file_to_csv(
+			mrfs[name],
+			out_dir,
+			code_filter = CODES,
+			npi_filter = NPI_FILTER,
+			engine = engine,
+			fast_skip = fast_skip,
+		)
+		tables[engine] = read_tables(out_dir)
+
+	assert tables['parse']
+	assert tables['basic'] == tables['parse']
+
+
+
+@pytest.mark.parametrize('name', ['refs_first.json.gz', 'refs_after.json.gz', 'refs_after.json'])
+@pytest.mark.parametrize('npi_filter', [None, NPI_FILTER], ids = ['all_npis', 'npi_filter'])
+def test_pruned_references_change_nothing(mrfs, tmp_path, monkeypatch, name, npi_filter):
+	add = ReferenceStore.add
+	added = []
+	monkeypatch.setattr(ReferenceStore, 'add', lambda self, *args: added.append(args[0]) or add(self, *args))
+
+	tables = {}
+	n_stored = {}
+	for prune_references in (False, True):
+		added.clear()
+		out_dir = str(tmp_path / str(prune_references))
+		in_network_file_to_csv(
+			mrfs[name],
+			out_dir,
+			code_filter = CODES,
+			npi_filter = npi_filter,
+			prune_references = prune_references,
+		)
+		tables[prune_references] = read_tables(out_dir)
+		n_stored[prune_references] = len(added)
+
+	# Only references that come after the items can be pruned
+	if name.startswith('refs_after'):
+		assert n_stored[True] < n_stored[False]
+	else:
+		assert n_stored[True] == n_stored[False]
+	assert tables[False]['npi_tin.csv'].count(b'\n') > 1
+	assert tables[True] == tables[False]
+
+
+def read_rows(out_dir, table_name: str) -> list[tuple]:
+	with open(f'{out_dir}/{table_name}.csv', newline = '') as f:
+		return [tuple(row) for row in csv.reader(f)][1:]
+
+
+def plan_file_links(out_dir) -> set[tuple]:
+	"""toc_plan_file as (link, toc_plan_id, toc_file_id) ints"""
+	with open(f'{out_dir}/toc_plan_file.csv', newline = '') as f:
+		return {
+			(int(row['link']), int(row['toc_plan_id']), int(row['toc_file_id']))
+			for row in csv.DictReader(f)
+		}
+
+
+def test_toc_writes_plans_and_files_once(mrfs, tmp_path):
+	out_dir = str(tmp_path / 'toc')
+	rows_written = toc_file_to_csv(mrfs['index.json'], out_dir, dedup = True)
+
+	index = make_index()
+	structures = [s for s in index['reporting_structure'] if s['in_network_files']]
+	plan_ids = {plan['plan_id'] for s in structures for plan in s['reporting_plans']}
+	locations = {file['location'] for s in structures for file in s['in_network_files']}
+
+	plans = read_rows(out_dir, 'toc_plan')
+	files = read_rows(out_dir, 'toc_file')
+	assert len({row[0] for row in plans}) == len(plans) == len(plan_ids)
+	assert len({row[0] for row in files}) == len(files) == len(locations)
+
+	plan_files = read_rows(out_dir, 'toc_plan_file')
+	assert len(set(plan_files)) == len(plan_files) == rows_written['toc_plan_file']
+	links = {
+		(json.dumps(s, sort_keys = True), plan['plan_id'], file['location'])
+		for s in structures
+		for plan in s['reporting_plans']
+		for file in s['in_network_files']
+	}
+	assert len(plan_files) == len(links)
+
+
+@pytest.mark.parametrize('dedup', [False, True])
+def test_toc_parallel_matches_serial(mrfs, tmp_path, dedup):
+	tables = {}
+	for workers in (1, 3):
+		out_dir = str(tmp_path / str(workers))
+		toc_file_to_csv(mrfs['index.json'], out_dir, workers = workers, dedup = dedup)
+		tables[workers] = read_tables(out_dir)
+
+	assert set(tables[1]) == {'toc.csv', 'toc_plan.csv', 'toc_file.csv', 'toc_plan_file.csv'}
+	assert tables[3] == tables[1]
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_toc_normalized_expands_to_plan_files(mrfs, tmp_path, workers):
+	url = mrfs['index.json']
+	plain_dir = str(tmp_path / 'plain')
+	toc_file_to_csv(url, plain_dir)
+
+	out_dir = str(tmp_path / 'normalized')
+	rows_written = toc_file_to_csv(url, out_dir, workers = workers, normalized = True)
+	assert 'toc_plan_file' not in rows_written
+	# The cross product is bigger than its parts
+	assert rows_written['toc_link_plan'] + rows_written['toc_link_file'] < len(plan_file_links(plain_dir))
+
+	for table_name in ('toc', 'toc_plan', 'toc_file'):
+		assert sorted(read_rows(out_dir, table_name)) == sorted(read_rows(plain_dir, table_name))
+
+	expand_toc_links(out_dir)
+	assert plan_file_links(out_dir) == plan_file_links(plain_dir)
+
+	sql_dir = str(tmp_path / 'sql')
+	toc_file_to_csv(url, sql_dir, output_format = 'sql', normalized = True)
+	conn = sqlite3.connect(f'{sql_dir}/mrf.db')
+	view_rows = conn.execute('SELECT link, toc_plan_id, toc_file_id FROM toc_plan_file_expanded')
+	assert {tuple(map(_to_uint64, row)) for row in view_rows} == plan_file_links(plain_dir)
+	conn.close()
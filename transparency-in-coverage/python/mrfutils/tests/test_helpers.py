@@ -0,0 +1,74 @@
+from __future__ import annotations
+
+import hashlib
+import json
+
+import pytest
+
+from mrfs import make_mrf
+from mrfutils import helpers
+from mrfutils.helpers import append_hash, dicthasher, filename_hasher, set_hasher
+
+
+def old_dicthasher(data: dict) -> int:
+	"""dicthasher as it was before the hashers and the cache"""
+	data = json.dumps(data, sort_keys = True).encode('utf-8')
+	return int.from_bytes(hashlib.sha256(data).digest()[:8], 'little')
+
+
+def gen_rows():
+	mrf = make_mrf()
+	yield dict(filename = 'in-network-rates')
+	for item in mrf['in_network']:
+		code = {k: item[k] for k in ('billing_code_type_version', 'billing_code', 'billing_code_type')}
+		yield code
+		yield dict(name = item['name'], description = item['description'])
+		for rate in item['negotiated_rates']:
+			for price in rate['negotiated_prices']:
+				yield price
+	for reference in mrf['provider_references']:
+		for group in reference['provider_groups']:
+			yield group['tin']
+			yield group
+	# Equal in Python, not in JSON
+	yield from (dict(value = 1), dict(value = 1.0), dict(value = True), dict(value = '1'))
+	yield dict(b = None, a = 'é ü', c = [1, 2.5, 'x'])
+
+
+@pytest.fixture
+def restore_hasher():
+	set_hasher('sha256')
+	yield
+	set_hasher('sha256')
+
+
+def test_sha256_ids_unchanged(restore_hasher):
+	rows = list(gen_rows())
+	# Twice, the second time from the cache
+	for _ in range(2):
+		for row in rows:
+			assert dicthasher(row) == old_dicthasher(row)
+	assert len({dicthasher(row) for row in rows[-5:-1]}) == 4
+
+	row = append_hash(dict(plan_name = 'P', plan_id = '123'), 'id')
+	assert row['id'] == old_dicthasher(dict(plan_name = 'P', plan_id = '123'))
+	assert filename_hasher('https://a.example/x/in-network-rates.json.gz') == old_dicthasher(dict(filename = 'in-network-rates'))
+
+
+def test_other_hashers(restore_hasher):
+	rows = list(gen_rows())
+	set_hasher('blake2b')
+	ids = [dicthasher(row) for row in rows]
+	assert all(0 <= i < 1 << 64 for i in ids)
+	assert ids != [old_dicthasher(row) for row in rows]
+
+	# Switching back doesn't serve blake2b IDs from the cache
+	set_hasher('sha256')
+	assert [dicthasher(row) for row in rows] == [old_dicthasher(row) for row in rows]
+
+
+def test_hash_cache_is_bounded(restore_hasher, monkeypatch):
+	monkeypatch.setattr(helpers, 'HASH_CACHE_SIZE', 10)
+	for i in range(25):
+		assert dicthasher(dict(i = i)) == old_dicthasher(dict(i = i))
+	assert len(helpers._hash_cache) <= 10
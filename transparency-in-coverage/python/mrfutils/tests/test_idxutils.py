@@ -0,0 +1,78 @@
+from __future__ import annotations
+
+import asyncio
+
+import pytest
+
+from mrfs import make_index
+from mrfutils.idxutils import LINK_PREFIXES, LinkCatalog, gen_index_links, size_links
+
+
+def expected_links(kinds) -> list[tuple[str, str]]:
+	"""The distinct (kind, url) of make_index(), in document order"""
+	links = []
+	for structure in make_index()['reporting_structure']:
+		found = [('in_network', file['location']) for file in structure['in_network_files']]
+		if 'allowed_amount_file' in structure:
+			# After in_network_files in the document
+			found.append(('allowed_amount', structure['allowed_amount_file']['location']))
+		links.extend(link for link in found if link[0] in kinds and link not in links)
+	return links
+
+
+@pytest.mark.parametrize('kinds', [
+	('in_network',),
+	('allowed_amount',),
+	('in_network', 'allowed_amount'),
+	tuple(LINK_PREFIXES),
+])
+def test_gen_index_links(mrfs, kinds):
+	links = list(gen_index_links(mrfs['index.json'], kinds))
+	assert links == expected_links(kinds)
+	assert {kind for kind, _ in links} == set(kinds) - {'provider_reference'}
+
+
+def test_add_links(tmp_path):
+	catalog = LinkCatalog(str(tmp_path / 'catalog.db'), batch_size = 2)
+	links = [
+		('in_network', 'https://a.example/1.json.gz', 100),
+		('in_network', 'https://a.example/2.json.gz'),
+		('in_network', 'https://a.example/3.json.gz'),
+		('allowed_amount', 'https://a.example/aa.json.gz', 5),
+	]
+	assert catalog.add_links(links, payer = 'a') == {'in_network': 3, 'allowed_amount': 1}
+	# Known URLs are left alone, sizes and all
+	assert catalog.add_links([('in_network', 'https://a.example/1.json.gz', 1)], payer = 'b') == {'in_network': 0}
+	catalog.add_links([('in_network', 'https://b.example/1.json.gz')], payer = 'b')
+
+	assert sorted(catalog.unsized('in_network', payer = 'a')) == [
+		'https://a.example/2.json.gz',
+		'https://a.example/3.json.gz',
+	]
+	assert len(catalog.unsized('in_network')) == 3
+	assert catalog.unsized('allowed_amount') == []
+	assert catalog.total_size('in_network') == 100
+	assert catalog.total_size('allowed_amount', payer = 'b') == 0
+	catalog.close()
+
+
+@pytest.mark.parametrize('ranges', [True, False])
+def test_size_links(server, tmp_path, ranges):
+	# No HEAD on this server, so the sizes come from a GET
+	server.ranges = ranges
+	catalog = LinkCatalog(str(tmp_path / 'catalog.db'))
+	urls = [f'{server.url}?{i}' for i in range(5)]
+	catalog.add_links([('in_network', url) for url in urls], payer = 'a')
+	catalog.add_links([('in_network', 'http://127.0.0.1:1/down.json.gz')], payer = 'b')
+	catalog.add_links([('allowed_amount', f'{server.url}?aa')], payer = 'a')
+
+	failed = asyncio.run(size_links(catalog, ('in_network',), concurrency = 2, retries = 0, payer = 'a'))
+	assert failed == {'in_network': 0}
+	assert catalog.unsized('in_network') == ['http://127.0.0.1:1/down.json.gz']
+	assert catalog.total_size('in_network') == 5 * len(server.data)
+	assert catalog.unsized('allowed_amount') == [f'{server.url}?aa']
+
+	failed = asyncio.run(size_links(catalog, ('in_network', 'allowed_amount'), retries = 0))
+	assert failed == {'in_network': 1, 'allowed_amount': 0}
+	assert catalog.total_size('allowed_amount') == len(server.data)
+	catalog.close()
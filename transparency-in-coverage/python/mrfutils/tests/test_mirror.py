@@ -0,0 +1,82 @@
+"""
+Resuming FileMirror downloads over parallel ranges
+"""
+from __future__ import annotations
+
+import json
+
+import pytest
+
+from mrfutils.mirror import FileMirror, _url_key
+
+
+def start_partial(mirror: FileMirror, url: str, data: bytes, meta: dict) -> None:
+	"""Leaves a partial download of the first 30_000 bytes of `data`"""
+	partial = f'{mirror.directory}/partial/{_url_key(url)}'
+	with open(f'{partial}.part', 'wb') as f:
+		f.write(data[:30_000])
+	with open(f'{partial}.json', 'w') as f:
+		json.dump(meta, f)
+
+
+def range_starts(server) -> list[int]:
+	starts = []
+	for headers in server.requests:
+		if headers.get('Range', 'bytes=0-0') != 'bytes=0-0':
+			starts.append(int(headers['Range'][6:].split('-')[0]))
+	return sorted(starts)
+
+
+@pytest.fixture
+def mirror(tmp_path):
+	return FileMirror(str(tmp_path), connections = 4, backoff = .01)
+
+
+def test_keeps_validators(server, mirror):
+	path = mirror.get(server.url)
+
+	with open(path, 'rb') as f:
+		assert f.read() == server.data
+	assert mirror.db.execute('SELECT etag FROM mirrored_files').fetchone() == (server.etag,)
+
+
+def test_resumes_same_version(server, mirror):
+	start_partial(mirror, server.url, server.data, dict(size = len(server.data), etag = server.etag))
+	path = mirror.get(server.url)
+
+	with open(path, 'rb') as f:
+		assert f.read() == server.data
+	assert range_starts(server)[0] == 30_000
+
+
+@pytest.mark.parametrize('meta', [
+	dict(size = 100_000),
+	dict(size = 100_000, etag = '"old"'),
+	dict(size = 100_000, etag = 'W/"weak"'),
+], ids = ['no_validators', 'other_etag', 'weak_etag'])
+def test_restarts_unknown_version(server, mirror, meta):
+	start_partial(mirror, server.url, b'x' * 100_000, meta)
+	path = mirror.get(server.url)
+
+	with open(path, 'rb') as f:
+		assert f.read() == server.data
+	assert range_starts(server)[0] == 0
+
+
+def test_restarts_without_server_validators(server, mirror):
+	server.validators = False
+	start_partial(mirror, server.url, b'x' * 100_000, dict(size = 100_000, etag = server.etag))
+	path = mirror.get(server.url)
+
+	with open(path, 'rb') as f:
+		assert f.read() == server.data
+	assert range_starts(server)[0] == 0
+
+
+def test_restarts_when_the_file_changes(server, mirror):
+	start_partial(mirror, server.url, server.data, dict(size = len(server.data), etag = server.etag))
+	server.set_data(server.data[::-1])
+	path = mirror.get(server.url)
+
+	with open(path, 'rb') as f:
+		assert f.read() == server.data
@@ -0,0 +1,44 @@
+from __future__ import annotations
+
+import pickle
+import random
+from array import array
+
+from mrfutils.npifilter import NPIFilter
+
+
+def test_filter_matches_set():
+	rng = random.Random(0)
+	npis = {rng.randrange(1_000_000_000, 2_000_000_000) for _ in range(5_000)}
+	npi_filter = NPIFilter(npis)
+	pool = list(npis)
+	for n in (10, 1_000, 20_000):
+		group = array('L', [rng.choice(pool) if rng.random() < .1 else rng.randrange(1_000_000_000, 2_000_000_000) for _ in range(n)])
+		assert list(npi_filter.filter(group)) == [npi for npi in group if npi in npis]
+
+
+def test_cache_is_keyed_on_contents():
+	npi_filter = NPIFilter([1111111111, 2222222222])
+	first = npi_filter.filter(array('L', [1111111111, 3333333333]))
+	again = npi_filter.filter(array('L', [1111111111, 3333333333]))
+	other = npi_filter.filter(array('L', [2222222222, 3333333333]))
+
+	assert again is first
+	assert list(other) == [2222222222]
+	assert (npi_filter.hits, npi_filter.misses) == (1, 2)
+	assert all(len(digest) == 16 for _, digest in npi_filter.cache)
+
+
+def test_cache_bytes_are_capped():
+	npis = list(range(1_000_000_000, 1_000_001_000))
+	npi_filter = NPIFilter(npis, cache_bytes = 20_000)
+	for i in range(100):
+		npi_filter.filter(array('L', npis[i:i + 500]))
+		assert npi_filter.cached_bytes <= 20_000
+
+
+def test_pickle_drops_cache():
+	npi_filter = NPIFilter([1111111111], cache_size = 10, cache_bytes = 1_000)
+	npi_filter.filter(array('L', [1111111111]))
+	copy = pickle.loads(pickle.dumps(npi_filter))
+	assert (copy.cache_size, copy.cache_bytes, copy.cache) == (10, 1_000, {})
@@ -0,0 +1,55 @@
+"""
+RangeReader against a local server that does (or doesn't do) Range requests
+"""
+from __future__ import annotations
+
+import pytest
+
+from mrfutils.ranges import FileChanged, open_ranged, probe_ranges
+
+
+def test_reads_ranges(server):
+	with open_ranged(server.url, connections = 4, chunk_size = 10_000, backoff = .01) as f:
+		assert f.read() == server.data
+
+	ranges = [headers for headers in server.requests if headers.get('Range') != 'bytes=0-0']
+	assert len(ranges) == 10
+	assert all(headers['If-Match'] == server.etag for headers in ranges)
+	assert all(headers['If-Range'] == server.etag for headers in ranges)
+
+
+def test_reads_from_start(server):
+	with open_ranged(server.url, start = 12_345, connections = 2, chunk_size = 10_000) as f:
+		assert f.read() == server.data[12_345:]
+
+
+def test_falls_back_without_ranges(server):
+	server.ranges = False
+	assert probe_ranges(server.url) is None
+	assert open_ranged(server.url) is None
+
+
+def test_whole_file_instead_of_range(server):
+	f = open_ranged(server.url, connections = 1, chunk_size = 10_000, max_ahead = 1, backoff = .01)
+	server.ranges = False
+	with f, pytest.raises(FileChanged):
+		f.read()
+
+
+@pytest.mark.parametrize('conditions', [True, False], ids = ['conditions', 'no_conditions'])
+def test_size_change(server, conditions):
+	server.conditions = conditions
+	f = open_ranged(server.url, connections = 1, chunk_size = 10_000, max_ahead = 1, backoff = .01)
+	server.set_data(server.data + b'more')
+	with f, pytest.raises(FileChanged):
+		f.read()
+
+
+def test_size_change_without_etag(server):
+	f = open_ranged(server.url, connections = 1, chunk_size = 10_000, max_ahead = 1, backoff = .01)
+	# A server with neither validators nor their checks
+	server.conditions = False
+	f.etag = None
+	server.set_data(server.data[:50_000] + server.data)
+	with f, pytest.raises(FileChanged, match = 'Size changed'):
+		f.read()
@@ -0,0 +1,30 @@
+from __future__ import annotations
+
+from mrfutils.refcache import ReferenceCache
+
+GROUPS = [{'npi': [1234567890, 1234567891], 'tin': {'type': 'ein', 'value': '123456789'}}]
+
+
+def test_size_counts_replaced_entries_once(tmp_path):
+	cache = ReferenceCache(str(tmp_path / 'refcache.db'))
+	for _ in range(5):
+		cache.store('https://a.example/ref/1', GROUPS, {'ETag': '"1"'})
+	cache.store('https://a.example/ref/1', GROUPS[:0], {})
+	cache.store('https://a.example/ref/2', GROUPS, {})
+
+	assert cache.size == cache._stored_size()
+	cache.close()
+
+
+def test_evicts_least_recently_used(tmp_path):
+	cache = ReferenceCache(str(tmp_path / 'refcache.db'), max_bytes = 500)
+	urls = [f'https://a.example/ref/{i}' for i in range(20)]
+	for url in urls:
+		cache.store(url, GROUPS, {})
+		# Refetching an entry must not make the cache think it's full
+		cache.store(url, GROUPS, {})
+		assert cache.size == cache._stored_size() <= 500
+
+	assert cache.lookup(urls[0]) is None
+	assert cache.lookup(urls[-1]) is not None
+	cache.close()
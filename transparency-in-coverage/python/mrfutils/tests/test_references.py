@@ -0,0 +1,186 @@
+from __future__ import annotations
+
+import pickle
+from array import array
+
+import pytest
+
+from mrfs import CODES, NPI_FILTER, read_tables
+from mrfutils.flatteners import in_network_file_to_csv
+from mrfutils.references import DiskReferenceStore, ReferenceStore
+
+
+def group(tin: str, *npis: int) -> dict:
+	return {'npi': list(npis), 'tin': {'type': 'ein', 'value': tin}}
+
+
+def as_lists(groups) -> list[dict]:
+	return [dict(group, npi = list(group['npi'])) for group in groups]
+
+
+REFERENCES = {
+	1: [group('1', 1111111111, 1222222222), group('2', 1333333333)],
+	2: [group('1', 1444444444)],
+	5: [],
+	7: [group('3')],
+}
+
+
+def check(store: ReferenceStore, references: dict) -> None:
+	assert len(store) == len(references)
+	for group_id, groups in references.items():
+		assert group_id in store
+		assert store.n_groups(group_id) == len(groups)
+		assert as_lists(store.get(group_id)) == groups
+	assert store.get(3) is None
+	assert store.get('missing', []) == []
+	assert 3 not in store
+
+
+def test_round_trip():
+	store = ReferenceStore()
+	for group_id, groups in REFERENCES.items():
+		store.add(group_id, groups)
+
+	# Sorted IDs stay in the array, the TINs get interned
+	assert store.ref_index is None
+	assert len(store.tins) == 3
+	assert store.npis.typecode == 'I'
+	check(store, REFERENCES)
+	assert all(isinstance(g['npi'], array) for g in store.gen_groups(1))
+
+	own = [group('9', 1999999999)]
+	resolved = store.resolve(own, [1, 3, 2])
+	assert len(resolved) == 1 + 2 + 1
+	assert as_lists(resolved) == own + REFERENCES[1] + REFERENCES[2]
+
+
+@pytest.mark.parametrize('ids', [
+	[5, 1, 7, 2],
+	[1, 2, -3, 7],
+	[1, 2, 'x', 7],
+	[1, 2, 1 << 64, 7],
+])
+def test_unsorted_ids(ids):
+	"""IDs that can't stay in the sorted array move to a dict"""
+	references = dict(zip(ids, REFERENCES.values()))
+	store = ReferenceStore()
+	for group_id, groups in references.items():
+		store.add(group_id, groups)
+
+	assert store.ref_index is not None
+	check(store, references)
+
+
+def test_replace():
+	store = ReferenceStore()
+	store.add(1, REFERENCES[1])
+	store.add(2, REFERENCES[2])
+	store.add(1, REFERENCES[7])
+	assert len(store) == 2
+	assert as_lists(store.get(1)) == REFERENCES[7]
+	assert as_lists(store.get(2)) == REFERENCES[2]
+
+
+def test_npis_that_overflow():
+	store = ReferenceStore()
+	store.add(1, REFERENCES[1])
+	# Not a real NPI, but it's kept
+	store.add(2, [group('1', 1555555555, 1 << 40)])
+
+	assert store.npis.typecode == 'Q'
+	assert as_lists(store.get(1)) == REFERENCES[1]
+	assert as_lists(store.get(2)) == [group('1', 1555555555, 1 << 40)]
+
+
+def fill(store: DiskReferenceStore, references: dict = REFERENCES) -> None:
+	store.clear()
+	for group_id, groups in references.items():
+		store.add(group_id, groups)
+	store.finish()
+
+
+def test_disk_round_trip(tmp_path):
+	store = DiskReferenceStore(str(tmp_path / 'refs.db'), 'file:v1', cache_size = 2, batch_size = 2)
+	assert not store.complete
+	fill(store)
+	assert store.complete
+	check(store, REFERENCES)
+	assert len(store.cache) <= 2
+
+	# Pickled (as in a checkpoint), it reconnects to the same map
+	copy = pickle.loads(pickle.dumps(store))
+	check(copy, REFERENCES)
+	copy.close()
+	store.close()
+
+
+def test_disk_maps_are_keyed(tmp_path):
+	path = str(tmp_path / 'refs.db')
+	store = DiskReferenceStore(path, 'file:v1', npi_filter = {1111111111})
+	fill(store)
+	store.close()
+
+	store = DiskReferenceStore(path, 'file:v1', npi_filter = {1111111111})
+	assert store.complete
+	check(store, REFERENCES)
+	store.close()
+
+	for source, npi_filter in [
+		('file:v2', {1111111111}),
+		('file:v1', {1222222222}),
+		('file:v1', None),
+		('other:v1', {1111111111}),
+	]:
+		store = DiskReferenceStore(path, source, npi_filter)
+		assert not store.complete
+		assert len(store) == 0
+		store.close()
+
+	# An unfinished map (e.g. from a run that died) isn't reused either
+	store = DiskReferenceStore(path, 'file:v3')
+	store.add(1, REFERENCES[1])
+	store.close()
+	assert not DiskReferenceStore(path, 'file:v3').complete
+
+
+@pytest.mark.parametrize('name', ['refs_first.json.gz', 'refs_after.json.gz'])
+def test_flattener_reuses_matching_maps(mrfs, tmp_path, monkeypatch, name):
+	url = mrfs[name]
+	reference_db = str(tmp_path / 'refs.db')
+
+	# A map that gets built is finished, one that's reused isn't
+	finish = DiskReferenceStore.finish
+	built = []
+	monkeypatch.setattr(DiskReferenceStore, 'finish', lambda self: built.append(1) or finish(self))
+
+	def run(out_name, **options):
+		built.clear()
+		in_network_file_to_csv(url, str(tmp_path / out_name), **options)
+		return not built, read_tables(tmp_path / out_name)
+
+	clean = {}
+	for code_filter in (None, CODES, {('CPT', '101')}):
+		_, clean[code_filter and frozenset(code_filter)] = run(f'clean-{len(clean)}', code_filter = code_filter)
+
+	runs = [
+		# (reused, code_filter, npi_filter, prune_references)
+		(False, None, None, False),
+		(True, None, None, False),
+		(False, None, NPI_FILTER, False),
+		(True, CODES, None, False),
+		(False, CODES, None, True),
+		(True, CODES, None, True),
+		(False, {('CPT', '101')}, None, True),
+	]
+	for i, (reused, code_filter, npi_filter, prune_references) in enumerate(runs):
+		result = run(
+			f'run-{i}',
+			code_filter = code_filter,
+			npi_filter = npi_filter,
+			prune_references = prune_references,
+			reference_db = reference_db,
+		)
+		assert result[0] == reused, runs[i]
+		if npi_filter is None:
+			assert result[1] == clean[code_filter and frozenset(code_filter)]
@@ -0,0 +1,139 @@
+from __future__ import annotations
+
+import io
+import json
+
+import ijson
+import pytest
+
+from mrfs import make_mrf
+from mrfutils import scanner
+from mrfutils.scanner import JSONScanner, ScanningParser, _scan_py
+
+# Strings that end, or don't, where a naive scan would get it wrong
+TRICKY = [
+	'',
+	'say "hi"',
+	'back\\slash',
+	'ends with \\',
+	'\\\\"',
+	'\\"]}',
+	'[not] {a} bracket',
+	'}}}]]]',
+	'\\\\\\"[',
+	'é ünïcode',
+]
+
+DOC = json.dumps({
+	'version': '1.0.0',
+	'provider_references': [{'provider_group_id': i, 'name': s} for i, s in enumerate(TRICKY)],
+	'in_network': [
+		{'name': s, 'nested': [[s, {s: [s]}], {}, []], 'n': 1.5, 'ok': True, 'none': None}
+		for s in TRICKY
+	],
+	'last': TRICKY,
+}, ensure_ascii = False).encode()
+
+MRF = json.dumps(make_mrf(n_items = 10, n_refs = 10), indent = 1).encode()
+
+CHUNK_SIZES = [1, 2, 3, 7, 64, 1 << 20]
+
+
+class Trickle(io.BytesIO):
+	"""Hands out at most `size` bytes per read"""
+
+	def __init__(self, data: bytes, size: int):
+		super().__init__(data)
+		self.size = size
+
+	def read(self, n: int = -1) -> bytes:
+		if n is None or n < 0 or n > self.size:
+			n = self.size
+		return super().read(n)
+
+
+@pytest.fixture(params = ['numpy', 'python'])
+def scan_path(request, monkeypatch):
+	if request.param == 'numpy':
+		if scanner.np is None:
+			pytest.skip('needs numpy')
+	else:
+		monkeypatch.setattr(scanner, 'np', None)
+	return request.param
+
+
+def read_items(doc: bytes, key: str, chunk_size: int) -> list:
+	"""The items of the top-level array `key`, via JSONScanner.read_value"""
+	s = JSONScanner(io.BytesIO(doc), chunk_size)
+	s.expect(b'{')
+	while True:
+		found = json.loads(s.read_string()) == key
+		s.expect(b':')
+		if found:
+			break
+		s.skip_value()
+		s.expect(b',')
+
+	items = []
+	s.expect(b'[')
+	while s.peek() != ord(']'):
+		if s.peek() == ord(','):
+			s.pos += 1
+		items.append(json.loads(s.read_value()))
+	return items
+
+
+@pytest.mark.parametrize('chunk_size', CHUNK_SIZES)
+def test_read_value_matches_json(scan_path, chunk_size):
+	data = json.loads(DOC)
+	for key in ('provider_references', 'in_network', 'last'):
+		assert read_items(DOC, key, chunk_size) == data[key]
+
+
+@pytest.mark.parametrize('chunk_size', CHUNK_SIZES)
+def test_copy_value(scan_path, chunk_size):
+	s = JSONScanner(io.BytesIO(DOC), chunk_size)
+	copy = io.BytesIO()
+	s.copy_value(copy)
+	assert copy.getvalue() == DOC
+	assert s.tell() == len(DOC)
+
+
+@pytest.mark.parametrize('doc', [DOC, MRF], ids = ['tricky', 'mrf'])
+@pytest.mark.parametrize('chunk_size', CHUNK_SIZES)
+def test_events_match_ijson(scan_path, doc, chunk_size):
+	expected = list(ijson.parse(io.BytesIO(doc)))
+	assert list(ScanningParser(Trickle(doc, chunk_size))) == expected
+
+
+def test_skip_item(scan_path):
+	parser = ScanningParser(io.BytesIO(DOC))
+	names = []
+	for prefix, event, value in parser:
+		if prefix == 'in_network.item.name':
+			names.append(value)
+			parser.skip_item()
+	assert names == TRICKY
+
+
+def test_bracket_index_matches_scan_py():
+	"""Brackets, strings and escapes counted the same way, wherever a chunk ends"""
+	if scanner.np is None:
+		pytest.skip('needs numpy')
+
+	for doc in (DOC, MRF[:4000]):
+		for cut in range(1, len(doc)):
+			base_depth = 1000
+			for base, buf, in_string in ((0, doc[:cut], False), (cut, doc, None)):
+				if in_string is None:
+					# Carry on from where the first chunk stopped
+					base, in_string = index.end, index.in_string
+				index = scanner._BracketIndex(buf, base, in_string)
+				value_end, _, depth, py_in_string = _scan_py(buf, base, index.end, base_depth, in_string)
+				assert value_end == -1
+				assert py_in_string == index.in_string
+				if len(index.depths):
+					assert depth == base_depth + index.depths[-1]
+				base_depth = depth
+			if doc is DOC:
+				assert base_depth == 1000
@@ -0,0 +1,45 @@
+from __future__ import annotations
+
+from mrfutils.idxutils import LinkCatalog
+from mrfutils.scheduler import pick_job, plan_jobs
+
+GB = 1 << 30
+
+
+def jobs(*sizes):
+	return [dict(url = f'file-{i}', size = size) for i, size in enumerate(sizes)]
+
+
+def test_pick_job_caps_large_files():
+	pending = jobs(None, 5 * GB, 2 * GB, 100, 10)
+
+	# The unknown size counts as large, and goes first
+	assert pick_job(pending, 0, 1) is pending[0]
+	# With a large one running, the biggest small one
+	assert pick_job(pending, 1, 1) is pending[3]
+	assert pick_job(pending, 1, 2) is pending[0]
+	assert pick_job(jobs(5 * GB, 2 * GB), 1, 1) is None
+
+
+def test_plan_jobs(tmp_path):
+	catalog = LinkCatalog(str(tmp_path / 'catalog.db'))
+	catalog.add_links([
+		('in_network', 'https://a.example/small.json.gz', 100),
+		('in_network', 'https://b.example/big.json.gz', 5 * GB),
+		('in_network', 'https://b.example/unsized.json.gz'),
+	], payer = 'a')
+	catalog.add_links([('in_network', 'https://c.example/other.json.gz', 10)], payer = 'c')
+	db = catalog.db
+
+	# Named after the file, like run_batch's directories
+	planned = plan_jobs(db, payer = 'a')
+	assert [job['name'] for job in planned] == ['unsized', 'big', 'small']
+
+	# A running job goes back to pending, done and failed ones don't
+	with db:
+		db.execute("UPDATE flatten_jobs SET status = 'running' WHERE name = 'big'")
+		db.execute("UPDATE flatten_jobs SET status = 'done' WHERE name = 'small'")
+		db.execute("UPDATE flatten_jobs SET status = 'failed' WHERE name = 'unsized'")
+	assert [job['name'] for job in plan_jobs(db)] == ['big', 'other']
+	assert [job['name'] for job in plan_jobs(db, retry_failed = True)] == ['unsized', 'big', 'other']
+	catalog.close()
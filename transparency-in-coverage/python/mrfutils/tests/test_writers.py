@@ -0,0 +1,184 @@
+from __future__ import annotations
+
+import csv
+import sqlite3
+
+import pytest
+
+from mrfutils.flatteners import in_network_file_to_csv
+from mrfutils.schema.schema import COLUMN_TYPES, SCHEMA
+from mrfutils.writers import WRITERS, CSVWriter, SeenKeys, SQLWriter, TableWriter, _to_int64, _to_uint64
+
+CODES = [
+	dict(id = 1, billing_code_type_version = '2023', billing_code = '99213', billing_code_type = 'CPT'),
+	dict(id = 2, billing_code_type_version = '2023', billing_code = '99214', billing_code_type = 'CPT'),
+]
+
+
+def _has_pyarrow() -> bool:
+	try:
+		import pyarrow  # noqa: F401
+	except ImportError:
+		return False
+	return True
+
+
+def writer_classes():
+	classes = []
+	for name, writer_class in WRITERS.items():
+		marks = ()
+		if name == 'parquet':
+			marks = pytest.mark.skipif(not _has_pyarrow(), reason = 'needs pyarrow')
+		classes.append(pytest.param(writer_class, id = name, marks = marks))
+	return classes
+
+
+@pytest.mark.parametrize('writer_class', writer_classes())
+def test_dedup_and_counts(writer_class, tmp_path):
+	with writer_class(str(tmp_path), dedup = True) as writer:
+		writer.write(CODES[0], 'code')
+		writer.write(CODES, 'code')
+		writer.write(CODES, 'code')
+
+	assert writer.rows_written == {'code': 2}
+	assert writer.hit_rates == {'code': pytest.approx(3 / 5)}
+
+
+@pytest.mark.parametrize('writer_class', writer_classes())
+def test_merge(writer_class, tmp_path):
+	shard_dir = tmp_path / 'shard'
+	shard_dir.mkdir()
+	with writer_class(str(shard_dir)) as shard:
+		shard.write(CODES, 'code')
+
+	with writer_class(str(tmp_path), dedup = True) as writer:
+		writer.write(CODES[0], 'code')
+		writer.merge(str(shard_dir), shard.rows_written)
+
+	assert writer.rows_written == {'code': 2}
+
+
+def test_writers_must_implement_the_sink(tmp_path):
+	with pytest.raises(TypeError):
+		TableWriter(str(tmp_path))
+
+	class NoMerge(TableWriter):
+		def _new_table(self, table_name, key_fields, seen):
+			pass
+
+		def _add(self, table, rows):
+			pass
+
+	with pytest.raises(TypeError, match = 'merge'):
+		NoMerge(str(tmp_path))
+
+
+def test_seen_keys_lru():
+	seen = SeenKeys(max_size = 2)
+	assert [seen.seen(key) for key in 'abab'] == [False, False, True, True]
+	# a was used less recently than b, so c pushes it out
+	seen.seen('a')
+	seen.seen('c')
+	assert list(seen.keys) == ['a', 'c']
+	assert not seen.seen('b')
+	assert seen.seen('c')
+	assert not seen.seen('a')
+	assert (seen.hits, seen.misses) == (4, 5)
+	assert seen.hit_rate == pytest.approx(4 / 9)
+
+	unbounded = SeenKeys()
+	assert [unbounded.seen(key) for key in 'abcab'] == [False, False, False, True, True]
+
+
+def test_bounded_dedup(tmp_path):
+	codes = [dict(CODES[0], id = i, billing_code = str(i)) for i in range(3)]
+	with CSVWriter(str(tmp_path), dedup = 2) as writer:
+		# The repeat of 0 keeps it over 1, which 2 then pushes out.
+		# 1 and 0 are written again, having been forgotten by then
+		for i in (0, 1, 0, 2, 1, 0):
+			writer.write(codes[i], 'code')
+
+	with open(tmp_path / 'code.csv', newline = '') as f:
+		assert [row['id'] for row in csv.DictReader(f)] == ['0', '1', '2', '1', '0']
+
+
+def test_csv_output(tmp_path):
+	with CSVWriter(str(tmp_path), max_rows = 1) as writer:
+		writer.write(CODES, 'code')
+		# Flushed as it goes
+		assert writer.rows_written == {'code': 2}
+
+	with open(tmp_path / 'code.csv', newline = '') as f:
+		rows = list(csv.DictReader(f))
+	assert [row['billing_code'] for row in rows] == ['99213', '99214']
+
+
+def test_sql_output(tmp_path):
+	with SQLWriter(str(tmp_path), batch_size = 1) as writer:
+		writer.write(CODES, 'code')
+		writer.write(CODES, 'code')
+
+	# The database drops the repeats without dedup
+	assert writer.rows_written == {'code': 2}
+	db = sqlite3.connect(tmp_path / 'mrf.db')
+	assert db.execute('SELECT billing_code FROM code ORDER BY id').fetchall() == [('99213',), ('99214',)]
+	db.close()
+
+
+def test_sql_uint64_ids(tmp_path):
+	ids = [5, (1 << 63) - 1, 1 << 63, (1 << 64) - 1]
+	codes = [dict(CODES[0], id = i, billing_code = str(i)) for i in ids]
+
+	shard_dir = tmp_path / 'shard'
+	shard_dir.mkdir()
+	with SQLWriter(str(shard_dir)) as shard:
+		shard.write(codes, 'code')
+
+	# Same bits, as a signed 64-bit INTEGER
+	db = sqlite3.connect(shard_dir / 'mrf.db')
+	stored = dict(db.execute('SELECT billing_code, id FROM code'))
+	db.close()
+	assert stored == {str(i): _to_int64(i) for i in ids}
+	assert stored[str(1 << 63)] == -(1 << 63)
+	assert stored[str((1 << 64) - 1)] == -1
+	assert all(_to_uint64(stored[str(i)]) == i for i in ids)
+
+	# And back to uint64 when merged into another writer
+	with SQLWriter(str(tmp_path)) as writer:
+		writer.merge(str(shard_dir), shard.rows_written)
+	assert writer.rows_written == {'code': len(ids)}
+	db = sqlite3.connect(tmp_path / 'mrf.db')
+	assert dict(db.execute('SELECT billing_code, id FROM code')) == stored
+	db.close()
+
+def test_sql_matches_csv(mrfs, tmp_path):
+	"""The SQL tables hold the same rows as the CSVs, IDs and all"""
+	url = mrfs['refs_first.json.gz']
+	in_network_file_to_csv(url, str(tmp_path / 'csv'))
+	in_network_file_to_csv(url, str(tmp_path / 'sql'), output_format = 'sql')
+
+	def value(v, uint64: bool):
+		if uint64:
+			return _to_uint64(int(v))
+		if v is None or v == '':
+			return ''
+		# REAL columns give 249.0 for a CSV's 249
+		try:
+			return float(v)
+		except ValueError:
+			return v
+
+	db = sqlite3.connect(tmp_path / 'sql' / 'mrf.db')
+	for table_name in ('code', 'rate_metadata', 'rate', 'tin', 'npi_tin', 'tin_rate_file', 'file'):
+		columns = SCHEMA[table_name]
+		column_types = COLUMN_TYPES.get(table_name, {})
+		uint64 = [column_types.get(column) == 'uint64' for column in columns]
+
+		with open(tmp_path / 'csv' / f'{table_name}.csv', newline = '') as f:
+			csv_rows = {tuple(map(value, row, uint64)) for row in list(csv.reader(f))[1:]}
+		sql_rows = {
+			tuple(map(value, row, uint64))
+			for row in db.execute(f'SELECT {", ".join(columns)} FROM {table_name}')
+		}
+		assert sql_rows == csv_rows, table_name
+	db.close()